@@ -7,11 +7,14 @@ from flask_moment import Moment
 from flask_bootstrap import Bootstrap
 from flask_pagedown import PageDown
 from flask_mongoengine import MongoEngine
+from .query_counter import QueryCounter
 
 db = MongoEngine()              # MongoDB
 bootstrap = Bootstrap()         # Styling of web interface.
 moment = Moment()               # For displaying time when message was received.
 pagedown = PageDown()           # For enabling HTML rendering of messages.
+# Database commands per request, created before connecting to MongoDB.
+query_counter = QueryCounter()
 
 
 def create_app(config_name='default', **config_overrides):
@@ -29,6 +32,11 @@ def create_app(config_name='default', **config_overrides):
     bootstrap.init_app(app)
     moment.init_app(app)
     pagedown.init_app(app)
+    query_counter.init_app(app)
+
+    # Configure message ingestion (write buffer etc.)
+    from .api_helpers import init_app as init_ingestion
+    init_ingestion(app)
 
     if not app.debug and not app.testing and not app.config['SSL_DISABLE']:
         from flask_sslify import SSLify
@@ -44,4 +52,9 @@ def create_app(config_name='default', **config_overrides):
     from .web_ui import web_ui as web_ui_blueprint
     app.register_blueprint(web_ui_blueprint, url_prefix='/web')
 
+    # Register blueprints for receiving Telegram updates via webhook. Updates
+    # are delivered to http(s)://<server_ip>:<server_port>/webhook/<secret>
+    from .webhook import webhook as webhook_blueprint
+    app.register_blueprint(webhook_blueprint, url_prefix='/webhook')
+
     return app
@@ -2,6 +2,18 @@
 global running_bots
 running_bots = {}
 
+# Dictionary object storing telegram.bot objects by webhook secret for bots
+# receiving updates via webhook.
+webhook_bots = {}
+
+# Ingestion settings, loaded from application configuration by init_app.
+ingestion_settings = {
+    'mode': 'polling',
+    'api_url': 'https://api.telegram.org/bot',
+    'webhook_url': None,
+    'webhook_certificate': None
+}
+
 # Setup the logger
 import logging
 from logging.handlers import RotatingFileHandler
@@ -26,3 +38,140 @@ proc_log_stream.setLevel(logging.ERROR)
 # Add handlers to the logger.
 proc_logger.addHandler(proc_log_fh)
 proc_logger.addHandler(proc_log_stream)
+
+# Write-behind buffer persisting logged messages in bulk.
+from .write_buffer import MessageWriteBuffer
+message_buffer = MessageWriteBuffer()
+
+# Journal receiving messages while the database is slow or unavailable.
+from .journal import SpillJournal
+spill_journal = SpillJournal()
+
+# Poller long-polling updates for all bots in multiplexed ingestion mode.
+from .poller import MultiplexedPoller
+update_poller = MultiplexedPoller()
+
+# Worker pool handling updates of all bots, partitioned by (bot_id, chat_id).
+from .worker_pool import PartitionedWorkerPool
+handler_pool = PartitionedWorkerPool()
+
+# Tracker of confirmed update offsets, advanced when messages are written.
+from .offsets import UpdateOffsetTracker
+offset_tracker = UpdateOffsetTracker()
+message_buffer.settle_listeners.append(offset_tracker.settled)
+
+# Cache of message listing results, invalidated when messages are written.
+from .result_cache import FilterCache
+filter_cache = FilterCache()
+message_buffer.flush_listeners.append(filter_cache.invalidate)
+
+# Materialized message counters per bot, chat and sender.
+from .counters import MessageCounters
+message_counters = MessageCounters()
+message_buffer.flush_listeners.append(message_counters.record)
+
+# Per minute and per hour message counts of chats for activity charts.
+from .rollups import MessageRollups
+message_rollups = MessageRollups()
+message_buffer.flush_listeners.append(message_rollups.record)
+
+# Approximate top senders and chats of bots over a sliding window.
+from .heavy_hitters import HeavyHitters
+heavy_hitters = HeavyHitters()
+message_buffer.flush_listeners.append(heavy_hitters.record)
+
+# Approximate unique sender counts of bots and chats.
+from .unique_senders import UniqueSenders
+unique_senders = UniqueSenders()
+message_buffer.flush_listeners.append(unique_senders.record)
+
+# Trending terms of message texts, globally and per bot.
+from .trending import TrendingTerms
+trending_terms = TrendingTerms()
+message_buffer.flush_listeners.append(trending_terms.record)
+
+# Directory of message senders used for username lookups.
+from .sender_directory import SenderDirectory
+sender_directory = SenderDirectory()
+message_buffer.flush_listeners.append(sender_directory.record)
+
+# In-memory registry of bots, reloaded when bots are changed.
+from .bot_registry import BotRegistry
+from botapp.models import MyBot
+bot_registry = BotRegistry()
+MyBot.change_listeners.append(bot_registry.changed)
+
+import atexit
+
+
+def init_app(app):
+    """
+    Configure message ingestion helpers from application configuration.
+    :param app: Flask application object.
+    :return:
+    """
+    ingestion_settings['mode'] = app.config.get('INGESTION_MODE', 'polling')
+    ingestion_settings['api_url'] = app.config.get(
+        'TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+    ingestion_settings['webhook_url'] = app.config.get('WEBHOOK_URL')
+    if app.config.get('WEBHOOK_UPLOAD_CERTIFICATE'):
+        ingestion_settings['webhook_certificate'] = \
+            app.config.get('SSL_CERTIFICATE')
+    message_buffer.init_app(app)
+    if app.config.get('JOURNAL_ENABLED'):
+        spill_journal.init_app(app)
+        message_buffer.attach_journal(spill_journal)
+    else:
+        message_buffer.attach_journal(None)
+    update_poller.init_app(app)
+    update_poller.paused = message_buffer.overloaded
+    handler_pool.init_app(app)
+    filter_cache.init_app(app)
+    message_counters.init_app(app)
+    message_rollups.init_app(app)
+    heavy_hitters.init_app(app)
+    unique_senders.init_app(app)
+    trending_terms.init_app(app)
+    sender_directory.init_app(app)
+    bot_registry.init_app(app)
+
+
+def forget_bot(bot_id):
+    """
+    Remove a bot from aggregates of logged messages (counters, rollups,
+    sketches and sender directory), before its messages are deleted.
+    :param bot_id: ID of the bot.
+    :return:
+    """
+    for aggregate in (message_counters, message_rollups, heavy_hitters,
+                      unique_senders, trending_terms, sender_directory):
+        aggregate.forget_bot(bot_id)
+
+
+def clear_aggregates():
+    """
+    Remove all aggregates of logged messages, after all messages are
+    deleted.
+    :return:
+    """
+    for aggregate in (message_counters, message_rollups, heavy_hitters,
+                      unique_senders, trending_terms, sender_directory):
+        aggregate.clear()
+
+
+def shutdown():
+    """
+    Stop ingestion helpers in order, so that polled updates are handled and
+    logged messages are flushed before the process exits.
+    :return:
+    """
+    update_poller.stop()
+    handler_pool.close()
+    message_buffer.close()
+    message_rollups.close()
+    heavy_hitters.close()
+    unique_senders.close()
+    spill_journal.close()
+    offset_tracker.commit()
+
+atexit.register(shutdown)
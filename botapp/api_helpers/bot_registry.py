@@ -0,0 +1,192 @@
+"""
+Module containing the bot registry, an in-memory copy of all registered bots
+indexed by ID, lowercase username and token. Bot lookups of procedures and
+views read the registry instead of querying MyBot. Every change of a bot
+increments a version stamp stored in the database; processes compare their
+loaded version with the stored one (at most every check_interval seconds)
+and reload all bots when it changed, so worker processes stay coherent.
+"""
+import time
+import threading
+from pymongo import ReturnDocument
+from botapp.models import MyBot, RegistryVersion
+from . import proc_logger
+
+# Name of the version stamp of the MyBot collection.
+VERSION_NAME = 'mybot'
+
+
+class BotRegistry(object):
+    """
+    Cache of MyBot documents. Lookups return copies of cached bots, so
+    changes of a caller are not seen by others until the bot is saved, which
+    notifies the registry.
+    :param check_interval: Time (in seconds) between checks of the stored
+    version stamp, changes of other processes are seen after at most this
+    time. Changes of this process are seen immediately.
+    :param enabled: If False, lookups query the database.
+    """
+
+    def __init__(self, check_interval=1.0, enabled=True):
+        self.check_interval = check_interval
+        self.enabled = enabled
+        self._by_id = {}
+        self._by_username = {}
+        self._by_token = {}
+        self._version = None            # Loaded version, None if not loaded.
+        self._checked = 0               # Time of last version check.
+        self._lock = threading.Lock()
+        # Metrics
+        self._loads = 0
+        self._checks = 0
+
+    def init_app(self, app):
+        """
+        Load bot registry settings from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.enabled = app.config.get('BOT_REGISTRY_ENABLED', True)
+        self.check_interval = app.config.get('BOT_REGISTRY_CHECK_INTERVAL',
+                                             self.check_interval)
+        self.invalidate()
+
+    def _stored_version(self):
+        document = RegistryVersion._get_collection().find_one(
+            {'_id': VERSION_NAME}, {'version': 1})
+        return document['version'] if document else 0
+
+    def changed(self, bot=None):
+        """
+        Increment the stored version stamp after bots are changed, used as
+        change listener of MyBot. Call it after queryset updates and deletes
+        of bots, which do not notify listeners.
+        :param bot: Changed MyBot object (unused, all bots are reloaded).
+        :return:
+        """
+        if not self.enabled:
+            return
+        RegistryVersion._get_collection().find_one_and_update(
+            {'_id': VERSION_NAME}, {'$inc': {'version': 1}}, upsert=True,
+            return_document=ReturnDocument.AFTER)
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Reload bots on the next lookup.
+        :return:
+        """
+        with self._lock:
+            self._version = None
+
+    def reload(self):
+        """
+        Load all bots from the database.
+        :return: Number of bots.
+        """
+        with self._lock:
+            # Read the version first, a change during loading reloads again.
+            version = self._stored_version()
+            by_id, by_username, by_token = {}, {}, {}
+            for bot in MyBot.objects.order_by('bot_id'):
+                by_id[bot.bot_id] = bot
+                by_token[bot.token] = bot
+                if bot.username_lower:
+                    by_username[bot.username_lower] = bot
+            self._by_id, self._by_username, self._by_token = \
+                by_id, by_username, by_token
+            self._version = version
+            self._checked = time.time()
+            self._loads += 1
+        proc_logger.info('Loaded {count} bots into bot registry (version '
+                         '{version}).'.format(count=len(by_id),
+                                              version=version))
+        return len(by_id)
+
+    def _refresh(self):
+        if self._version is None:
+            self.reload()
+        elif time.time() - self._checked >= self.check_interval:
+            self._checks += 1
+            self._checked = time.time()
+            if self._stored_version() != self._version:
+                self.reload()
+
+    @staticmethod
+    def _copy(bot):
+        """
+        :param bot: Cached MyBot object or None.
+        :return: Copy of the bot, as loaded from the database, or None.
+        """
+        if bot is None:
+            return None
+        return MyBot._from_son(bot.to_mongo())
+
+    def get(self, bot_id):
+        """
+        :param bot_id: ID of the bot.
+        :return: MyBot object or None.
+        """
+        if not self.enabled:
+            return MyBot.objects(bot_id=bot_id).first()
+        self._refresh()
+        return self._copy(self._by_id.get(bot_id))
+
+    def by_username(self, username):
+        """
+        :param username: Username of the bot (case insensitive).
+        :return: MyBot object or None.
+        """
+        username = (username or '').lower()
+        if not self.enabled:
+            return MyBot.objects(username_lower=username).first()
+        self._refresh()
+        return self._copy(self._by_username.get(username))
+
+    def by_token(self, token):
+        """
+        :param token: Token of the bot.
+        :return: MyBot object or None.
+        """
+        if not self.enabled:
+            return MyBot.objects(token=token).first()
+        self._refresh()
+        return self._copy(self._by_token.get(token))
+
+    def find(self, botid=None, username=None):
+        """
+        :param botid: ID of the bot, looked up first.
+        :param username: Username of the bot (case insensitive), looked up if
+        no bot is registered with botid.
+        :return: MyBot object or None.
+        """
+        return self.get(botid or 0) or self.by_username(username)
+
+    def bots(self):
+        """
+        :return: List of all MyBot objects ordered by ID.
+        """
+        if not self.enabled:
+            return list(MyBot.objects.order_by('bot_id'))
+        self._refresh()
+        return [self._copy(bot) for bot in
+                sorted(self._by_id.values(), key=lambda bot: bot.bot_id)]
+
+    def choices(self, key='bot_id'):
+        """
+        :param key: Bot attribute used as value of choices.
+        :return: List of (value, username) of all bots for select fields.
+        """
+        return [(getattr(bot, key), bot.username) for bot in self.bots()]
+
+    def stats(self):
+        """
+        :return: Dictionary of bot registry metrics.
+        """
+        return {
+            'enabled': self.enabled,
+            'bots': len(self._by_id),
+            'version': self._version,
+            'loads': self._loads,
+            'checks': self._checks
+        }
@@ -0,0 +1,206 @@
+"""
+Module containing materialized message counters per bot, chat and sender.
+Counters are incremented for every batch of messages written by the write
+buffer (duplicates and dropped messages are not counted), so the number of
+messages of a bot is read from a few counter documents instead of counting
+its messages.
+"""
+import random
+from collections import defaultdict
+from pymongo import UpdateOne, InsertOne
+from pymongo.errors import BulkWriteError
+from botapp.models import Message, MessageCounter
+from .write_buffer import bulk_write_reason
+from . import proc_logger
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _keys(document):
+    """
+    :param document: Message document.
+    :return: List of (kind, key) counters a message is counted in.
+    """
+    keys = [('bot', str(document.get('bot_id', 0))),
+            ('chat', str(document.get('chatid', 0)))]
+    if document.get('sender_username_lower'):
+        keys.append(('sender', document['sender_username_lower']))
+    return keys
+
+
+def bulk_upsert(collection, requests, ignore_duplicates=False):
+    """
+    Write upserts with an unordered bulk write. Concurrent upserts creating
+    the same document fail with a duplicate key error for all but one of
+    them, these are retried once (and then update the created document).
+    :param collection: pymongo Collection object.
+    :param requests: List of UpdateOne requests with upsert=True.
+    :param ignore_duplicates: If True, requests failing again with a
+    duplicate key error are skipped, e.g. upserts whose filter excludes
+    documents they already updated.
+    :return:
+    :except BulkWriteError: If requests fail for another reason, or again.
+    """
+    for attempt in range(2):
+        if not requests:
+            return
+        try:
+            collection.bulk_write(requests, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors')
+            # Write concern errors (without write errors) are not retried.
+            if not errors or any(error['code'] != DUPLICATE_KEY_ERROR
+                                 for error in errors):
+                raise
+            if attempt:
+                if ignore_duplicates:
+                    return
+                raise
+            requests = [requests[error['index']] for error in errors]
+
+
+class MessageCounters(object):
+    """
+    Sharded message counters updated with $inc.
+    :param shards: Number of shards of each counter, an increment goes to a
+    random shard.
+    :param enabled: If False, written messages are not counted.
+    """
+
+    def __init__(self, shards=8, enabled=True):
+        self.shards = shards
+        self.enabled = enabled
+        # Metrics
+        self._increments = 0
+        self._failures = 0
+
+    def init_app(self, app):
+        """
+        Load counter settings from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.shards = app.config.get('MESSAGE_COUNTER_SHARDS', 8)
+        self.enabled = app.config.get('MESSAGE_COUNTERS_ENABLED', True)
+
+    def record(self, documents):
+        """
+        Count written messages, used as flush listener of the message write
+        buffer. Increments of a batch are summed per counter first.
+        :param documents: Written message documents.
+        :return:
+        """
+        if not self.enabled:
+            return
+        increments = defaultdict(int)
+        for document in documents:
+            for key in _keys(document):
+                increments[key] += 1
+        self._increment(increments)
+
+    def _increment(self, increments):
+        """
+        :param increments: Dictionary of (kind, key) and value added to it.
+        :return:
+        """
+        requests = [UpdateOne({'kind': kind, 'key': key,
+                               'shard': random.randrange(self.shards)},
+                              {'$inc': {'count': value}}, upsert=True)
+                    for (kind, key), value in increments.items() if value]
+        try:
+            bulk_upsert(MessageCounter._get_collection(), requests)
+        except BulkWriteError as e:
+            self._failures += 1
+            proc_logger.error('Unable to update message counters. Reason:'
+                              '{reason}'.format(
+                                reason=bulk_write_reason(e)))
+            return
+        self._increments += len(requests)
+
+    def count(self, kind, key):
+        """
+        :param kind: Kind of counter, 'bot', 'chat' or 'sender'.
+        :param key: Bot ID, chat ID or (lowercase) sender username.
+        :return: Number of messages counted.
+        """
+        return self.counts(kind, [key]).get(str(key), 0)
+
+    def counts(self, kind, keys=None):
+        """
+        :param kind: Kind of counters, 'bot', 'chat' or 'sender'.
+        :param keys: Keys of counters, all counters of kind if None.
+        :return: Dictionary of key (string) and number of messages counted.
+        """
+        match = {'kind': kind}
+        if keys is not None:
+            match['key'] = {'$in': [str(key) for key in keys]}
+        collection = MessageCounter._get_collection()
+        return dict((row['_id'], row['count']) for row in collection.aggregate(
+            [{'$match': match},
+             {'$group': {'_id': '$key', 'count': {'$sum': '$count'}}}]))
+
+    def forget_bot(self, bot_id):
+        """
+        Remove counts of a bot's messages before they are deleted, counters
+        of their chats and senders are decremented accordingly.
+        :param bot_id: ID of the bot.
+        :return:
+        """
+        decrements = defaultdict(int)
+        for kind, field in (('chat', 'chatid'),
+                            ('sender', 'sender_username_lower')):
+            for row in Message._get_collection().aggregate(
+                    [{'$match': {'bot_id': bot_id, field: {'$ne': None}}},
+                     {'$group': {'_id': '$' + field, 'count': {'$sum': 1}}}],
+                    allowDiskUse=True):
+                decrements[(kind, str(row['_id']))] -= row['count']
+        self._increment(decrements)
+        MessageCounter._get_collection().delete_many(
+            {'kind': 'bot', 'key': str(bot_id)})
+
+    def clear(self):
+        """
+        Remove all counters e.g. after all messages are deleted.
+        :return:
+        """
+        MessageCounter._get_collection().delete_many({})
+
+    def rebuild(self, batch_size=1000):
+        """
+        Recompute all counters from the messages collection. Messages written
+        while counters are rebuilt may be counted twice or not at all, so
+        rebuild while ingestion is stopped.
+        :param batch_size: Number of counters inserted per bulk write.
+        :return counts: Dictionary of kind and number of counters.
+        """
+        collection = MessageCounter._get_collection()
+        collection.delete_many({})
+        counts = {}
+        for kind, field in (('bot', 'bot_id'), ('chat', 'chatid'),
+                            ('sender', 'sender_username_lower')):
+            counts[kind] = 0
+            batch = []
+            for row in Message._get_collection().aggregate(
+                    [{'$match': {field: {'$ne': None}}},
+                     {'$group': {'_id': '$' + field, 'count': {'$sum': 1}}}],
+                    allowDiskUse=True):
+                batch.append(InsertOne({'kind': kind, 'key': str(row['_id']),
+                                        'shard': 0, 'count': row['count']}))
+                if len(batch) >= batch_size:
+                    collection.bulk_write(batch, ordered=False)
+                    counts[kind] += len(batch)
+                    batch = []
+            if batch:
+                collection.bulk_write(batch, ordered=False)
+                counts[kind] += len(batch)
+            proc_logger.info('Rebuilt {count} {kind} message counters.'.format(
+                count=counts[kind], kind=kind))
+        return counts
+
+    def stats(self):
+        """
+        :return: Dictionary of counter metrics.
+        """
+        return {'enabled': self.enabled, 'shards': self.shards,
+                'increments': self._increments, 'failures': self._failures}
@@ -0,0 +1,372 @@
+"""
+Module containing approximate top senders and chats of bots over a sliding
+window. Written messages are counted per bot by Space-Saving sketches, one
+sketch per slice of the window, which keep at most capacity counters each, so
+the busiest senders and chats of a bot are answered from a few sketches
+without grouping its messages. Sketches are merged into the database, so
+counts survive a restart and include messages of all worker processes.
+"""
+import time
+import threading
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from botapp.models import HeavyHitterCheckpoint
+from .unique_senders import MAX_MERGE_ATTEMPTS
+from .periodic import PeriodicWorker
+from . import proc_logger
+
+# Dimensions messages are counted by, and the message field of their keys.
+DIMENSIONS = {'sender': 'sender_username_lower', 'chat': 'chatid'}
+
+
+class SpaceSaving(object):
+    """
+    Space-Saving sketch of the most frequent keys of a stream. When all
+    counters are taken, the key with the smallest count is replaced by the new
+    key, which inherits its count as error. The true count of a key is
+    between count - error and count, keys missing from the sketch occurred at
+    most minimum() times.
+    :param capacity: Maximum number of counters.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counters = {}          # key -> [count, error]
+        self.total = 0
+
+    def offer(self, key, count=1):
+        """
+        :param key: Occurred key e.g. a sender username.
+        :param count: Number of occurrences.
+        :return:
+        """
+        self.total += count
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [count, 0]
+        else:
+            smallest = min(self.counters, key=lambda k: self.counters[k][0])
+            minimum = self.counters.pop(smallest)[0]
+            self.counters[key] = [minimum + count, minimum]
+
+    def minimum(self):
+        """
+        :return: Maximum count of keys not in the sketch.
+        """
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(counter[0] for counter in self.counters.values())
+
+    def top(self, k):
+        """
+        :param k: Number of keys.
+        :return: List of (key, count, error) tuples of the k keys with
+        highest counts, highest first.
+        """
+        return sorted(((key, count, error) for key, (count, error) in
+                       self.counters.items()),
+                      key=lambda entry: (-entry[1], entry[2]))[:k]
+
+    @classmethod
+    def merge(cls, sketches, capacity):
+        """
+        Combine sketches of disjoint parts of a stream. A key missing from a
+        sketch is counted with that sketch's minimum, both as count and error,
+        so bounds of merged counts hold.
+        :param sketches: List of SpaceSaving objects.
+        :param capacity: Capacity of the merged sketch.
+        :return: SpaceSaving object.
+        """
+        merged = cls(capacity)
+        minimums = [sketch.minimum() for sketch in sketches]
+        keys = set()
+        for sketch in sketches:
+            keys.update(sketch.counters)
+            merged.total += sketch.total
+        for key in keys:
+            count = error = 0
+            for sketch, minimum in zip(sketches, minimums):
+                counter = sketch.counters.get(key, (minimum, minimum))
+                count += counter[0]
+                error += counter[1]
+            merged.counters[key] = [count, error]
+        if len(merged.counters) > capacity:
+            merged.counters = dict(
+                (key, [count, error]) for key, count, error in
+                merged.top(capacity))
+        return merged
+
+    def to_list(self):
+        return [[key, count, error] for key, (count, error) in
+                self.counters.items()]
+
+    @classmethod
+    def from_list(cls, counters, total, capacity):
+        sketch = cls(capacity)
+        sketch.counters = dict((key, [count, error]) for key, count, error in
+                               counters[:capacity])
+        sketch.total = total
+        return sketch
+
+
+class HeavyHitters(object):
+    """
+    Sliding window top senders and chats per bot. Messages written by this
+    process are counted by in-memory sketches, which are merged into the
+    sketches stored in the database every checkpoint_interval seconds.
+    Stored sketches are replaced only if their version did not change since
+    they were read, so worker processes counting messages concurrently do
+    not overwrite each other's counts. Top senders and chats are read from
+    the stored sketches and the sketches of this process.
+    :param capacity: Number of counters of each sketch, the error of counts
+    is at most number of messages in the window divided by capacity.
+    :param window: Length (in seconds) of the window.
+    :param slices: Number of slices of the window, the window advances by
+    window / slices seconds.
+    :param checkpoint_interval: Time (in seconds) between checkpoints.
+    :param enabled: If False, written messages are not counted.
+    """
+
+    def __init__(self, capacity=100, window=3600, slices=12,
+                 checkpoint_interval=10, enabled=True):
+        self.capacity = capacity
+        self.window = window
+        self.slices = slices
+        self.checkpoint_interval = checkpoint_interval
+        self.enabled = enabled
+        # (bot_id, dimension) -> {slice start: SpaceSaving} not yet merged
+        # into the stored sketches.
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._worker = PeriodicWorker('heavy-hitters', self._save,
+                                      lambda: self.checkpoint_interval)
+        # Metrics
+        self._checkpoints = 0
+        self._conflicts = 0
+        self._failures = 0
+
+    def init_app(self, app):
+        """
+        Load heavy hitter settings from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.enabled = app.config.get('HEAVY_HITTERS_ENABLED', True)
+        self.capacity = app.config.get('HEAVY_HITTERS_CAPACITY', self.capacity)
+        self.window = app.config.get('HEAVY_HITTERS_WINDOW', self.window)
+        self.slices = app.config.get('HEAVY_HITTERS_SLICES', self.slices)
+        self.checkpoint_interval = app.config.get(
+            'HEAVY_HITTERS_CHECKPOINT_INTERVAL', self.checkpoint_interval)
+
+    def _slice_start(self, now):
+        length = float(self.window) / self.slices
+        return now - now % length
+
+    def record(self, documents, now=None):
+        """
+        Count written messages of bots by sender and chat, used as flush
+        listener of the message write buffer.
+        :param documents: Written message documents.
+        :param now: Current time (seconds since epoch), time.time() if None.
+        :return:
+        """
+        if not self.enabled:
+            return
+        start = self._slice_start(now or time.time())
+        with self._lock:
+            for document in documents:
+                for dimension, field in DIMENSIONS.items():
+                    value = document.get(field)
+                    if value is None:
+                        continue
+                    slices = self._pending.setdefault(
+                        (document.get('bot_id', 0), dimension), {})
+                    sketch = slices.get(start)
+                    if sketch is None:
+                        sketch = slices[start] = SpaceSaving(self.capacity)
+                    sketch.offer(value)
+        self.start()
+
+    def top(self, bot_id, dimension, k=10, now=None):
+        """
+        :param bot_id: ID of the bot.
+        :param dimension: 'sender' or 'chat'.
+        :param k: Number of senders or chats, at most capacity.
+        :param now: Current time (seconds since epoch), time.time() if None.
+        :return: Dictionary of top k keys with counts and error bounds
+        (count - error <= true count <= count), number of counted messages
+        in the window and the maximum count of keys not listed.
+        :except ValueError: If dimension is not supported.
+        """
+        if dimension not in DIMENSIONS:
+            raise ValueError('Invalid dimension:{dimension}, use one of '
+                             '{dimensions}.'.format(
+                                dimension=dimension,
+                                dimensions=', '.join(sorted(DIMENSIONS))))
+        oldest = (now or time.time()) - self.window
+        document = HeavyHitterCheckpoint._get_collection().find_one(
+            {'bot_id': bot_id, 'dimension': dimension}, {'slices': 1})
+        sketches = [sketch for start, sketch in
+                    self._slices(document).items() if start > oldest]
+        with self._lock:
+            sketches.extend(
+                sketch for start, sketch in
+                self._pending.get((bot_id, dimension), {}).items()
+                if start > oldest)
+        merged = SpaceSaving.merge(sketches, self.capacity)
+        k = min(k, self.capacity)
+        top = merged.top(k + 1)
+        # Keys not listed occurred at most others_max times, listed keys
+        # occurring more often than that are guaranteed to be in the top k.
+        others_max = top[k][1] if len(top) > k else merged.minimum()
+        return {
+            'messages': merged.total,
+            'top': [{'key': key, 'count': count, 'error': error,
+                     'guaranteed': count - error >= others_max}
+                    for key, count, error in top[:k]],
+            'others_max': others_max
+        }
+
+    def _slices(self, document):
+        """
+        :param document: Stored HeavyHitterCheckpoint document or None.
+        :return: Dictionary of slice start and SpaceSaving object.
+        """
+        if document is None:
+            return {}
+        return dict((item['start'], SpaceSaving.from_list(
+            item['counters'], item['total'], self.capacity))
+            for item in document.get('slices', []))
+
+    def forget_bot(self, bot_id):
+        """
+        Remove counts of a bot whose messages are deleted.
+        :param bot_id: ID of the bot.
+        :return:
+        """
+        with self._lock:
+            for dimension in DIMENSIONS:
+                self._pending.pop((bot_id, dimension), None)
+        HeavyHitterCheckpoint._get_collection().delete_many({'bot_id': bot_id})
+
+    def clear(self):
+        """
+        Remove all counts e.g. after all messages are deleted.
+        :return:
+        """
+        with self._lock:
+            self._pending.clear()
+        HeavyHitterCheckpoint._get_collection().delete_many({})
+
+    def checkpoint(self, now=None):
+        """
+        Merge in-memory sketches into the stored sketches, expired slices are
+        dropped. Sketches which could not be merged are kept for the next
+        checkpoint.
+        :param now: Current time (seconds since epoch), time.time() if None.
+        :return: Number of merged (bot, dimension) sketches.
+        :except PyMongoError: If a sketch could not be merged.
+        """
+        oldest = (now or time.time()) - self.window
+        with self._checkpoint_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            collection = HeavyHitterCheckpoint._get_collection()
+            merged = 0
+            try:
+                for key in list(pending):
+                    self._merge(collection, key, pending[key], oldest)
+                    del pending[key]
+                    merged += 1
+            finally:
+                if pending:
+                    self._requeue(pending)
+            self._checkpoints += 1
+            return merged
+
+    def _merge(self, collection, key, slices, oldest):
+        bot_id, dimension = key
+        query = {'bot_id': bot_id, 'dimension': dimension}
+        for attempt in range(MAX_MERGE_ATTEMPTS):
+            document = collection.find_one(query, {'slices': 1,
+                                                   'version': 1})
+            stored = self._slices(document)
+            for start, sketch in slices.items():
+                stored[start] = SpaceSaving.merge(
+                    [stored[start], sketch], self.capacity) \
+                    if start in stored else sketch
+            items = [{'start': start, 'total': sketch.total,
+                      'counters': sketch.to_list()}
+                     for start, sketch in sorted(stored.items())
+                     if start > oldest]
+            if document is None:
+                try:
+                    collection.insert_one(dict(query, version=1,
+                                               slices=items))
+                    return
+                except DuplicateKeyError:
+                    self._conflicts += 1
+                    continue
+            result = collection.update_one(
+                dict(query, version=document.get('version', 0)),
+                {'$set': {'slices': items}, '$inc': {'version': 1}})
+            if result.matched_count:
+                return
+            self._conflicts += 1
+        raise PyMongoError('Sketch updated concurrently {count} times.'
+                           .format(count=MAX_MERGE_ATTEMPTS))
+
+    def _requeue(self, pending):
+        """
+        Put sketches which could not be merged back, combined with sketches
+        counted meanwhile.
+        :param pending: Dictionary of (bot_id, dimension) and slices.
+        :return:
+        """
+        with self._lock:
+            for key, slices in pending.items():
+                current = self._pending.setdefault(key, {})
+                for start, sketch in slices.items():
+                    current[start] = SpaceSaving.merge(
+                        [current[start], sketch], self.capacity) \
+                        if start in current else sketch
+
+    def start(self):
+        """
+        Start the background checkpoint thread if it is not running already.
+        :return:
+        """
+        self._worker.start()
+
+    def close(self):
+        """
+        Stop the background thread and merge in-memory sketches.
+        :return:
+        """
+        self._worker.close()
+        if self._pending:
+            self._save()
+
+    def _save(self):
+        try:
+            self.checkpoint()
+        except PyMongoError as e:
+            self._failures += 1
+            proc_logger.error('Unable to checkpoint top senders and chats. '
+                              'Reason:{reason}'.format(reason=e))
+
+    def stats(self):
+        """
+        :return: Dictionary of heavy hitter metrics.
+        """
+        with self._lock:
+            sketches = sum(len(slices) for slices in self._pending.values())
+        return {
+            'enabled': self.enabled,
+            'pending': sketches,
+            'checkpoints': self._checkpoints,
+            'conflicts': self._conflicts,
+            'failures': self._failures
+        }
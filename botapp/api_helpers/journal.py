@@ -0,0 +1,389 @@
+"""
+This module contains the on-disk spill journal of the write buffer. Messages
+which can not be written to MongoDB (database down or write path saturated)
+are appended to segmented journal files and written to the database by a
+background replayer once it is available again.
+"""
+
+import os
+import time
+import threading
+from datetime import datetime
+from bson import json_util
+from . import proc_logger
+
+SEGMENT_SUFFIX = '.journal'
+# File of the journal directory receiving documents which can not be written.
+QUARANTINE_NAME = 'quarantine.log'
+
+
+class SpillJournal(object):
+    """
+    Append-only journal of message documents. Appended documents are fsynced
+    in groups every fsync_interval seconds, the durable_listeners are notified
+    once documents are on disk. A segment is closed when it reaches
+    segment_size bytes and deleted once all of its documents are replayed.
+    :param directory: Directory containing the journal segments.
+    :param segment_size: Size (in bytes) of a segment before it is closed.
+    :param max_size: Journal size (in bytes) above which it is overloaded.
+    :param fsync_interval: Maximum time (in seconds) before appended
+    documents are fsynced.
+    :param replay_interval: Time (in seconds) between replay attempts.
+    :param batch_size: Number of documents replayed per bulk write.
+    """
+
+    def __init__(self, directory='logs/journal', segment_size=4194304,
+                 max_size=268435456, fsync_interval=0.1, replay_interval=1.0,
+                 batch_size=100):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync_interval = fsync_interval
+        self.replay_interval = replay_interval
+        self.batch_size = batch_size
+        # Callable writing a list of documents to the database, returns
+        # whether all documents were written (False is retried later).
+        # Documents which can never be written are passed to quarantine() by
+        # the writer, or make it raise an exception.
+        self.writer = None
+        # Callables invoked with the list of documents fsynced to the journal.
+        self.durable_listeners = []
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+        self._loaded = False
+        self._segments = []             # Closed segments, oldest first.
+        self._active = None             # Path of segment being appended.
+        self._file = None
+        self._sequence = 0
+        self._unsynced = []
+        self._size = 0
+        self._pending = 0
+        # Metrics
+        self._appended = 0
+        self._replayed = 0
+        self._replay_failures = 0
+        self._quarantined = 0
+
+    def init_app(self, app):
+        """
+        Configure the journal from application configuration and replay
+        segments left by a previous run.
+        :param app: Flask application object.
+        :return:
+        """
+        if self._running:
+            return
+        self.directory = app.config.get('JOURNAL_DIR', self.directory)
+        self.segment_size = app.config.get('JOURNAL_SEGMENT_SIZE',
+                                           self.segment_size)
+        self.max_size = app.config.get('JOURNAL_MAX_SIZE', self.max_size)
+        self.fsync_interval = app.config.get('JOURNAL_FSYNC_INTERVAL',
+                                             self.fsync_interval)
+        self.replay_interval = app.config.get('JOURNAL_REPLAY_INTERVAL',
+                                              self.replay_interval)
+        self._loaded = False
+        self._load()
+        if self._segments:
+            self.start()
+
+    def _load(self):
+        """
+        Find segments present in the journal directory.
+        :return:
+        """
+        if self._loaded:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(SEGMENT_SUFFIX))
+        self._segments = [os.path.join(self.directory, name) for name in names]
+        self._size = sum(os.path.getsize(path) for path in self._segments)
+        self._pending = sum(self._count(path) for path in self._segments)
+        if names:
+            self._sequence = int(names[-1][:-len(SEGMENT_SUFFIX)])
+            proc_logger.warn('Found {count} journaled messages to be replayed.'
+                             .format(count=self._pending))
+        self._loaded = True
+
+    @staticmethod
+    def _count(path):
+        with open(path, 'rb') as segment:
+            return sum(1 for line in segment if line.strip())
+
+    def start(self):
+        """
+        Start the background thread syncing and replaying the journal if it
+        is not running already.
+        :return:
+        """
+        with self._lock:
+            if self._running:
+                return
+            self._load()
+            self._running = True
+            self._thread = threading.Thread(target=self._run,
+                                            name='spill-journal')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def append(self, documents):
+        """
+        Append documents to the active segment. Documents are durable once
+        the durable_listeners are notified.
+        :param documents: List of message documents.
+        :return:
+        """
+        self.start()
+        now = time.time()
+        with self._lock:
+            if self._file is None:
+                self._open_segment()
+            for document in documents:
+                line = json_util.dumps({'t': now, 'd': document}) + '\n'
+                self._file.write(line)
+                self._size += len(line)
+            self._unsynced.extend(documents)
+            self._pending += len(documents)
+            self._appended += len(documents)
+            if self._file.tell() >= self.segment_size:
+                self._close_segment()
+
+    def _open_segment(self):
+        self._sequence += 1
+        self._active = os.path.join(self.directory, '{0:012d}{1}'.format(
+            self._sequence, SEGMENT_SUFFIX))
+        self._file = open(self._active, 'ab')
+
+    def _close_segment(self):
+        self._fsync()
+        self._file.close()
+        self._segments.append(self._active)
+        self._file = self._active = None
+
+    def _fsync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def sync(self):
+        """
+        Fsync appended documents and notify the durable_listeners.
+        :return:
+        """
+        with self._lock:
+            if self._unsynced:
+                self._fsync()
+            documents, self._unsynced = self._unsynced, []
+        if not documents:
+            return
+        for listener in self.durable_listeners:
+            try:
+                listener(documents)
+            except Exception as e:
+                proc_logger.error('Journal listener:{name} failed. Reason:'
+                                  '{reason}'.format(name=listener.__name__,
+                                                    reason=e))
+
+    def _run(self):
+        last_replay = 0
+        while self._running:
+            self._wakeup.wait(self.fsync_interval)
+            self._wakeup.clear()
+            if not self._running:
+                break               # Closing, segments are replayed later.
+            try:
+                self.sync()
+                if time.time() - last_replay >= self.replay_interval:
+                    last_replay = time.time()
+                    self.replay()
+            except Exception as e:
+                proc_logger.error('Unexpected error in spill journal. Reason:'
+                                  '{reason}'.format(reason=e))
+
+    def replay(self):
+        """
+        Write journaled documents to the database, oldest segment first. The
+        active segment is closed for replay once no closed segment is left.
+        Replay stops at the first failing batch, as writes are idempotent the
+        segment is replayed again from its start on the next attempt.
+        Documents which can never be written are quarantined instead.
+        :return replayed: Number of documents replayed.
+        """
+        replayed = 0
+        with self._replay_lock:
+            while True:
+                with self._lock:
+                    if not self._segments and self._file is not None and \
+                            not self._unsynced:
+                        self._close_segment()
+                    if not self._segments:
+                        break
+                    path = self._segments[0]
+                count = self._replay_segment(path)
+                if count is None:
+                    self._replay_failures += 1
+                    break
+                with self._lock:
+                    self._segments.pop(0)
+                    self._size -= os.path.getsize(path)
+                    self._pending -= count
+                    self._replayed += count
+                os.remove(path)
+                replayed += count
+        if replayed:
+            proc_logger.info('Replayed {count} journaled messages.'.format(
+                count=replayed))
+        return replayed
+
+    def _replay_segment(self, path):
+        """
+        :param path: Path of a closed segment.
+        :return: Number of replayed documents or None if writing failed.
+        """
+        count = 0
+        batch = []
+        with open(path, 'rb') as segment:
+            for line in segment:
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(self._decode(line))
+                except ValueError:
+                    proc_logger.error('Skipped corrupt line in journal segment'
+                                      ':{path}'.format(path=path))
+                    continue
+                if len(batch) >= self.batch_size:
+                    if not self._write(batch):
+                        return None
+                    count += len(batch)
+                    batch = []
+        if batch:
+            if not self._write(batch):
+                return None
+            count += len(batch)
+        return count
+
+    def _write(self, batch):
+        """
+        Write a batch of journaled documents. If the writer raises an error
+        (e.g. for a document which can not be encoded), the documents are
+        written one by one and failing ones are quarantined, so the segment
+        is not retried from its start forever.
+        :param batch: List of journaled documents.
+        :return boolean: False if writing failed and should be retried.
+        """
+        try:
+            return self.writer(batch)
+        except Exception as e:
+            proc_logger.error('Unable to replay {count} journaled messages, '
+                              'replaying them one by one. Reason:{reason}'
+                              .format(count=len(batch), reason=e))
+        for document in batch:
+            try:
+                if not self.writer([document]):
+                    return False
+            except Exception as e:
+                self.quarantine([document], e)
+        return True
+
+    def quarantine(self, documents, reason):
+        """
+        Set aside journaled documents which can not be written (e.g. rejected
+        by the database), replay continues with the following documents. They
+        are appended to the quarantine file of the journal directory.
+        :param documents: List of message documents.
+        :param reason: Reason why documents can not be written.
+        :return:
+        """
+        now = time.time()
+        with self._lock:
+            with open(os.path.join(self.directory, QUARANTINE_NAME),
+                      'ab') as quarantine:
+                for document in documents:
+                    quarantine.write(json_util.dumps(
+                        {'t': now, 'reason': str(reason), 'd': document}) +
+                        '\n')
+            self._quarantined += len(documents)
+        proc_logger.error('Quarantined {count} journaled messages in {path}. '
+                          'Reason:{reason}'.format(
+                            count=len(documents), reason=reason,
+                            path=os.path.join(self.directory,
+                                              QUARANTINE_NAME)))
+
+    @staticmethod
+    def _decode(line):
+        """
+        :param line: Journal line.
+        :return: Journaled document, with naive (UTC) datetimes as documents
+        loaded by mongoengine.
+        """
+        document = json_util.loads(line)['d']
+        for key, value in document.items():
+            if isinstance(value, datetime) and value.tzinfo is not None:
+                document[key] = value.replace(tzinfo=None)
+        return document
+
+    def close(self):
+        """
+        Stop the background thread and fsync the active segment.
+        :return:
+        """
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join(self.fsync_interval + 5)
+        self._thread = None
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._close_segment()
+
+    def size(self):
+        """
+        :return: Size (in bytes) of all journal segments.
+        """
+        return self._size
+
+    def overloaded(self):
+        """
+        :return boolean: True if the journal is larger than max_size.
+        """
+        return self._size > self.max_size
+
+    def lag(self):
+        """
+        :return: Age (in seconds) of the oldest journaled document.
+        """
+        with self._lock:
+            path = self._segments[0] if self._segments else self._active
+            if path is None or not self._pending:
+                return 0.0
+            if path == self._active:
+                self._file.flush()
+        try:
+            with open(path, 'rb') as segment:
+                first = segment.readline()
+            return max(0.0, time.time() - json_util.loads(first)['t'])
+        except (IOError, ValueError):
+            return 0.0              # Segment replayed meanwhile.
+
+    def stats(self):
+        """
+        :return: Dictionary containing journal size, lag and replay metrics.
+        """
+        return {
+            'segments': len(self._segments) + (1 if self._file else 0),
+            'size_bytes': self._size,
+            'pending': self._pending,
+            'lag_seconds': round(self.lag(), 3),
+            'overloaded': self.overloaded(),
+            'appended': self._appended,
+            'replayed': self._replayed,
+            'replay_failures': self._replay_failures,
+            'quarantined': self._quarantined
+        }
@@ -0,0 +1,204 @@
+"""
+This module contains the tracker of confirmed Telegram update offsets. An
+update is confirmed once it is handled and the message it logged is durably
+written by the write buffer. The highest update ID below which all updates are
+confirmed is stored on MyBot, so a restarted bot resumes polling after it
+instead of fetching (and logging) the pending backlog again.
+"""
+
+import threading
+from mongoengine import Q
+from botapp.models import MyBot
+from . import proc_logger
+
+
+class UpdateOffsetTracker(object):
+    """
+    Tracks updates of every bot from the time they are received until they
+    are confirmed, and commits the confirmed offsets to the database.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Bot ID -> {update ID: [handled, awaited messages]}
+        self._pending = {}
+        # (bot_id, chatid, msg_id) -> list of (bot ID, update ID) awaiting it.
+        self._awaiting = {}
+        self._highest = {}          # Bot ID -> highest update ID received.
+        self._committed = {}        # Bot ID -> update ID stored in database.
+        # Metrics
+        self._redundant = 0
+        self._resumed = 0
+
+    def resume(self, bot_id, last_update_id):
+        """
+        Register the update ID stored for a bot which (re)starts receiving
+        updates. Updates up to it are skipped as redundant.
+        :param bot_id: ID of the bot.
+        :param last_update_id: Last confirmed update ID stored on MyBot.
+        :return: Offset from which polling resumes i.e. next update ID.
+        """
+        last_update_id = last_update_id or 0
+        with self._lock:
+            if last_update_id > self._committed.get(bot_id, 0):
+                self._committed[bot_id] = last_update_id
+            self._highest[bot_id] = max(self._highest.get(bot_id, 0),
+                                        self._committed.get(bot_id, 0))
+            if last_update_id:
+                self._resumed += 1
+            return self._committed.get(bot_id, 0) + 1
+
+    def received(self, bot_id, update_id):
+        """
+        Start tracking a received update.
+        :param bot_id: ID of the bot receiving the update.
+        :param update_id: Telegram update ID.
+        :return boolean: False if the update is already confirmed or being
+        handled i.e. it is redelivered and should be skipped.
+        """
+        with self._lock:
+            pending = self._pending.setdefault(bot_id, {})
+            if update_id <= self._committed.get(bot_id, 0) or \
+                    update_id in pending:
+                self._redundant += 1
+                return False
+            pending[update_id] = [False, 0]
+            self._highest[bot_id] = max(self._highest.get(bot_id, 0),
+                                        update_id)
+            return True
+
+    def expect(self, bot_id, update_id, key):
+        """
+        Register a message logged for an update. The update is not confirmed
+        before the message is settled by the write buffer.
+        :param bot_id: ID of the bot receiving the update.
+        :param update_id: Telegram update ID.
+        :param key: Natural key (bot_id, chatid, msg_id) of logged message.
+        :return:
+        """
+        with self._lock:
+            state = self._pending.get(bot_id, {}).get(update_id)
+            if state is None:
+                return              # Update is not tracked.
+            state[1] += 1
+            self._awaiting.setdefault(key, []).append((bot_id, update_id))
+
+    def handled(self, bot_id, update_id, failed=False):
+        """
+        Mark an update as handled. A failed update is not handled again, so
+        it is confirmed without waiting for its messages.
+        :param bot_id: ID of the bot receiving the update.
+        :param update_id: Telegram update ID.
+        :param failed: Whether the handler of the update failed.
+        :return:
+        """
+        with self._lock:
+            state = self._pending.get(bot_id, {}).get(update_id)
+            if state is None:
+                return
+            state[0] = True
+            if failed:
+                state[1] = 0
+            self._complete(bot_id, update_id)
+
+    def settled(self, documents):
+        """
+        Flush listener of the write buffer, confirms updates whose messages
+        were written (or found to be present already) and commits offsets.
+        :param documents: List of message documents settled by a flush.
+        :return:
+        """
+        with self._lock:
+            for document in documents:
+                key = (document.get('bot_id'), document.get('chatid'),
+                       document.get('msg_id'))
+                waiting = self._awaiting.get(key)
+                if not waiting:
+                    continue
+                bot_id, update_id = waiting.pop(0)
+                if not waiting:
+                    del self._awaiting[key]
+                state = self._pending.get(bot_id, {}).get(update_id)
+                if state is not None:
+                    state[1] -= 1
+                    self._complete(bot_id, update_id)
+        self.commit()
+
+    def _complete(self, bot_id, update_id):
+        state = self._pending[bot_id][update_id]
+        if state[0] and state[1] <= 0:
+            del self._pending[bot_id][update_id]
+
+    def confirmed(self, bot_id):
+        """
+        :param bot_id: ID of a bot.
+        :return: Highest update ID for which all updates of the bot up to it
+        are confirmed.
+        """
+        with self._lock:
+            return self._confirmed(bot_id)
+
+    def _confirmed(self, bot_id):
+        pending = self._pending.get(bot_id)
+        if pending:
+            return min(pending) - 1
+        return self._highest.get(bot_id, 0)
+
+    def commit(self, bot_id=None):
+        """
+        Store confirmed offsets which advanced since the last commit on MyBot.
+        Stored offsets never move backwards.
+        :param bot_id: ID of the bot to commit, all bots if None.
+        :return count: Number of bots whose offset was committed.
+        """
+        with self._lock:
+            bot_ids = [bot_id] if bot_id is not None else self._highest.keys()
+            offsets = [(key, self._confirmed(key)) for key in bot_ids]
+            offsets = [(key, offset) for key, offset in offsets
+                       if offset > self._committed.get(key, 0)]
+        count = 0
+        for key, offset in offsets:
+            try:
+                MyBot.objects(Q(bot_id=key) & (
+                    Q(last_update_id__lt=offset) |
+                    Q(last_update_id__exists=False))).update_one(
+                    set__last_update_id=offset)
+            except Exception as e:
+                proc_logger.error('Unable to store update offset:{offset} for'
+                                  ' bot:{bot_id}. Reason:{reason}'.format(
+                                        offset=offset, bot_id=key, reason=e))
+                continue
+            with self._lock:
+                self._committed[key] = max(self._committed.get(key, 0),
+                                           offset)
+            count += 1
+        return count
+
+    def forget(self, bot_id):
+        """
+        Stop tracking a bot after it stopped receiving updates, its offset is
+        loaded from the database when it is started again.
+        :param bot_id: ID of the bot.
+        :return:
+        """
+        with self._lock:
+            self._pending.pop(bot_id, None)
+            self._highest.pop(bot_id, None)
+            self._committed.pop(bot_id, None)
+            for key in [key for key in self._awaiting if key[0] == bot_id]:
+                del self._awaiting[key]
+
+    def stats(self):
+        """
+        :return: Dictionary containing confirmed offsets and skipped updates.
+        """
+        with self._lock:
+            return {
+                'redundant_updates_skipped': self._redundant,
+                'resumed_bots': self._resumed,
+                'bots': [{'bot_id': bot_id,
+                          'confirmed': self._confirmed(bot_id),
+                          'committed': self._committed.get(bot_id, 0),
+                          'pending': len(self._pending.get(bot_id, {}))}
+                         for bot_id in sorted(self._highest)]
+            }
@@ -0,0 +1,169 @@
+"""
+Module containing keyset (seek) pagination of messages. Messages are ordered
+newest first by (date, _id), a page continues after (or before) the last
+(or first) message of the previous page instead of skipping messages, so
+every page costs the same regardless of its depth. Positions are handed out
+as opaque cursor tokens.
+"""
+import base64
+import binascii
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(message):
+    """
+    :param message: Message object the cursor points at.
+    :return cursor: Opaque URL safe token of message's (date, id).
+    """
+    delta = message.date - EPOCH
+    millis = (delta.days * 86400 + delta.seconds) * 1000 + \
+        delta.microseconds // 1000
+    token = '{millis}.{id}'.format(millis=millis, id=message.id)
+    return base64.urlsafe_b64encode(token).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: Token returned by encode_cursor.
+    :return (date, id): Position of the message the cursor points at.
+    :except ValueError: If cursor is malformed.
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        token = base64.urlsafe_b64decode(str(cursor) + padding)
+        millis, object_id = token.split('.')
+        return (EPOCH + timedelta(milliseconds=int(millis)),
+                ObjectId(object_id))
+    except (TypeError, ValueError, InvalidId, binascii.Error,
+            UnicodeEncodeError):
+        raise ValueError('Invalid cursor, use a cursor returned with the '
+                         'previous page.')
+
+
+class Total(object):
+    """
+    Number of messages of a listing, which may be bounded (counting stopped
+    at a limit) or estimated (from collection metadata).
+    :param value: Number of messages, the limit if counting was stopped.
+    :param exact: False if more than value messages exist.
+    :param estimated: True if value is an estimate.
+    """
+
+    def __init__(self, value, exact=True, estimated=False):
+        self.value = value
+        self.exact = exact and not estimated
+        self.estimated = estimated
+
+    def __str__(self):
+        if self.estimated:
+            return '~{value:,}'.format(value=self.value)
+        return '{value:,}{more}'.format(value=self.value,
+                                        more='' if self.exact else '+')
+
+
+def bounded_total(msgs, limit):
+    """
+    Count messages, stopping at limit so large listings cost no more than
+    limit index entries.
+    :param msgs: Query Set of messages.
+    :param limit: Maximum number of counted messages.
+    :return: Total object, not exact if more than limit messages exist.
+    """
+    count = msgs.limit(limit + 1).count(with_limit_and_skip=True)
+    return Total(min(count, limit), exact=count <= limit)
+
+
+def estimated_total(document):
+    """
+    :param document: Document class e.g. Message.
+    :return: Total object of all documents estimated from collection
+    metadata, without scanning the collection.
+    """
+    return Total(document._get_collection().count(), estimated=True)
+
+
+class MessagePage(object):
+    """
+    Page of messages, newest first.
+    :param items: Messages of the page.
+    :param prev_cursor: Cursor of the first message if newer messages exist.
+    :param next_cursor: Cursor of the last message if older messages exist.
+    :param total: Total object of all messages of the listing, if counted.
+    """
+
+    def __init__(self, items, prev_cursor=None, next_cursor=None,
+                 total=None):
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.total = total
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def older_than(msgs, cursor=None):
+    """
+    :param msgs: Query Set of messages.
+    :param cursor: Cursor of a message, None for all messages.
+    :return messages: Query Set of messages older than cursor ordered by
+    (-date, -id).
+    :except ValueError: If cursor is malformed.
+    """
+    if cursor:
+        date, object_id = decode_cursor(cursor)
+        # (date, _id) < position, date bound narrows the index scan.
+        msgs = msgs.filter(__raw__={'date': {'$lte': date},
+                                    '$or': [{'date': {'$lt': date}},
+                                            {'_id': {'$lt': object_id}}]})
+    return msgs.order_by('-date', '-id')
+
+
+def seek(msgs, per_page, cursor=None, before=None, record=None):
+    """
+    Get a page of messages older than cursor, or newer than before.
+    :param msgs: Query Set of messages, its ordering is replaced by (-date,
+    -id).
+    :param per_page: Number of messages on the page.
+    :param cursor: Cursor of the message preceding the page, None for the
+    first (newest) page.
+    :param before: Cursor of the message following the page, used for going
+    back to newer messages.
+    :param record: Class of page items built from rows of a raw query set
+    e.g. MessageRecord, rows are used as items if None.
+    :return page: MessagePage object.
+    :except ValueError: If cursor or before is malformed.
+    """
+    if before:
+        date, object_id = decode_cursor(before)
+        # (date, _id) > position, date bound narrows the index scan.
+        msgs = msgs.filter(__raw__={'date': {'$gte': date},
+                                    '$or': [{'date': {'$gt': date}},
+                                            {'_id': {'$gt': object_id}}]})
+        items = _items(msgs.order_by('+date', '+id').limit(per_page + 1),
+                       record)
+        newer = len(items) > per_page
+        items = items[:per_page][::-1]
+        return MessagePage(
+            items, prev_cursor=encode_cursor(items[0]) if newer else None,
+            next_cursor=encode_cursor(items[-1]) if items else None)
+    items = _items(older_than(msgs, cursor).limit(per_page + 1), record)
+    older = len(items) > per_page
+    items = items[:per_page]
+    return MessagePage(
+        items, prev_cursor=encode_cursor(items[0]) if cursor and items
+        else None,
+        next_cursor=encode_cursor(items[-1]) if older else None)
+
+
+def _items(rows, record):
+    return [record(row) for row in rows] if record else list(rows)
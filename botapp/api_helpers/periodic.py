@@ -0,0 +1,77 @@
+"""
+Module containing the background thread of aggregates which write in-memory
+state to the database periodically, e.g. merging unique sender sketches,
+compacting message rollups and checkpointing top senders and chats.
+"""
+import threading
+from . import proc_logger
+
+
+class PeriodicWorker(object):
+    """
+    Daemon thread calling a function every interval seconds until it is
+    closed. Exceptions raised by the function are logged, so the thread keeps
+    running.
+    :param name: Name of the thread.
+    :param func: Function called without arguments.
+    :param interval: Function returning the time (in seconds) between calls,
+    called before every wait so configuration changes are applied.
+    """
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self._thread = None
+        self._stopped = None            # Event set when the thread is closed.
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """
+        Start the thread if it is not running already.
+        :return:
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            # Every thread gets its own event, a thread still finishing a call
+            # after close() stops although a new thread is started.
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run,
+                                            args=(self._stopped,),
+                                            name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self, timeout=5):
+        """
+        Stop the thread, waiting for a running call to return.
+        :param timeout: Maximum time (in seconds) to wait for the thread.
+        :return:
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopped.set()
+        if thread is not threading.current_thread():
+            thread.join(timeout)
+            if thread.is_alive():
+                proc_logger.warn('Thread:{name} did not stop within {timeout} '
+                                 'seconds.'.format(name=self.name,
+                                                   timeout=timeout))
+
+    def _run(self, stopped):
+        while not stopped.wait(self.interval()):
+            try:
+                self.func()
+            except Exception as e:
+                proc_logger.error('Unexpected error in thread:{name}. '
+                                  'Reason:{reason}'.format(name=self.name,
+                                                           reason=e))
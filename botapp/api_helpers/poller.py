@@ -0,0 +1,638 @@
+"""
+This module contains the multiplexed poller which issues long-poll getUpdates
+requests for all running bots from a single event loop thread, instead of an
+Updater (with its own polling, dispatcher and worker threads) per bot.
+Python 2 has no asyncio, therefore the loop is built on select.poll with
+non-blocking (TLS) sockets and a minimal HTTP/1.1 client. Keep-alive
+connections to the Bot API server are pooled and shared by all bots.
+"""
+
+import os
+import ssl
+import json
+import time
+import errno
+import socket
+import select
+import threading
+from Queue import Queue
+from urllib import urlencode
+from urlparse import urlparse
+from telegram import Update
+from . import proc_logger
+
+# Errors of non-blocking sockets meaning "try again later".
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+# Longest wait (in seconds) between failed getUpdates requests of a bot.
+MAX_BACKOFF = 30
+
+
+class _HttpResponse(object):
+    """
+    Incremental parser for a HTTP/1.1 response. Supports Content-Length,
+    chunked and read-until-close bodies.
+    """
+
+    def __init__(self):
+        self.status = None
+        self.headers = {}
+        self.body = None
+        self.keep_alive = True
+        self._buf = ''
+        self._length = None
+        self._chunked = False
+        self._chunks = []
+
+    def feed(self, data, eof=False):
+        """
+        :param data: Data received from the server.
+        :param eof: True if the server closed the connection.
+        :return boolean: True once the response is complete.
+        :except EOFError: If the connection closed before response completed.
+        """
+        self._buf += data
+        if self.status is None:
+            end = self._buf.find('\r\n\r\n')
+            if end < 0:
+                if eof:
+                    raise EOFError('Connection closed before response '
+                                   'headers.')
+                return False
+            head, self._buf = self._buf[:end], self._buf[end + 4:]
+            lines = head.split('\r\n')
+            self.status = int(lines[0].split()[1])
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                self.headers[name.strip().lower()] = value.strip()
+            self.keep_alive = \
+                self.headers.get('connection', '').lower() != 'close'
+            self._chunked = \
+                'chunked' in self.headers.get('transfer-encoding', '').lower()
+            if 'content-length' in self.headers:
+                self._length = int(self.headers['content-length'])
+        if self._chunked:
+            complete = self._feed_chunked()
+        elif self._length is not None:
+            complete = len(self._buf) >= self._length
+            if complete:
+                self.body = self._buf[:self._length]
+        else:
+            complete = eof         # Body ends when the connection closes.
+            if complete:
+                self.body = self._buf
+                self.keep_alive = False
+        if not complete and eof:
+            raise EOFError('Connection closed before response body.')
+        return complete
+
+    def _feed_chunked(self):
+        while True:
+            end = self._buf.find('\r\n')
+            if end < 0:
+                return False
+            size = int(self._buf[:end].split(';')[0], 16)
+            if len(self._buf) < end + 2 + size + 2:
+                return False
+            if size == 0:
+                self.body = ''.join(self._chunks)
+                return True
+            self._chunks.append(self._buf[end + 2:end + 2 + size])
+            self._buf = self._buf[end + 4 + size:]
+
+
+class _Connection(object):
+    """
+    Non-blocking (TLS) connection to the Bot API server.
+    """
+
+    def __init__(self, address, host, ssl_context=None):
+        self.host = host
+        self.ssl_context = ssl_context
+        self.sock = socket.socket(address[0], socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        error = self.sock.connect_ex(address[4])
+        if error and error not in _WOULD_BLOCK:
+            self.sock.close()
+            raise socket.error(error, os.strerror(error))
+        self.state = 'connecting'
+        self.want = 'write'         # Direction a blocked TLS operation needs.
+        self.outbuf = ''
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def interest(self):
+        """
+        :return (read, write): Events the connection is waiting for.
+        """
+        if self.state != 'ready':
+            return self.want == 'read', self.want == 'write'
+        return True, bool(self.outbuf)
+
+    def send(self, data):
+        self.outbuf += data
+
+    def progress(self):
+        """
+        Advance connection setup, write pending data and read all available
+        data without blocking.
+        :return data: Data received from the server.
+        :except socket.error: On connection failures.
+        """
+        if self.state == 'connecting':
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            if self.ssl_context is None:
+                self.state = 'ready'
+            else:
+                self.sock = self.ssl_context.wrap_socket(
+                    self.sock, server_hostname=self.host,
+                    do_handshake_on_connect=False)
+                self.state = 'handshake'
+        if self.state == 'handshake':
+            try:
+                self.sock.do_handshake()
+            except ssl.SSLWantReadError:
+                self.want = 'read'
+                return ''
+            except ssl.SSLWantWriteError:
+                self.want = 'write'
+                return ''
+            self.state = 'ready'
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+                self.outbuf = self.outbuf[sent:]
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                pass
+            except socket.error as e:
+                if e.errno not in _WOULD_BLOCK:
+                    raise
+        received = []
+        while not self.closed:
+            try:
+                chunk = self.sock.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except socket.error as e:
+                if e.errno in _WOULD_BLOCK:
+                    break
+                raise
+            if not chunk:
+                self.closed = True
+            received.append(chunk)
+        return ''.join(received)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class _ConnectionPool(object):
+    """
+    Pool of keep-alive connections to the Bot API server shared by all bots.
+    :param host: Bot API server host.
+    :param port: Bot API server port.
+    :param use_ssl: Whether connections use TLS.
+    :param max_idle: Maximum number of idle connections kept open.
+    """
+
+    def __init__(self, host, port, use_ssl=True, max_idle=16):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.ssl_context = ssl.create_default_context() if use_ssl else None
+        self.idle = []
+        self._address = None
+        self._resolver = None
+        self.opened = 0
+        self.reused = 0
+
+    def resolve(self):
+        """
+        Resolve the address of the Bot API server. Name resolution blocks,
+        so it is never done by the event loop.
+        :return boolean: False if the address could not be resolved.
+        """
+        try:
+            self._address = socket.getaddrinfo(self.host, self.port, 0,
+                                               socket.SOCK_STREAM)[0]
+            return True
+        except socket.error as e:
+            proc_logger.error('Unable to resolve Bot API server:{host}. '
+                              'Reason:{reason}'.format(host=self.host,
+                                                       reason=e))
+            return False
+
+    def resolve_later(self):
+        """
+        Resolve the address again on a separate thread, the current address
+        (if any) is used meanwhile.
+        :return:
+        """
+        if self._resolver is not None and self._resolver.is_alive():
+            return
+        self._resolver = threading.Thread(target=self.resolve,
+                                          name='poller-resolver')
+        self._resolver.daemon = True
+        self._resolver.start()
+
+    def acquire(self):
+        """
+        :return: Idle connection, or a new connection if there is none.
+        :except socket.error: If the address is not resolved or connecting
+        fails.
+        """
+        while self.idle:
+            conn = self.idle.pop()
+            if not conn.closed:
+                self.reused += 1
+                return conn
+        if self._address is None:
+            self.resolve_later()
+            raise socket.error('Address of {host} is not resolved.'.format(
+                host=self.host))
+        try:
+            conn = _Connection(self._address, self.host, self.ssl_context)
+        except socket.error:
+            self.resolve_later()        # Address may have changed.
+            raise
+        self.opened += 1
+        return conn
+
+    def release(self, conn):
+        if conn.closed or len(self.idle) >= self.max_idle:
+            conn.close()
+        else:
+            self.idle.append(conn)
+
+    def close(self):
+        for conn in self.idle:
+            conn.close()
+        self.idle = []
+
+
+class _PollChannel(object):
+    """
+    Long-poll state of a single bot.
+    :param bot: telegram.bot object.
+    :param offset: Update ID of the first update to be requested.
+    """
+
+    def __init__(self, bot, offset=0):
+        self.bot = bot
+        self.offset = offset
+        self.conn = None
+        self.response = None
+        self.deadline = None
+        self.retry_at = 0
+        self.backoff = 0
+
+    def fail(self, now, delay=None):
+        """
+        Schedule the next request after a failed request.
+        """
+        if delay is None:
+            self.backoff = min(MAX_BACKOFF, self.backoff * 1.5 or 1)
+            delay = self.backoff
+        self.retry_at = now + delay
+
+
+class MultiplexedPoller(object):
+    """
+    Event loop issuing concurrent long-poll getUpdates requests for all bots
+    in its active set from a single thread. Received updates are handed to
+    the dispatch callable (e.g. procedures.submit_update) on a separate
+    thread, so slow handlers do not stall polling.
+    :param api_url: Base URL of the Bot API, the token is appended to it.
+    :param timeout: Long-poll timeout (in seconds) of getUpdates requests.
+    :param network_delay: Extra time to wait for a getUpdates response.
+    :param max_idle_connections: Idle keep-alive connections kept open.
+    """
+
+    def __init__(self, api_url='https://api.telegram.org/bot', timeout=10,
+                 network_delay=5.0, max_idle_connections=16):
+        self.dispatch = None
+        # Callable returning True while polling should be paused.
+        self.paused = None
+        self.timeout = timeout
+        self.network_delay = network_delay
+        self._max_idle = max_idle_connections
+        self._configure(api_url)
+        self._channels = {}             # bot_id -> _PollChannel
+        self._retired = []              # Removed channels to be closed.
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._wakeup_r = self._wakeup_w = None
+        self._updates = Queue()
+        self._dispatcher = None
+        # Metrics
+        self._requests = 0
+        self._errors = 0
+        self._received = 0
+
+    def _configure(self, api_url):
+        url = urlparse(api_url)
+        use_ssl = url.scheme == 'https'
+        self._path = url.path
+        self._pool = _ConnectionPool(url.hostname,
+                                     url.port or (443 if use_ssl else 80),
+                                     use_ssl, self._max_idle)
+
+    def init_app(self, app):
+        """
+        Configure the poller from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.timeout = app.config.get('POLLER_TIMEOUT', self.timeout)
+        self._max_idle = app.config.get('POLLER_MAX_IDLE_CONNECTIONS',
+                                        self._max_idle)
+        if not self._running:
+            self._configure(app.config.get('TELEGRAM_API_URL',
+                                           'https://api.telegram.org/bot'))
+
+    def add(self, bot, offset=0):
+        """
+        Add a bot to the active set, its updates are polled from now on.
+        :param bot: telegram.bot object.
+        :param offset: Update ID of the first update to be requested.
+        :return:
+        """
+        with self._lock:
+            if bot.id not in self._channels:
+                self._channels[bot.id] = _PollChannel(bot, offset)
+        self.start()
+        self._wakeup()
+
+    def remove(self, bot_id):
+        """
+        Remove a bot from the active set.
+        :param bot_id: ID of the bot.
+        :return boolean: False if the bot was not being polled.
+        """
+        with self._lock:
+            channel = self._channels.pop(bot_id, None)
+            if channel is None:
+                return False
+            self._retired.append(channel)   # Loop closes its connection.
+        self._wakeup()
+        return True
+
+    def is_polling(self, bot_id):
+        return bot_id in self._channels
+
+    def bot_ids(self):
+        return list(self._channels.keys())
+
+    def start(self):
+        """
+        Start event loop and dispatching threads if they are not running.
+        :return:
+        """
+        if self._running:
+            return
+        # Resolved here, the event loop must not block on it.
+        self._pool.resolve()
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._wakeup_r, self._wakeup_w = os.pipe()
+            self._thread = threading.Thread(target=self._run,
+                                            args=(self._wakeup_r,
+                                                  self._wakeup_w),
+                                            name='multiplexed-poller')
+            self._thread.daemon = True
+            self._thread.start()
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch_updates, name='poller-dispatcher')
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+
+    def stop(self, timeout=5):
+        """
+        Stop the event loop. Bots stay in the active set and are polled again
+        once the poller is started. The wakeup pipe is closed by the event
+        loop thread when it exits.
+        :param timeout: Maximum time (in seconds) to wait for the event loop.
+        :return:
+        """
+        with self._lock:
+            if not self._running:
+                return
+            self._signal()
+            self._running = False
+            self._wakeup_r = self._wakeup_w = None
+            thread = self._thread
+        if thread is not threading.current_thread():
+            thread.join(timeout)
+            if thread.is_alive():
+                proc_logger.error('Multiplexed poller did not stop within '
+                                  '{timeout} seconds.'.format(timeout=timeout))
+
+    def _wakeup(self):
+        with self._lock:
+            self._signal()
+
+    def _signal(self):
+        # Called with the lock held, so the pipe is not closed meanwhile.
+        if self._running and self._wakeup_w is not None:
+            try:
+                os.write(self._wakeup_w, 'x')
+            except OSError:
+                pass
+
+    def _run(self, wakeup_r, wakeup_w):
+        proc_logger.info('Multiplexed poller started.')
+        # A loop outlived by stop() exits once another loop is started.
+        while self._running and self._thread is threading.current_thread():
+            try:
+                self._iterate(wakeup_r)
+            except Exception as e:
+                proc_logger.error('Unexpected error in multiplexed poller. '
+                                  'Reason:{reason}'.format(reason=e))
+                time.sleep(1)
+        if self._thread is threading.current_thread():
+            for channel in self._channels.values():
+                self._close(channel)
+            self._pool.close()
+        with self._lock:
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+        proc_logger.info('Multiplexed poller stopped.')
+
+    def _iterate(self, wakeup_r):
+        now = time.time()
+        with self._lock:
+            channels = list(self._channels.values())
+            retired, self._retired = self._retired, []
+        for channel in retired:
+            self._close(channel)
+        # Send requests for bots waiting for their next poll.
+        paused = self.paused is not None and self.paused()
+        for channel in channels:
+            if not paused and channel.conn is None and channel.retry_at <= now:
+                self._request(channel, now)
+        # Collect socket interests.
+        targets = {wakeup_r: None}
+        interests = {wakeup_r: (True, False)}
+        next_event = now + 1
+        for channel in channels:
+            if channel.conn is not None:
+                targets[channel.conn.fileno()] = channel
+                interests[channel.conn.fileno()] = channel.conn.interest()
+                next_event = min(next_event, channel.deadline)
+            else:
+                next_event = min(next_event, channel.retry_at)
+        for conn in self._pool.idle:
+            targets[conn.fileno()] = conn
+            interests[conn.fileno()] = (True, False)
+        for fd in _wait(interests, max(0, next_event - now)):
+            target = targets[fd]
+            if target is None:
+                os.read(wakeup_r, 4096)
+            elif isinstance(target, _Connection):
+                target.close()          # Idle connection closed by server.
+            else:
+                self._progress(target)
+        # Expire requests without response.
+        now = time.time()
+        for channel in channels:
+            if channel.conn is not None and channel.deadline <= now:
+                self._errors += 1
+                proc_logger.warn('getUpdates for bot:{uname} timed out.'
+                                 .format(uname=channel.bot.username))
+                self._close(channel)
+                channel.fail(now)
+        self._pool.idle = [conn for conn in self._pool.idle if not conn.closed]
+
+    def _request(self, channel, now):
+        query = urlencode({'offset': channel.offset, 'timeout': self.timeout})
+        request = ('GET {path}{token}/getUpdates?{query} HTTP/1.1\r\n'
+                   'Host: {host}:{port}\r\n'
+                   'Connection: keep-alive\r\n'
+                   'Accept: application/json\r\n\r\n').format(
+                        path=self._path, token=channel.bot.token, query=query,
+                        host=self._pool.host, port=self._pool.port)
+        try:
+            channel.conn = self._pool.acquire()
+        except socket.error as e:
+            self._errors += 1
+            proc_logger.error('Unable to connect to Bot API for bot:{uname}. '
+                              'Reason:{reason}'.format(
+                                    uname=channel.bot.username, reason=e))
+            channel.fail(now)
+            return
+        channel.conn.send(request)
+        channel.response = _HttpResponse()
+        channel.deadline = now + self.timeout + self.network_delay
+        self._requests += 1
+
+    def _progress(self, channel):
+        try:
+            data = channel.conn.progress()
+            if not channel.response.feed(data, eof=channel.conn.closed):
+                return
+        except (socket.error, EOFError, ValueError) as e:
+            self._errors += 1
+            proc_logger.warn('getUpdates for bot:{uname} failed. Reason:'
+                             '{reason}'.format(uname=channel.bot.username,
+                                               reason=e))
+            self._close(channel)
+            channel.fail(time.time())
+            return
+        response = channel.response
+        if response.keep_alive:
+            self._pool.release(channel.conn)
+        else:
+            channel.conn.close()
+        channel.conn = channel.response = None
+        self._handle_response(channel, response)
+
+    def _handle_response(self, channel, response):
+        now = time.time()
+        try:
+            data = json.loads(response.body)
+        except ValueError:
+            data = {}
+        if response.status != 200 or not data.get('ok'):
+            self._errors += 1
+            retry_after = data.get('parameters', {}).get('retry_after')
+            proc_logger.error('getUpdates for bot:{uname} failed with HTTP '
+                              'status:{status}. Reason:{reason}'.format(
+                                    uname=channel.bot.username,
+                                    status=response.status,
+                                    reason=data.get('description')))
+            channel.fail(now, retry_after)
+            return
+        channel.backoff = 0
+        channel.retry_at = now
+        for item in data.get('result', []):
+            channel.offset = item['update_id'] + 1
+            self._updates.put((channel.bot, Update.de_json(item, channel.bot)))
+            self._received += 1
+
+    def _close(self, channel):
+        if channel.conn is not None:
+            channel.conn.close()
+        channel.conn = channel.response = None
+
+    def _dispatch_updates(self):
+        while True:
+            bot, update = self._updates.get()
+            try:
+                self.dispatch(bot, update)
+            except Exception as e:
+                proc_logger.error('Unable to handle update:{uid} for bot:'
+                                  '{uname}. Reason:{reason}'.format(
+                                        uid=update.update_id,
+                                        uname=bot.username, reason=e))
+
+    def stats(self):
+        """
+        :return: Dictionary containing poller metrics.
+        """
+        return {
+            'running': self._running,
+            'paused': bool(self.paused is not None and self.paused()),
+            'bots': len(self._channels),
+            'requests': self._requests,
+            'errors': self._errors,
+            'updates_received': self._received,
+            'updates_pending': self._updates.qsize(),
+            'connections_opened': self._pool.opened,
+            'connections_reused': self._pool.reused,
+            'connections_idle': len(self._pool.idle)
+        }
+
+
+def _wait(interests, timeout):
+    """
+    Wait until file descriptors are ready for the requested events.
+    :param interests: Dictionary mapping file descriptors to (read, write).
+    :param timeout: Maximum time to wait (in seconds).
+    :return: List of file descriptors which are ready.
+    """
+    try:
+        if hasattr(select, 'poll'):
+            poll = select.poll()
+            for fd, (read, write) in interests.items():
+                poll.register(fd, (select.POLLIN if read else 0) |
+                              (select.POLLOUT if write else 0))
+            return [fd for fd, _ in poll.poll(timeout * 1000)]
+        readers = [fd for fd, (read, _) in interests.items() if read]
+        writers = [fd for fd, (_, write) in interests.items() if write]
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        return list(set(readable + writable))
+    except (select.error, IOError) as e:
+        if e.args[0] == errno.EINTR:
+            return []
+        raise
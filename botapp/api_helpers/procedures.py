@@ -5,13 +5,18 @@ functions.
 
 import time
 from datetime import datetime, timedelta
+from bson.regex import Regex
 from mongoengine import Q
-from botapp.models import MyBot, Message
+from botapp.models import MyBot, Message, name_tokens
 from mongoengine import NotUniqueError
+from telegram import User, Update
 from telegram.bot import Bot
-from telegram.error import InvalidToken
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-from . import running_bots, proc_logger
+from telegram.error import InvalidToken, TelegramError
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, \
+    TypeHandler
+from helper.helper_functions import generate_url_token
+from . import running_bots, webhook_bots, ingestion_settings, proc_logger, \
+    message_buffer, update_poller, handler_pool, offset_tracker, bot_registry
 
 
 def start(bot, update):
@@ -55,24 +60,143 @@ def log_message(bot, update):
     """
     message = update.message
     sender = message.from_user
+    # Update is confirmed once the message is written.
+    offset_tracker.expect(bot.id, update.update_id,
+                          (bot.id, message.chat_id, message.message_id))
     try:
-        Message(msg_id=message.message_id,
-                date=message.date,
-                sender_username=sender.username,
-                sender_firstname=sender.first_name,
-                sender_lastname=sender.last_name,
-                chatid=message.chat_id,
-                text_content=message.text,
-                bot_id=bot.id).save()
-        proc_logger.info('New message:{msg_id} logged for chat:{chatid} by bot:'
+        # Queue the message, write buffer saves it with the next bulk write.
+        message_buffer.put(Message(msg_id=message.message_id,
+                                   date=message.date,
+                                   sender_username=sender.username,
+                                   sender_firstname=sender.first_name,
+                                   sender_lastname=sender.last_name,
+                                   chatid=message.chat_id,
+                                   text_content=message.text,
+                                   bot_id=bot.id))
+        proc_logger.info('New message:{msg_id} queued for chat:{chatid} by bot:'
                          '{bot_uname}'.format(msg_id=message.message_id,
-                                              chatid=update.message.chatid,
+                                              chatid=message.chat_id,
                                               bot_uname=bot.username))
     except Exception as e:
         raise ValueError('Unable to log message. Reason{reason}'.format(
             reason=e.message))
 
 
+# Handlers for incoming updates, in order of precedence.
+update_handlers = [CommandHandler('start', start),
+                   MessageHandler([Filters.text], log_message)]
+
+
+def add_handlers(dispatcher):
+    """
+    Add handler to the dispatcher of a bot's updater, which hands all updates
+    over to the shared handler pool.
+    :param dispatcher: telegram.ext.Dispatcher object.
+    :return:
+    """
+    dispatcher.add_handler(TypeHandler(Update, submit_update))
+
+
+def submit_update(bot, update):
+    """
+    This function queues an update to the handler pool shared by all bots.
+    Updates are partitioned by bot and chat, so updates of a chat are handled
+    in order of arrival while different chats are handled in parallel.
+    Redelivered updates which are already confirmed are skipped. While the
+    spill journal is overloaded, the caller (e.g. a bot's updater) is blocked.
+    :param bot: telegram.bot object receiving the update.
+    :param update: telegram.Update object.
+    :return:
+    """
+    while message_buffer.overloaded():
+        time.sleep(1)               # Wait for the journal to be replayed.
+    if not offset_tracker.received(bot.id, update.update_id):
+        proc_logger.info('Skipped redundant update:{uid} for bot:{bot_id}'
+                         .format(uid=update.update_id, bot_id=bot.id))
+        return
+    message = update.message or update.edited_message
+    chat_id = message.chat_id if message is not None else None
+    handler_pool.submit((bot.id, chat_id), handle_update, bot, update)
+
+
+def handle_update(bot, update):
+    """
+    This function runs in the handler pool, it dispatches an update and marks
+    it as handled for the offset tracker.
+    :param bot: telegram.bot object receiving the update.
+    :param update: telegram.Update object.
+    :return:
+    """
+    try:
+        dispatch_update(bot, update)
+    except Exception:
+        offset_tracker.handled(bot.id, update.update_id, failed=True)
+        raise
+    offset_tracker.handled(bot.id, update.update_id)
+
+
+def dispatch_update(bot, update):
+    """
+    This function feeds an update to the first matching handler, same as a
+    dispatcher would.
+    :param bot: telegram.bot object receiving the update.
+    :param update: telegram.Update object.
+    :return boolean: True if the update was handled.
+    """
+    for handler in update_handlers:
+        if handler.check_update(update):
+            handler.callback(bot, update)
+            return True
+    return False
+
+
+# Updates polled by the multiplexed poller are fed to the same handlers.
+update_poller.dispatch = submit_update
+
+
+def get_telegram_bot(bot):
+    """
+    This function returns telegram.bot object for a bot registered in the
+    database. Bot's identity is filled from the database so that no getMe
+    request is made for it.
+    :param bot: MyBot object.
+    :return tg_bot: telegram.bot object.
+    :except InvalidToken: If the bot is registered with a malformed token.
+    """
+    tg_bot = Bot(token=bot.token, base_url=ingestion_settings['api_url'])
+    tg_bot.bot = User(id=bot.bot_id, first_name=bot.first_name or '',
+                      last_name=bot.last_name or '',
+                      username=bot.username or '')
+    return tg_bot
+
+
+def get_webhook_bot(secret):
+    """
+    This function finds the polling bot for which Telegram delivered an update
+    on given webhook secret.
+    :param secret: Webhook secret of the bot (part of webhook URL).
+    :return tg_bot: telegram.bot object or None if no bot is registered with
+    the secret.
+    """
+    tg_bot = webhook_bots.get(secret)
+    if tg_bot is None:
+        # Webhook may be registered by another worker process.
+        bot = MyBot.objects(webhook_secret=secret, state=True).first()
+        if bot is not None:
+            offset_tracker.resume(bot.bot_id, bot.last_update_id)
+            tg_bot = webhook_bots[secret] = get_telegram_bot(bot)
+    return tg_bot
+
+
+def webhook_url(secret):
+    """
+    :param secret: Webhook secret of a bot.
+    :return: URL on which Telegram delivers updates for the bot.
+    """
+    return '{base}/webhook/{secret}'.format(
+        base=ingestion_settings['webhook_url'].rstrip('/'), secret=secret)
+
+
 def add_bot(token=None, testing=False):
     """
     This function takes token for adding a new bot in the database. If
@@ -105,7 +229,8 @@ def add_bot(token=None, testing=False):
             return bot.username, False
 
         # Get bot information from telegram API for live bot.
-        tg_bot = Bot(token=token).getMe()
+        tg_bot = Bot(token=token,
+                     base_url=ingestion_settings['api_url']).getMe()
         bot = MyBot(bot_id=tg_bot.id, first_name=tg_bot.first_name,
                     last_name=tg_bot.last_name, username=tg_bot.username,
                     test_bot=False, token=token).save()
@@ -138,7 +263,8 @@ def start_bot(botid=None, username=None):
     This function starts polling for a newly added bot. It gets an updater
     object for a valid (i.e. not test) bot and associated dispatcher. It adds
     handlers for responding to /start command and text messages to the
-    dispatcher.
+    dispatcher. In webhook ingestion mode, a webhook is registered for the bot
+    instead and in multiplexed mode, the bot is added to the shared poller.
     :param botid:  ID of the bot for which start polling request is made.
     :param username: Username of the bot for which start polling request is
     made.
@@ -157,9 +283,8 @@ def start_bot(botid=None, username=None):
     elif username is not None and type(username) is not str:
         raise ValueError('String value expected for username in start bot '
                          'request.')
-    # Find the requested Bot in database.
-    bot = MyBot.objects(bot_id=botid or 0).first() or \
-        MyBot.objects(username__iexact=username or '').first()
+    # Find the requested Bot in the bot registry.
+    bot = bot_registry.find(botid=botid, username=username)
     if bot is None:         # Requested bot not found in DB.
         proc_logger.error('No bot found with ID:{id} or Username:{uname} for '
                           'starting the polling.'.format(id=botid,
@@ -170,8 +295,15 @@ def start_bot(botid=None, username=None):
                           'or username:{uname}'.format(id=botid,
                                                        uname=username))
         return -2
+    if ingestion_settings['mode'] == 'webhook':
+        return start_webhook(bot)
+    if ingestion_settings['mode'] == 'multiplexed':
+        return start_multiplexed(bot)
     if bot.bot_id in running_bots.keys():   # Bot found and previously ran once.
         updater = running_bots.get(bot.bot_id)  # Retrieve updater from dict.
+        # Resume after the last confirmed update.
+        updater.last_update_id = offset_tracker.resume(bot.bot_id,
+                                                       bot.last_update_id)
         updater.start_polling()
         bot.state = True
         bot.save()
@@ -180,15 +312,12 @@ def start_bot(botid=None, username=None):
                                         id=botid, uname=username))
         return 1                            # Started running requested bot.
     try:
-        updater = Updater(token=bot.token)  # Get bot Updater
-        dispatcher = updater.dispatcher
-
-        start_handler = CommandHandler('start', start)  # Add Handlers.
-        dispatcher.add_handler(start_handler)
-
-        log_handler = MessageHandler([Filters.text], log_message)
-        dispatcher.add_handler(log_handler)
-
+        # Handlers run in the shared pool, no dispatcher threads are needed.
+        updater = Updater(token=bot.token, workers=0,
+                          base_url=ingestion_settings['api_url'])
+        add_handlers(updater.dispatcher)        # Add Handlers.
+        updater.last_update_id = offset_tracker.resume(bot.bot_id,
+                                                       bot.last_update_id)
         updater.start_polling()                 # Start polling.
         running_bots[bot.bot_id] = updater      # Add to dictionary.
         bot.state = True                        # Update bot state.
@@ -207,7 +336,9 @@ def start_bot(botid=None, username=None):
 
 def stop_bot(botid=None, username=None):
     """
-    This function stops a bot from polling for new message updates.
+    This function stops a bot from polling for new message updates. In
+    webhook ingestion mode, the webhook of the bot is removed instead and in
+    multiplexed mode, the bot is removed from the shared poller.
     :param botid:  ID of the bot for which start polling request is made.
     :param username: Username of the bot for which start polling request is
     made.
@@ -224,18 +355,22 @@ def stop_bot(botid=None, username=None):
     elif username is not None and type(username) is not str:
         raise ValueError('String value expected for username in stop bot '
                          'request.')
-    bot = MyBot.objects(bot_id=botid or 0).first() or \
-        MyBot.objects(username__iexact=username or '').first()
+    bot = bot_registry.find(botid=botid, username=username)
     if bot is None:
         proc_logger.error('No bot found with ID:{id} or Username:{uname} for '
                           'starting the polling.'.format(id=botid,
                                                          uname=username))
         return -1
+    if bot.state and ingestion_settings['mode'] == 'webhook':
+        return stop_webhook(bot)
+    if bot.state and ingestion_settings['mode'] == 'multiplexed':
+        return stop_multiplexed(bot)
     if bot.state:
         try:
             if bot.bot_id in running_bots.keys():
                 updater = running_bots.get(bot.bot_id)     # Find bot from dict.
                 updater.stop()             # Stop bot
+                release_bot(bot)           # Store confirmed offset.
                 bot.state = False          # Update bot state to STOP.
                 bot.save()
                 proc_logger.info(
@@ -243,14 +378,9 @@ def stop_bot(botid=None, username=None):
                     'or username:{uname}'.format(id=botid, uname=username))
                 return 1                   # Bot stopped successfully.
             else:
-                updater = Updater(token=bot.token)  # Get bot Updater
-                dispatcher = updater.dispatcher
-
-                start_handler = CommandHandler('start', start)  # Add Handlers.
-                dispatcher.add_handler(start_handler)
-
-                log_handler = MessageHandler([Filters.text], log_message)
-                dispatcher.add_handler(log_handler)
+                updater = Updater(token=bot.token, workers=0,
+                                  base_url=ingestion_settings['api_url'])
+                add_handlers(updater.dispatcher)    # Add Handlers.
 
                 updater.stop()  # Start polling.
                 running_bots[bot.bot_id] = updater  # Add to dictionary.
@@ -272,6 +402,131 @@ def stop_bot(botid=None, username=None):
     return -2                           # Bot not polling already.
 
 
+def start_webhook(bot):
+    """
+    This function registers a webhook for a live bot, so Telegram delivers
+    its updates to the webhook blueprint instead of the bot being polled.
+    :param bot: MyBot object.
+    :return integer: 1 = Successfully registered webhook for the bot.
+     0 = Unable to register webhook for the bot.
+    :except ValueError: If bot is registered with a bad token.
+    """
+    if not ingestion_settings['webhook_url']:
+        proc_logger.error('WEBHOOK_URL is not configured, unable to register '
+                          'webhook for bot:{uname}.'.format(
+                                uname=bot.username))
+        return 0
+    if not bot.webhook_secret:
+        bot.webhook_secret = generate_url_token()
+    try:
+        tg_bot = get_telegram_bot(bot)
+        certificate = ingestion_settings['webhook_certificate']
+        if certificate:
+            with open(certificate, 'rb') as cert:
+                tg_bot.setWebhook(webhook_url=webhook_url(bot.webhook_secret),
+                                  certificate=cert)
+        else:
+            tg_bot.setWebhook(webhook_url=webhook_url(bot.webhook_secret))
+    except InvalidToken:
+        proc_logger.error('Unable to register webhook for bot:{uname} '
+                          'registered with bad token.'.format(
+                                uname=bot.username))
+        raise ValueError('Bot:{uname} registered with bad token can not be '
+                         'started.'.format(uname=bot.username))
+    except (TelegramError, IOError) as e:
+        proc_logger.error('Unable to register webhook for bot:{uname}. '
+                          'Reason:{reason}'.format(uname=bot.username,
+                                                   reason=e))
+        return 0
+    webhook_bots[bot.webhook_secret] = tg_bot
+    offset_tracker.resume(bot.bot_id, bot.last_update_id)
+    bot.state = True
+    bot.save()
+    proc_logger.info('Successfully registered webhook for live bot:'
+                     '{uname}'.format(uname=bot.username))
+    return 1
+
+
+def stop_webhook(bot):
+    """
+    This function removes the webhook of a bot receiving updates via webhook.
+    :param bot: MyBot object.
+    :return integer: 1 = Successfully removed webhook of the bot.
+     0 = Unable to remove webhook of the bot.
+    """
+    try:
+        get_telegram_bot(bot).setWebhook(webhook_url='')
+    except (InvalidToken, TelegramError) as e:
+        proc_logger.critical('Unable to remove webhook for bot:{uname}. '
+                             'Reason:{reason}'.format(uname=bot.username,
+                                                      reason=e))
+        return 0
+    webhook_bots.pop(bot.webhook_secret, None)
+    release_bot(bot)
+    bot.state = False
+    bot.save()
+    proc_logger.info('Successfully removed webhook for live bot:'
+                     '{uname}'.format(uname=bot.username))
+    return 1
+
+
+def start_multiplexed(bot):
+    """
+    This function adds a live bot to the active set of the multiplexed poller.
+    :param bot: MyBot object.
+    :return integer: 1 = Bot added to the poller.
+    :except ValueError: If bot is registered with a bad token.
+    """
+    try:
+        update_poller.add(get_telegram_bot(bot), offset=offset_tracker.resume(
+            bot.bot_id, bot.last_update_id))
+    except InvalidToken:
+        proc_logger.error('Unable to start polling for bot:{uname} registered '
+                          'with bad token.'.format(uname=bot.username))
+        raise ValueError('Bot:{uname} registered with bad token can not be '
+                         'started.'.format(uname=bot.username))
+    bot.state = True
+    bot.save()
+    proc_logger.info('Successfully added live bot:{uname} to multiplexed '
+                     'poller.'.format(uname=bot.username))
+    return 1
+
+
+def stop_multiplexed(bot):
+    """
+    This function removes a bot from the active set of the multiplexed poller.
+    :param bot: MyBot object.
+    :return integer: 1 = Bot removed from the poller.
+    """
+    update_poller.remove(bot.bot_id)
+    release_bot(bot)
+    bot.state = False
+    bot.save()
+    proc_logger.info('Successfully removed live bot:{uname} from multiplexed '
+                     'poller.'.format(uname=bot.username))
+    return 1
+
+
+def release_bot(bot, timeout=10):
+    """
+    This function waits until updates received by a stopped bot are handled
+    and logged, stores the confirmed update offset of the bot and stops
+    tracking its updates. Updates of other bots are not waited for.
+    :param bot: MyBot object.
+    :param timeout: Maximum time (in seconds) to wait for updates of the bot
+    to be handled, the offset of updates handled later is not stored.
+    :return:
+    """
+    if not handler_pool.wait(lambda key: key[0] == bot.bot_id,
+                             timeout=timeout):
+        proc_logger.warn('Updates of bot:{uname} are still being handled '
+                         '{timeout} seconds after it was stopped.'.format(
+                                uname=bot.username, timeout=timeout))
+    message_buffer.flush()
+    offset_tracker.commit(bot.bot_id)
+    offset_tracker.forget(bot.bot_id)
+
+
 def start_all():
     """
     This function starts all bots in the database.
@@ -279,7 +534,7 @@ def start_all():
     polling.
     """
     # Get all non-test (i.e. live) bots.
-    bots = MyBot.objects(test_bot=False).all()
+    bots = [bot for bot in bot_registry.bots() if not bot.test_bot]
     started_bots = []
     # Start all non test bots registered in the database.
     for bot in bots:
@@ -294,36 +549,102 @@ def start_all():
     return started_bots
 
 
-def stop_all():
+def stop_all(timeout=10):
     """
     This function stops all bots for polling which have ever started polling.
+    :param timeout: Maximum time (in seconds) to wait for updates received by
+    the stopped bots to be handled, handler workers still busy are logged.
     :return stopped_bots: List of bot IDs for Bots which successfully stopped
     polling.
     """
     stopped_bots = []
+    if ingestion_settings['mode'] == 'webhook':
+        # Webhooks may have been registered by other worker processes.
+        bot_ids = [bot.bot_id for bot in bot_registry.bots() if bot.state]
+    elif ingestion_settings['mode'] == 'multiplexed':
+        bot_ids = update_poller.bot_ids()
+    else:
+        bot_ids = running_bots.keys()
     # Stop all bots which have ever been started.
-    for key in running_bots.keys():
+    for key in bot_ids:
         try:
             stopped_bots.append(key) if stop_bot(botid=key) > 0 else 0
         except (KeyError, Exception):
             pass            # Do nothing
+    # Handle updates received by the stopped bots.
+    handler_pool.join(timeout=timeout)
+    message_buffer.flush()  # Persist messages logged by the stopped bots.
+    offset_tracker.commit()
     proc_logger.info('Successfully stopped polling for {count} previously '
                      'running bots'.format(count=len(stopped_bots)))
     return stopped_bots
 
 
+# Matching modes for the text criterion of filter_messages.
+TEXT_MODES = ('text', 'substring')
+# Matching modes for the name criterion of filter_messages.
+NAME_MODES = ('prefix', 'token', 'substring')
+
+
+def _check_mode(mode, modes, criterion):
+    if mode not in modes:
+        raise ValueError('Unknown {criterion} matching mode:{mode}, expected '
+                         'one of {modes}.'.format(criterion=criterion,
+                                                  mode=mode,
+                                                  modes=', '.join(modes)))
+
+
+def _filter_name(msgs, name, name_mode):
+    """
+    Filter messages by sender's firstname or lastname.
+    :param msgs: Query Set of messages.
+    :param name: Sender's name, may contain several words.
+    :param name_mode: 'prefix' or 'token' match every word of name against
+    the indexed sender name tokens, 'substring' matches name partially against
+    firstname or lastname (slow, no index is used).
+    :return messages: Filtered Query Set.
+    """
+    if name_mode == 'substring':
+        return msgs.filter(Q(sender_lastname__icontains=name) |
+                           Q(sender_firstname__icontains=name))
+    tokens = name_tokens(name)
+    if not tokens:                  # Only separators, no name can match.
+        return msgs.none()
+    if name_mode == 'prefix':
+        # Tokens consist of word characters only, so anchored regexes need no
+        # escaping and their prefix is used as index bounds. Regex (unlike
+        # compiled patterns) can be copied when query sets are combined.
+        tokens = [Regex('^' + token) for token in tokens]
+    return msgs.filter(__raw__={'sender_name_tokens': {'$all': tokens}})
+
+
 def filter_messages(time_min=0, botid=None, text='#', username=None,
-                    name='#'):
+                    name='#', text_mode='text', rank=False,
+                    name_mode='prefix'):
     """
     This function filters the messages logged by Bots based on the 5 given
     fields.
     :param time_min: Time (in minutes) for filtering messages by date.
     :param botid: ID of bot from which message was received.
-    :param text: Message text (partially matched.)
+    :param text: Message text. In 'text' mode, messages containing any of
+    the words (or a "quoted phrase") are matched using the text index. In
+    'substring' mode, text is partially matched (slow, no index is used).
     :param username: Senders username (exactly matched.)
-    :param name: Sender's firstname or lastname (partially matched.)
+    :param name: Sender's firstname or lastname. In 'prefix' mode, every
+    word of name has to start a word of sender's firstname or lastname, in
+    'token' mode it has to be a whole word of them (both use the name token
+    index.) In 'substring' mode, name is partially matched (slow, no index is
+    used).
+    :param text_mode: Matching mode for text, 'text' or 'substring'.
+    :param rank: Order messages by relevance to text instead of date ('text'
+    mode only).
+    :param name_mode: Matching mode for name, 'prefix', 'token' or
+    'substring'.
     :return messages: Query Set containing filtered messages.
+    :except ValueError: If text_mode or name_mode is unknown.
     """
+    _check_mode(text_mode, TEXT_MODES, 'text')
+    _check_mode(name_mode, NAME_MODES, 'name')
     time_min = time_min if time_min > 0 else int(time.time())/60
     if botid:
         msgs = Message.objects(bot_id=int(botid),
@@ -334,16 +655,20 @@ def filter_messages(time_min=0, botid=None, text='#', username=None,
             minutes=time_min)).order_by('-date')
     if msgs is None:
         return None
-    if text and text != '#':                        # Wildcards
+    if text and text != '#' and text_mode == 'substring':   # Wildcards
         msgs = msgs.filter(Q(text_content__icontains=text))
+    elif text and text != '#':
+        msgs = msgs.search_text(text)
+        if rank:
+            msgs = msgs.order_by('$text_score')
     if username is not None and username != '#':    # Wildcards
-        msgs = msgs.filter(Q(sender_username__iexact=username))
+        msgs = msgs.filter(Q(sender_username_lower=username.lower()))
     if name and name != '#':                        # Wildcards
-        msgs = msgs.filter(Q(sender_lastname__icontains=name) |
-                           Q(sender_firstname__icontains=name))
+        msgs = _filter_name(msgs, name, name_mode)
+    # Query is not run here, callers count the messages they fetch.
     proc_logger.info(
-        '{count} messages filtered for criteria.botid:{botid}, time(in minutes)'
+        'Messages filtered for criteria.botid:{botid}, time(in minutes)'
         ':{time_min}, text:{text}, username={uname},name:{name}'.format(
-            count=len(msgs), botid=botid, time_min=time_min, uname=username,
-            text=text, name=name))
+            botid=botid, time_min=time_min, uname=username, text=text,
+            name=name))
     return msgs
@@ -0,0 +1,258 @@
+"""
+Module containing the cache of message listing results (pages of filtered
+messages). Entries are keyed by normalized criteria and page cursor, and
+depend on scopes (a bot, a chat or all messages). Every scope has a
+generation which is incremented when messages of the scope are written, so
+entries of other scopes stay valid while outdated entries are never read
+again (and are eventually evicted).
+"""
+import time
+import pickle
+import threading
+from collections import OrderedDict
+from . import proc_logger
+
+# Scope of entries depending on messages of any bot or chat.
+ALL = 'all'
+# Scope of all entries, incremented when messages are deleted.
+EPOCH = 'epoch'
+
+
+def scope(kind, value):
+    """
+    :param kind: Kind of scope, 'bot' or 'chat'.
+    :param value: Bot or chat ID (integer or string).
+    :return: Scope name e.g. bot:12345
+    """
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        pass
+    return '{kind}:{value}'.format(kind=kind, value=value)
+
+
+class LRUBackend(object):
+    """
+    In-process cache backend evicting least recently used entries.
+    :param max_entries: Maximum number of cached entries.
+    """
+    name = 'lru'
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()       # key -> (expires, value)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                return None                 # Expired, dropped.
+            self._entries[key] = entry      # Most recently used.
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generations(self, scopes):
+        with self._lock:
+            return [self._generations.get(name, 0) for name in scopes]
+
+    def increment(self, scopes):
+        with self._lock:
+            for name in scopes:
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+    def size(self):
+        return len(self._entries)
+
+
+class RedisBackend(object):
+    """
+    Cache backend storing entries in Redis (e.g. a local instance shared by
+    all server processes), entries are evicted by Redis (maxmemory-policy
+    allkeys-lru) or when they expire. Requires the redis package.
+    :param url: Redis URL e.g. redis://localhost:6379/0
+    :param prefix: Prefix of keys used by the cache.
+    """
+    name = 'redis'
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='filter_cache'):
+        import redis
+        self.prefix = prefix
+        self._redis = redis.StrictRedis.from_url(url)
+
+    def _key(self, key):
+        return '{prefix}:{key}'.format(prefix=self.prefix, key=key)
+
+    def get(self, key):
+        value = self._redis.get(self._key(key))
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self._redis.set(self._key(key), pickle.dumps(value, 2),
+                        ex=max(int(ttl), 1))
+
+    def generations(self, scopes):
+        return [int(value or 0) for value in self._redis.mget(
+            [self._key('generation:' + name) for name in scopes])]
+
+    def increment(self, scopes):
+        pipeline = self._redis.pipeline(transaction=False)
+        for name in scopes:
+            pipeline.incr(self._key('generation:' + name))
+        pipeline.execute()
+
+    def size(self):
+        return None                 # Not tracked, keys are shared.
+
+
+class FilterCache(object):
+    """
+    Cache of message listing results with invalidation driven by written
+    messages.
+    :param backend: LRUBackend or RedisBackend object.
+    :param ttl: Time (in seconds) entries are kept, bounds staleness of
+    results of relative time windows e.g. last 10 minutes.
+    :param enabled: If False, results are not cached.
+    """
+
+    def __init__(self, backend=None, ttl=60.0, enabled=True):
+        self.backend = backend or LRUBackend()
+        self.ttl = ttl
+        self.enabled = enabled
+        # Metrics
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._errors = 0
+
+    def init_app(self, app):
+        """
+        Load cache settings from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.enabled = app.config.get('FILTER_CACHE_ENABLED', True)
+        self.ttl = app.config.get('FILTER_CACHE_TTL', 60.0)
+        if app.config.get('FILTER_CACHE_BACKEND', 'lru') == 'redis':
+            try:
+                self.backend = RedisBackend(
+                    url=app.config.get('FILTER_CACHE_REDIS_URL',
+                                       'redis://localhost:6379/0'))
+                return
+            except ImportError as e:
+                proc_logger.error('Unable to use redis filter cache backend, '
+                                  'using in-process backend instead. Reason:'
+                                  '{reason}'.format(reason=e))
+        self.backend = LRUBackend(
+            max_entries=app.config.get('FILTER_CACHE_SIZE', 1000))
+
+    @staticmethod
+    def key(criteria):
+        """
+        :param criteria: Dictionary of criteria and page cursor.
+        :return: Key of the criteria, independent of the order of criteria,
+        wildcards ('#', '' and None) and case of text, username and name.
+        """
+        normalized = []
+        for name, value in sorted(criteria.items()):
+            if value in ('#', ''):
+                value = None
+            if isinstance(value, basestring):
+                value = value.strip()
+                if name in ('text', 'username', 'name'):
+                    value = value.lower()
+                value = value.encode('utf-8')
+            normalized.append('{0}={1!r}'.format(name, value))
+        return '|'.join(normalized)
+
+    def get(self, criteria, scopes, compute):
+        """
+        Get a cached result, computing and caching it if missing.
+        :param criteria: Dictionary of criteria and page cursor.
+        :param scopes: Scopes the result depends on e.g. [scope('bot', 1)] or
+        [ALL].
+        :param compute: Callable returning the result.
+        :return: Result of criteria.
+        """
+        if not self.enabled:
+            return compute()
+        scopes = [EPOCH] + list(scopes)
+        try:
+            key = '{key}@{generations}'.format(
+                key=self.key(criteria),
+                generations=','.join(str(generation) for generation in
+                                     self.backend.generations(scopes)))
+            result = self.backend.get(key)
+        except Exception as e:
+            self._error(e)
+            return compute()
+        if result is not None:
+            self._hits += 1
+            return result
+        self._misses += 1
+        result = compute()
+        try:
+            self.backend.set(key, result, self.ttl)
+        except Exception as e:
+            self._error(e)
+        return result
+
+    def invalidate(self, documents):
+        """
+        Invalidate results depending on bots and chats of written messages,
+        used as flush listener of the message write buffer.
+        :param documents: Written message documents.
+        :return:
+        """
+        scopes = set([ALL])
+        for document in documents:
+            scopes.add(scope('bot', document.get('bot_id', 0)))
+            scopes.add(scope('chat', document.get('chatid', 0)))
+        self._increment(scopes)
+
+    def clear(self):
+        """
+        Invalidate all results e.g. after messages are deleted.
+        :return:
+        """
+        self._increment([EPOCH])
+
+    def _increment(self, scopes):
+        if not self.enabled:
+            return
+        try:
+            self.backend.increment(scopes)
+            self._invalidations += 1
+        except Exception as e:
+            self._error(e)
+
+    def _error(self, e):
+        self._errors += 1
+        proc_logger.warn('Filter cache unavailable. Reason:{reason}'.format(
+            reason=e))
+
+    def stats(self):
+        """
+        :return: Dictionary of cache metrics.
+        """
+        lookups = self._hits + self._misses
+        return {
+            'enabled': self.enabled,
+            'backend': self.backend.name,
+            'entries': self.backend.size(),
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_ratio': round(float(self._hits) / lookups, 3)
+            if lookups else None,
+            'invalidations': self._invalidations,
+            'errors': self._errors
+        }
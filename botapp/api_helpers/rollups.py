@@ -0,0 +1,328 @@
+"""
+Module containing time bucketed message rollups used for activity charts.
+Written messages are counted per (bot, chat, minute) with $inc, and minute
+buckets older than the retention period are folded into hour buckets by a
+background compaction, so a time series over months of messages is read from
+a few hundred rollup documents instead of aggregating the messages.
+"""
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import UpdateOne, InsertOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from botapp.models import Message, MessageRollup
+from .counters import bulk_upsert
+from .pagination import EPOCH
+from .write_buffer import bulk_write_reason
+from .periodic import PeriodicWorker
+from . import proc_logger
+
+# Number of minute buckets folded by a single bulk write.
+FOLD_BATCH_SIZE = 1000
+# Length (in seconds) of buckets of each resolution. Only minute and hour
+# buckets are stored, days are summed from them.
+RESOLUTIONS = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def floor(date, seconds):
+    """
+    :param date: datetime object.
+    :param seconds: Length of buckets in seconds e.g. 60.
+    :return: Start of the bucket containing date.
+    """
+    delta = date - EPOCH
+    elapsed = delta.days * 86400 + delta.seconds
+    return EPOCH + timedelta(seconds=elapsed - elapsed % seconds)
+
+
+def _bucket_start(field, seconds):
+    """
+    :param field: Date field e.g. '$bucket'.
+    :param seconds: Length of buckets in seconds.
+    :return: Aggregation expression of the start of the bucket of field.
+    """
+    elapsed = {'$subtract': [field, EPOCH]}             # Milliseconds.
+    return {'$subtract': [field, {'$mod': [elapsed, seconds * 1000]}]}
+
+
+class MessageRollups(object):
+    """
+    Per minute and per hour message counts of chats.
+    :param retention: Time (in seconds) minute buckets are kept before they
+    are folded into hour buckets.
+    :param compact_interval: Time (in seconds) between compactions.
+    :param claim_timeout: Time (in seconds) after which minute buckets
+    claimed by a compaction which did not finish (e.g. its process crashed)
+    are claimed again.
+    :param enabled: If False, written messages are not counted.
+    """
+
+    def __init__(self, retention=86400, compact_interval=3600,
+                 claim_timeout=600, enabled=True):
+        self.retention = retention
+        self.compact_interval = compact_interval
+        self.claim_timeout = claim_timeout
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._worker = PeriodicWorker('message-rollups', self._compact,
+                                      lambda: self.compact_interval)
+        # Metrics
+        self._compactions = 0
+        self._compacted = 0
+        self._failures = 0
+        self._last_compaction = None
+
+    def init_app(self, app):
+        """
+        Load rollup settings from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.enabled = app.config.get('MESSAGE_ROLLUPS_ENABLED', True)
+        self.retention = app.config.get('MESSAGE_ROLLUP_MINUTE_RETENTION',
+                                        self.retention)
+        self.compact_interval = app.config.get(
+            'MESSAGE_ROLLUP_COMPACT_INTERVAL', self.compact_interval)
+        self.claim_timeout = app.config.get('MESSAGE_ROLLUP_CLAIM_TIMEOUT',
+                                            self.claim_timeout)
+
+    def cutoff(self, now=None):
+        """
+        :param now: Current time, datetime.now() if None.
+        :return: Start of the oldest hour whose messages are counted in
+        minute buckets, older messages are counted in hour buckets.
+        """
+        return floor((now or datetime.now()) -
+                     timedelta(seconds=self.retention), 3600)
+
+    def record(self, documents):
+        """
+        Count written messages in their buckets, used as flush listener of
+        the message write buffer. Increments of a batch are summed per bucket
+        first.
+        :param documents: Written message documents.
+        :return:
+        """
+        if not self.enabled:
+            return
+        self.start()
+        cutoff = self.cutoff()
+        increments = defaultdict(int)
+        for document in documents:
+            date = document.get('date') or datetime.now()
+            if date >= cutoff:
+                key = ('minute', floor(date, 60))
+            else:
+                key = ('hour', floor(date, 3600))     # Late message.
+            increments[(document.get('bot_id', 0), document.get('chatid', 0))
+                       + key] += 1
+        requests = [UpdateOne({'bot_id': bot_id, 'chatid': chatid,
+                               'resolution': resolution, 'bucket': bucket},
+                              {'$inc': {'count': value}}, upsert=True)
+                    for (bot_id, chatid, resolution, bucket), value in
+                    increments.items()]
+        try:
+            bulk_upsert(MessageRollup._get_collection(), requests)
+        except BulkWriteError as e:
+            self._failures += 1
+            proc_logger.error('Unable to update message rollups. Reason:'
+                              '{reason}'.format(
+                                reason=bulk_write_reason(e)))
+
+    def series(self, bot_id, start, end, resolution='hour', chatid=None):
+        """
+        Get number of messages per bucket of a bot or chat.
+        :param bot_id: ID of the bot.
+        :param start: Start of the range (datetime), rounded down to the
+        start of its bucket.
+        :param end: End of the range (datetime, exclusive).
+        :param resolution: 'minute', 'hour' or 'day'. Minute buckets are only
+        kept for the retention period.
+        :param chatid: ID of the chat, all chats of the bot if None.
+        :return: List of (bucket start, count) tuples of non-empty buckets,
+        oldest first.
+        :except ValueError: If resolution is not supported.
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError('Invalid resolution:{resolution}, use one of '
+                             '{resolutions}.'.format(
+                                resolution=resolution,
+                                resolutions=', '.join(sorted(RESOLUTIONS))))
+        seconds = RESOLUTIONS[resolution]
+        match = {'bot_id': bot_id,
+                 'bucket': {'$gte': floor(start, seconds), '$lt': end}}
+        if chatid is not None:
+            match['chatid'] = chatid
+        if resolution == 'minute':
+            match['resolution'] = 'minute'
+        collection = MessageRollup._get_collection()
+        rows = collection.aggregate(
+            [{'$match': match},
+             {'$group': {'_id': _bucket_start('$bucket', seconds),
+                         'count': {'$sum': '$count'}}},
+             {'$sort': {'_id': 1}}])
+        return [(row['_id'], row['count']) for row in rows]
+
+    def compact(self, now=None):
+        """
+        Fold minute buckets of hours older than cutoff (one hour earlier, as
+        messages being recorded may still target the hour before cutoff)
+        into hour buckets. Until minute buckets are removed, their messages
+        are counted twice by hourly series. Minute buckets are first claimed
+        with the ID of this compaction, so concurrent compactions of several
+        processes fold every minute bucket once. Claims older than
+        claim_timeout are taken over, hour buckets list the minute buckets
+        folded into them, so a minute bucket folded by a compaction which
+        failed before removing it is not counted again.
+        :param now: Current time, datetime.now() if None.
+        :return: Number of minute buckets folded.
+        """
+        now = now or datetime.now()
+        before = self.cutoff(now) - timedelta(hours=1)
+        expired = now - timedelta(seconds=self.claim_timeout)
+        collection = MessageRollup._get_collection()
+        compaction = ObjectId()
+        folded = 0
+        with self._lock:
+            collection.update_many(
+                {'resolution': 'minute', 'bucket': {'$lt': before},
+                 '$or': [{'claimed_at': {'$exists': False}},
+                         {'claimed_at': {'$lt': expired}}]},
+                {'$set': {'compaction': compaction, 'claimed_at': now}})
+            minutes = collection.find(
+                {'resolution': 'minute', 'compaction': compaction},
+                {'bot_id': 1, 'chatid': 1, 'bucket': 1, 'count': 1})
+            batch = []
+            for minute in minutes:
+                batch.append(minute)
+                if len(batch) == FOLD_BATCH_SIZE:
+                    folded += self._fold(collection, batch, compaction)
+                    batch = []
+            folded += self._fold(collection, batch, compaction)
+        self._compactions += 1
+        self._compacted += folded
+        self._last_compaction = datetime.now()
+        if folded:
+            proc_logger.info('Folded {count} minute buckets into hour '
+                             'buckets.'.format(count=folded))
+        return folded
+
+    @staticmethod
+    def _fold(collection, minutes, compaction):
+        """
+        Add counts of minute buckets to their hour buckets and remove them.
+        Each fold is a single update of the hour bucket, which is skipped if
+        the hour bucket already lists the minute bucket.
+        :param collection: pymongo Collection of MessageRollup.
+        :param minutes: List of claimed minute bucket documents.
+        :param compaction: ID of the compaction which claimed them.
+        :return: Number of removed minute buckets.
+        """
+        if not minutes:
+            return 0
+        requests = [UpdateOne({'bot_id': minute['bot_id'],
+                               'chatid': minute['chatid'],
+                               'resolution': 'hour',
+                               'bucket': floor(minute['bucket'], 3600),
+                               'folded': {'$ne': minute['_id']}},
+                              {'$inc': {'count': minute['count']},
+                               '$push': {'folded': minute['_id']}},
+                              upsert=True)
+                    for minute in minutes]
+        # A duplicate key error of the retried upsert means the hour bucket
+        # exists and lists the minute bucket, i.e. it is folded already.
+        bulk_upsert(collection, requests, ignore_duplicates=True)
+        # Minute buckets claimed again by another compaction meanwhile are
+        # removed by that compaction.
+        return collection.delete_many(
+            {'_id': {'$in': [minute['_id'] for minute in minutes]},
+             'compaction': compaction}).deleted_count
+
+    def start(self):
+        """
+        Start the background compaction thread if it is not running already.
+        :return:
+        """
+        self._worker.start()
+
+    def close(self):
+        """
+        Stop the background compaction thread.
+        :return:
+        """
+        self._worker.close()
+
+    def _compact(self):
+        try:
+            self.compact()
+        except (PyMongoError, BulkWriteError) as e:
+            self._failures += 1
+            proc_logger.error('Unable to compact message rollups. '
+                              'Reason:{reason}'.format(reason=e))
+
+    def forget_bot(self, bot_id):
+        """
+        Remove rollups of a bot whose messages are deleted.
+        :param bot_id: ID of the bot.
+        :return:
+        """
+        MessageRollup._get_collection().delete_many({'bot_id': bot_id})
+
+    def clear(self):
+        """
+        Remove all rollups e.g. after all messages are deleted.
+        :return:
+        """
+        MessageRollup._get_collection().delete_many({})
+
+    def rebuild(self, now=None, batch_size=1000):
+        """
+        Recompute all rollups from the messages collection, messages before
+        cutoff are counted in hour buckets. Rebuild while ingestion is
+        stopped.
+        :param now: Current time, datetime.now() if None.
+        :param batch_size: Number of rollups inserted per bulk write.
+        :return: Number of rollups.
+        """
+        cutoff = self.cutoff(now)
+        collection = MessageRollup._get_collection()
+        count = 0
+        with self._lock:
+            collection.delete_many({})
+            for resolution, date in (('minute', {'$gte': cutoff}),
+                                     ('hour', {'$lt': cutoff})):
+                start = _bucket_start('$date', RESOLUTIONS[resolution])
+                batch = []
+                for row in Message._get_collection().aggregate(
+                        [{'$match': {'date': date}},
+                         {'$group': {'_id': {'bot_id': '$bot_id',
+                                             'chatid': '$chatid',
+                                             'bucket': start},
+                                     'count': {'$sum': 1}}}],
+                        allowDiskUse=True):
+                    batch.append(InsertOne(dict(row['_id'], count=row['count'],
+                                                resolution=resolution)))
+                    if len(batch) >= batch_size:
+                        collection.bulk_write(batch, ordered=False)
+                        count += len(batch)
+                        batch = []
+                if batch:
+                    collection.bulk_write(batch, ordered=False)
+                    count += len(batch)
+        proc_logger.info('Rebuilt {count} message rollups.'.format(
+            count=count))
+        return count
+
+    def stats(self):
+        """
+        :return: Dictionary of rollup metrics.
+        """
+        return {
+            'enabled': self.enabled,
+            'compactions': self._compactions,
+            'compacted': self._compacted,
+            'failures': self._failures,
+            'last_compaction': self._last_compaction.isoformat()
+            if self._last_compaction else None
+        }
@@ -0,0 +1,167 @@
+"""
+Module containing the sender directory, one document per sender username
+with the number of messages received from the sender and when the last one
+was sent. It is updated for every batch of written messages, so sender
+lookups (e.g. typeahead of the filtering form) read the directory instead of
+the usernames of all messages.
+"""
+import re
+from collections import defaultdict
+from pymongo import UpdateOne, InsertOne, ASCENDING
+from pymongo.errors import BulkWriteError
+from botapp.models import Message, Sender
+from .counters import bulk_upsert
+from .write_buffer import bulk_write_reason
+from . import proc_logger
+
+# Characters with special meaning in regular expressions.
+REGEX_SPECIAL = re.compile(r'([.^$*+?{}\[\]\\|()])')
+
+
+def prefix_pattern(prefix):
+    """
+    :param prefix: Start of a username.
+    :return: Anchored regular expression matching usernames starting with
+    prefix, which is served by an index on the username.
+    """
+    return '^' + REGEX_SPECIAL.sub(r'\\\1', prefix)
+
+
+class SenderDirectory(object):
+    """
+    Directory of message senders maintained with $inc and $max upserts.
+    :param enabled: If False, senders of written messages are not recorded.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        # Metrics
+        self._updates = 0
+        self._failures = 0
+
+    def init_app(self, app):
+        """
+        Load sender directory settings from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.enabled = app.config.get('SENDER_DIRECTORY_ENABLED', True)
+
+    def record(self, documents):
+        """
+        Add senders of written messages to the directory, used as flush
+        listener of the message write buffer.
+        :param documents: Written message documents.
+        :return:
+        """
+        if not self.enabled:
+            return
+        senders = {}            # username_lower -> [count, last seen, name]
+        for document in documents:
+            username = document.get('sender_username_lower')
+            if not username or username == 'unknown':
+                continue
+            sender = senders.setdefault(username, [0, None, None])
+            sender[0] += 1
+            date = document.get('date')
+            if date is not None and (sender[1] is None or date >= sender[1]):
+                sender[1] = date
+                sender[2] = document.get('sender_username')
+        requests = []
+        for username, (count, last_seen, name) in senders.items():
+            update = {'$inc': {'messages': count},
+                      '$set': {'username': name or username}}
+            if last_seen is not None:
+                update['$max'] = {'last_seen': last_seen}
+            requests.append(UpdateOne({'username_lower': username}, update,
+                                      upsert=True))
+        try:
+            bulk_upsert(Sender._get_collection(), requests)
+            self._updates += len(requests)
+        except BulkWriteError as e:
+            self._failures += 1
+            proc_logger.error('Unable to update sender directory. Reason:'
+                              '{reason}'.format(
+                                reason=bulk_write_reason(e)))
+
+    def lookup(self, prefix, limit=10):
+        """
+        :param prefix: Start of sender usernames (case insensitive).
+        :param limit: Maximum number of senders.
+        :return: List of dictionaries of username, messages and last_seen of
+        senders whose username starts with prefix, in username order.
+        """
+        cursor = Sender._get_collection().find(
+            {'username_lower': {'$regex': prefix_pattern(prefix.lower())}},
+            {'_id': 0, 'username': 1, 'messages': 1, 'last_seen': 1})
+        return list(cursor.sort('username_lower', ASCENDING).limit(limit))
+
+    def forget_bot(self, bot_id):
+        """
+        Subtract messages of a bot before they are deleted, senders without
+        messages left are removed.
+        :param bot_id: ID of the bot.
+        :return:
+        """
+        decrements = defaultdict(int)
+        for row in Message._get_collection().aggregate(
+                [{'$match': {'bot_id': bot_id,
+                             'sender_username_lower': {'$ne': None}}},
+                 {'$group': {'_id': '$sender_username_lower',
+                             'count': {'$sum': 1}}}], allowDiskUse=True):
+            decrements[row['_id']] -= row['count']
+        collection = Sender._get_collection()
+        if decrements:
+            collection.bulk_write([
+                UpdateOne({'username_lower': username},
+                          {'$inc': {'messages': count}})
+                for username, count in decrements.items()], ordered=False)
+        collection.delete_many({'messages': {'$lte': 0}})
+
+    def clear(self):
+        """
+        Remove all senders e.g. after all messages are deleted.
+        :return:
+        """
+        Sender._get_collection().delete_many({})
+
+    def rebuild(self, batch_size=1000):
+        """
+        Recompute the directory from the messages collection. Rebuild while
+        ingestion is stopped.
+        :param batch_size: Number of senders inserted per bulk write.
+        :return: Number of senders.
+        """
+        collection = Sender._get_collection()
+        collection.delete_many({})
+        count = 0
+        batch = []
+        for row in Message._get_collection().aggregate(
+                [{'$match': {'sender_username_lower': {'$nin': [
+                    None, '', 'unknown']}}},
+                 {'$group': {'_id': '$sender_username_lower',
+                             'username': {'$last': '$sender_username'},
+                             'messages': {'$sum': 1},
+                             'last_seen': {'$max': '$date'}}}],
+                allowDiskUse=True):
+            batch.append(InsertOne({'username_lower': row['_id'],
+                                    'username': row['username'],
+                                    'messages': row['messages'],
+                                    'last_seen': row['last_seen']}))
+            if len(batch) >= batch_size:
+                collection.bulk_write(batch, ordered=False)
+                count += len(batch)
+                batch = []
+        if batch:
+            collection.bulk_write(batch, ordered=False)
+            count += len(batch)
+        proc_logger.info('Rebuilt sender directory of {count} senders.'.format(
+            count=count))
+        return count
+
+    def stats(self):
+        """
+        :return: Dictionary of sender directory metrics.
+        """
+        return {'enabled': self.enabled, 'updates': self._updates,
+                'failures': self._failures}
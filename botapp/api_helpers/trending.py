@@ -0,0 +1,271 @@
+"""
+Module containing the trending terms detector. Words and two word phrases of
+written messages are counted per time window by count-min sketches, globally
+and per bot, and compared with a decayed baseline of previous windows. Only
+the sketches and a bounded set of candidate terms are kept, so memory does
+not grow with the vocabulary.
+"""
+import re
+import time
+import array
+import hashlib
+import struct
+import threading
+from . import proc_logger
+
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+# Scope of terms of all bots.
+GLOBAL = 'all'
+
+
+def terms(text, min_length=3):
+    """
+    :param text: Message text.
+    :param min_length: Minimum length of words.
+    :return: List of lowercase words and two word phrases of text.
+    """
+    words = [word for word in TERM_PATTERN.findall((text or u'').lower())
+             if len(word) >= min_length and not word.isdigit()]
+    return words + [u' '.join(pair) for pair in zip(words, words[1:])]
+
+
+class CountMinSketch(object):
+    """
+    Count-min sketch of depth rows of width counters. Estimates never
+    undercount, and overcount by at most 2 / width of the total count with
+    probability 1 - 0.5 ** depth.
+    :param width: Number of counters per row.
+    :param depth: Number of rows (hash functions).
+    :param typecode: array typecode of counters, 'f' for decayed counts.
+    """
+
+    def __init__(self, width=2048, depth=4, typecode='l'):
+        self.width = width
+        self.depth = depth
+        self.rows = [array.array(typecode, [0] * width) for _ in range(depth)]
+        self.total = 0
+
+    def _indexes(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        digest = hashlib.md5(item).digest()
+        first, second = struct.unpack('>QQ', digest)
+        # Double hashing, row i uses first + i * second.
+        return [(first + row * second) % self.width
+                for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        """
+        :param item: Counted item e.g. a term.
+        :param count: Number of occurrences.
+        :return: Estimated count of item after adding it.
+        """
+        self.total += count
+        estimate = None
+        for row, index in zip(self.rows, self._indexes(item)):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, item):
+        """
+        :param item: Counted item.
+        :return: Estimated count of item.
+        """
+        return min(row[index] for row, index in
+                   zip(self.rows, self._indexes(item)))
+
+    def decay(self, factor, other):
+        """
+        Update self (a baseline) to factor * self + (1 - factor) * other.
+        :param factor: Weight of the current counts, 0 to 1.
+        :param other: CountMinSketch object of the same dimensions.
+        :return:
+        """
+        for row, other_row in zip(self.rows, other.rows):
+            for index in range(self.width):
+                row[index] = factor * row[index] + \
+                    (1 - factor) * other_row[index]
+        self.total = factor * self.total + (1 - factor) * other.total
+
+
+class TermWindow(object):
+    """
+    Term counts of a scope (all bots or a bot): the sketch of the current
+    window, the decayed baseline sketch of previous windows and the
+    candidates, terms with the highest counts in the current window.
+    """
+
+    def __init__(self, start, width, depth):
+        self.start = start
+        self.windows = 0                # Windows folded into the baseline.
+        self.current = CountMinSketch(width, depth)
+        self.baseline = CountMinSketch(width, depth, typecode='f')
+        self.candidates = {}            # term -> estimated count.
+        self.smallest = 0               # Smallest count of full candidates.
+
+
+class TrendingTerms(object):
+    """
+    Trending terms detector, globally and per bot.
+    :param window: Length (in seconds) of a window.
+    :param decay: Weight of the baseline when a window is folded into it.
+    :param candidates: Number of candidate terms kept per scope.
+    :param min_count: Minimum count of trending terms in a window, also
+    added to expected counts to damp terms never seen before.
+    :param width: Number of counters per row of sketches.
+    :param depth: Number of rows of sketches.
+    :param enabled: If False, written messages are not counted.
+    """
+
+    def __init__(self, window=300, decay=0.9, candidates=200, min_count=5,
+                 width=2048, depth=4, enabled=True):
+        self.window = window
+        self.decay = decay
+        self.candidates = candidates
+        self.min_count = min_count
+        self.width = width
+        self.depth = depth
+        self.enabled = enabled
+        self._scopes = {}               # GLOBAL or bot ID -> TermWindow.
+        self._lock = threading.Lock()
+        # Metrics
+        self._terms = 0
+
+    def init_app(self, app):
+        """
+        Load trending terms settings from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.enabled = app.config.get('TRENDING_ENABLED', True)
+        self.window = app.config.get('TRENDING_WINDOW', self.window)
+        self.decay = app.config.get('TRENDING_DECAY', self.decay)
+        self.candidates = app.config.get('TRENDING_CANDIDATES',
+                                         self.candidates)
+        self.min_count = app.config.get('TRENDING_MIN_COUNT', self.min_count)
+
+    def _scope(self, name, now):
+        """
+        :return: TermWindow of scope, the current window folded into the
+        baseline if it has ended.
+        """
+        start = now - now % self.window
+        scope = self._scopes.get(name)
+        if scope is None:
+            scope = self._scopes[name] = TermWindow(start, self.width,
+                                                    self.depth)
+        elif scope.start < start:
+            elapsed = int((start - scope.start) // self.window)
+            scope.baseline.decay(self.decay if scope.windows else 0,
+                                 scope.current)
+            if elapsed > 1:
+                # Empty windows since the last message decay the baseline.
+                scope.baseline.decay(self.decay ** (elapsed - 1),
+                                     CountMinSketch(self.width, self.depth))
+            scope.windows += elapsed
+            scope.start = start
+            scope.current = CountMinSketch(self.width, self.depth)
+            scope.candidates = {}
+            scope.smallest = 0
+        return scope
+
+    def record(self, documents, now=None):
+        """
+        Count terms of written messages, used as flush listener of the
+        message write buffer.
+        :param documents: Written message documents.
+        :param now: Current time (seconds since epoch), time.time() if None.
+        :return:
+        """
+        if not self.enabled:
+            return
+        now = now or time.time()
+        with self._lock:
+            for document in documents:
+                found = set(terms(document.get('text_content')))
+                if not found:
+                    continue
+                self._terms += len(found)
+                for name in (GLOBAL, document.get('bot_id', 0)):
+                    scope = self._scope(name, now)
+                    for term in found:
+                        self._offer(scope, term, scope.current.add(term))
+
+    def _offer(self, scope, term, count):
+        candidates = scope.candidates
+        if term in candidates or len(candidates) < self.candidates:
+            candidates[term] = count
+            return
+        if count <= scope.smallest:
+            return
+        smallest = min(candidates, key=candidates.get)
+        if candidates[smallest] < count:
+            del candidates[smallest]
+            candidates[term] = count
+        scope.smallest = min(candidates.values())
+
+    def trending(self, bot_id=None, k=10, now=None):
+        """
+        :param bot_id: ID of the bot, all bots if None.
+        :param k: Number of terms.
+        :param now: Current time (seconds since epoch), time.time() if None.
+        :return: List of dictionaries of the k terms with highest ratio of
+        their count in the current window to their expected count (decayed
+        baseline scaled to the elapsed part of the window).
+        """
+        now = now or time.time()
+        name = GLOBAL if bot_id is None else bot_id
+        with self._lock:
+            if name not in self._scopes:
+                return []
+            scope = self._scope(name, now)
+            elapsed = max(now - scope.start, 1.0) / float(self.window)
+            results = []
+            for term in scope.candidates:
+                count = scope.current.estimate(term)
+                if count < self.min_count:
+                    continue
+                expected = scope.baseline.estimate(term) * elapsed
+                results.append({
+                    'term': term,
+                    'count': count,
+                    'expected': round(expected, 2),
+                    'score': round(count / (expected + self.min_count), 3)
+                })
+        results.sort(key=lambda result: (-result['score'], -result['count']))
+        return results[:k]
+
+    def forget_bot(self, bot_id):
+        """
+        Remove term counts of a bot.
+        :param bot_id: ID of the bot.
+        :return:
+        """
+        with self._lock:
+            self._scopes.pop(bot_id, None)
+
+    def clear(self):
+        """
+        Remove all term counts.
+        :return:
+        """
+        with self._lock:
+            self._scopes.clear()
+        proc_logger.info('Cleared trending terms.')
+
+    def stats(self):
+        """
+        :return: Dictionary of trending terms metrics.
+        """
+        return {
+            'enabled': self.enabled,
+            'scopes': len(self._scopes),
+            'terms': self._terms,
+            # Bytes of counters of current and baseline sketches.
+            'memory': sum(
+                sum(row.itemsize * len(row) for row in
+                    scope.current.rows + scope.baseline.rows)
+                for scope in self._scopes.values())
+        }
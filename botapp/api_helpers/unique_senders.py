@@ -0,0 +1,329 @@
+"""
+Module containing approximate unique sender counts of bots and chats.
+Senders of written messages are added to HyperLogLog sketches per bot and per
+chat, one per hour and one per day. Sketches of a range are merged (register
+wise maximum), so the number of unique senders over any range is estimated
+from a few kilobytes of registers per day without reading messages. Sketches
+are kept in memory and merged into the database periodically, which makes
+them mergeable across worker processes too.
+"""
+import math
+import array
+import hashlib
+import struct
+import threading
+from datetime import datetime, timedelta
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from botapp.models import SenderSketch
+from .rollups import floor
+from .periodic import PeriodicWorker
+from . import proc_logger
+
+# Attempts of merging a sketch into a concurrently updated stored sketch.
+MAX_MERGE_ATTEMPTS = 5
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog sketch estimating the number of distinct values added, with
+    a relative standard error of 1.04 / sqrt(2 ** precision).
+    :param precision: Number of hash bits selecting a register, 4 to 16.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        """
+        :param value: Value e.g. a sender username.
+        :return:
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        digest = hashlib.sha1(str(value)).digest()
+        hashed = struct.unpack('>Q', digest[:8])[0]
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        # Position of the leftmost 1 bit of the remaining 64-precision bits.
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Add all values of other sketch (of the same precision).
+        :param other: HyperLogLog object.
+        :return: self
+        """
+        registers = self.registers
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+        return self
+
+    def count(self):
+        """
+        :return: Estimated number of distinct values added.
+        """
+        size = self.size
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(
+            size, 0.7213 / (1 + 1.079 / size))
+        estimate = alpha * size * size / sum(2.0 ** -rank
+                                             for rank in self.registers)
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * size and zeros:
+            # Small range correction, linear counting.
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        """
+        :return: Compact binary form of the registers, sparse (index and rank
+        of non zero registers) while few registers are set.
+        """
+        used = [(index, rank) for index, rank in enumerate(self.registers)
+                if rank]
+        if len(used) * 4 < self.size:
+            sparse = array.array('I', [index << 8 | rank
+                                       for index, rank in used])
+            return b'S' + sparse.tostring()
+        return b'D' + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data, precision=12):
+        """
+        :param data: Bytes returned by to_bytes.
+        :param precision: Precision of the stored sketch.
+        :return: HyperLogLog object.
+        """
+        sketch = cls(precision)
+        data = bytes(data)
+        if data[:1] == b'S':
+            sparse = array.array('I')
+            sparse.fromstring(data[1:])
+            for item in sparse:
+                sketch.registers[item >> 8] = item & 0xff
+        elif data:
+            sketch.registers = bytearray(data[1:])
+        return sketch
+
+
+class UniqueSenders(object):
+    """
+    Hourly and daily HyperLogLog sketches of senders per bot and chat.
+    :param precision: Precision of sketches.
+    :param persist_interval: Time (in seconds) between merges of in-memory
+    sketches into the database.
+    :param enabled: If False, senders of written messages are not counted.
+    """
+
+    def __init__(self, precision=12, persist_interval=10, enabled=True):
+        self.precision = precision
+        self.persist_interval = persist_interval
+        self.enabled = enabled
+        # (kind, key, resolution, bucket) -> HyperLogLog not yet persisted.
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._persist_lock = threading.Lock()
+        self._worker = PeriodicWorker('unique-senders', self.persist,
+                                      lambda: self.persist_interval)
+        # Metrics
+        self._persisted = 0
+        self._conflicts = 0
+        self._failures = 0
+
+    def init_app(self, app):
+        """
+        Load unique sender settings from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.enabled = app.config.get('UNIQUE_SENDERS_ENABLED', True)
+        self.precision = app.config.get('UNIQUE_SENDERS_PRECISION',
+                                        self.precision)
+        self.persist_interval = app.config.get(
+            'UNIQUE_SENDERS_PERSIST_INTERVAL', self.persist_interval)
+
+    def record(self, documents):
+        """
+        Add senders of written messages to sketches of their bot and chat,
+        used as flush listener of the message write buffer.
+        :param documents: Written message documents.
+        :return:
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            for document in documents:
+                sender = document.get('sender_username_lower')
+                if not sender:
+                    continue
+                date = document.get('date') or datetime.now()
+                for kind, key in (('bot', document.get('bot_id', 0)),
+                                  ('chat', document.get('chatid', 0))):
+                    for resolution, seconds in (('hour', 3600),
+                                                ('day', 86400)):
+                        sketch_key = (kind, key, resolution,
+                                      floor(date, seconds))
+                        sketch = self._pending.get(sketch_key)
+                        if sketch is None:
+                            sketch = self._pending[sketch_key] = \
+                                HyperLogLog(self.precision)
+                        sketch.add(sender)
+        self.start()
+
+    def estimate(self, kind, key, start, end):
+        """
+        Estimate the number of unique senders of a bot or chat, merging
+        daily sketches of whole days and hourly sketches of the hours before
+        and after them.
+        :param kind: 'bot' or 'chat'.
+        :param key: Bot ID or chat ID.
+        :param start: Start of the range (datetime), rounded down to the hour.
+        :param end: End of the range (datetime, exclusive), rounded up to the
+        hour.
+        :return: Estimated number of unique senders.
+        """
+        start = floor(start, 3600)
+        if floor(end, 3600) < end:
+            end = floor(end, 3600) + timedelta(hours=1)
+        first_day = floor(start, 86400)
+        if first_day < start:
+            first_day += timedelta(days=1)
+        last_day = max(floor(end, 86400), first_day)
+        ranges = [('day', first_day, last_day), ('hour', start, first_day),
+                  ('hour', last_day, end)]
+        if first_day >= end:
+            ranges = [('hour', start, end)]
+        merged = HyperLogLog(self.precision)
+        documents = SenderSketch._get_collection().find(
+            {'$or': [{'kind': kind, 'key': key, 'resolution': resolution,
+                      'bucket': {'$gte': low, '$lt': high}}
+                     for resolution, low, high in ranges if low < high]},
+            {'registers': 1})
+        for document in documents:
+            merged.merge(HyperLogLog.from_bytes(document['registers'],
+                                                self.precision))
+        with self._lock:
+            for (sketch_kind, sketch_key, resolution, bucket), sketch in \
+                    self._pending.items():
+                if sketch_kind == kind and sketch_key == key and \
+                        any(resolution == ranged and low <= bucket < high
+                            for ranged, low, high in ranges):
+                    merged.merge(sketch)
+        return merged.count()
+
+    def persist(self):
+        """
+        Merge in-memory sketches into stored sketches. A stored sketch is
+        replaced only if its version did not change since it was read, else
+        merging is retried, so concurrent processes do not lose senders.
+        :return: Number of persisted sketches.
+        """
+        with self._persist_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            collection = SenderSketch._get_collection()
+            persisted = 0
+            for sketch_key, sketch in pending.items():
+                kind, key, resolution, bucket = sketch_key
+                query = {'kind': kind, 'key': key, 'resolution': resolution,
+                         'bucket': bucket}
+                try:
+                    self._merge(collection, query, sketch)
+                    persisted += 1
+                except PyMongoError as e:
+                    self._failures += 1
+                    proc_logger.error('Unable to persist sender sketch. '
+                                      'Reason:{reason}'.format(reason=e))
+                    with self._lock:
+                        current = self._pending.get(sketch_key)
+                        self._pending[sketch_key] = sketch.merge(current) \
+                            if current is not None else sketch
+            self._persisted += persisted
+            return persisted
+
+    def _merge(self, collection, query, sketch):
+        for attempt in range(MAX_MERGE_ATTEMPTS):
+            document = collection.find_one(query, {'registers': 1,
+                                                   'version': 1})
+            if document is None:
+                try:
+                    collection.insert_one(dict(
+                        query, version=1,
+                        registers=Binary(sketch.to_bytes())))
+                    return
+                except DuplicateKeyError:
+                    self._conflicts += 1
+                    continue
+            merged = HyperLogLog.from_bytes(document['registers'],
+                                            self.precision).merge(sketch)
+            result = collection.update_one(
+                dict(query, version=document['version']),
+                {'$set': {'registers': Binary(merged.to_bytes())},
+                 '$inc': {'version': 1}})
+            if result.matched_count:
+                return
+            self._conflicts += 1
+        raise PyMongoError('Sketch updated concurrently {count} times.'
+                           .format(count=MAX_MERGE_ATTEMPTS))
+
+    def error(self):
+        """
+        :return: Relative standard error of estimates.
+        """
+        return 1.04 / math.sqrt(1 << self.precision)
+
+    def forget_bot(self, bot_id):
+        """
+        Remove sketches of a bot whose messages are deleted. Senders cannot
+        be removed from sketches of its chats.
+        :param bot_id: ID of the bot.
+        :return:
+        """
+        with self._lock:
+            for sketch_key in list(self._pending):
+                if sketch_key[:2] == ('bot', bot_id):
+                    del self._pending[sketch_key]
+        SenderSketch._get_collection().delete_many({'kind': 'bot',
+                                                    'key': bot_id})
+
+    def clear(self):
+        """
+        Remove all sketches e.g. after all messages are deleted.
+        :return:
+        """
+        with self._lock:
+            self._pending.clear()
+        SenderSketch._get_collection().delete_many({})
+
+    def start(self):
+        """
+        Start the background persisting thread if it is not running already.
+        :return:
+        """
+        self._worker.start()
+
+    def close(self):
+        """
+        Stop the background thread and persist in-memory sketches.
+        :return:
+        """
+        self._worker.close()
+        if self._pending:
+            self.persist()
+
+    def stats(self):
+        """
+        :return: Dictionary of unique sender metrics.
+        """
+        return {
+            'enabled': self.enabled,
+            'pending': len(self._pending),
+            'persisted': self._persisted,
+            'conflicts': self._conflicts,
+            'failures': self._failures
+        }
@@ -0,0 +1,189 @@
+"""
+This module contains the handler worker pool shared by all bots. Work is
+partitioned by (bot_id, chat_id), so updates of a chat are handled in order by
+the same worker while different chats are handled in parallel.
+"""
+
+import time
+import threading
+from Queue import Queue, Full
+from . import proc_logger
+
+
+class PartitionedWorkerPool(object):
+    """
+    Bounded pool of worker threads, each with its own FIFO queue. A task is
+    always queued to the worker its partition key hashes to. Submitting blocks
+    while the worker's queue is full.
+    :param workers: Number of worker threads.
+    :param queue_size: Maximum number of tasks queued per worker.
+    """
+
+    def __init__(self, workers=8, queue_size=1000):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues = []
+        self._threads = []
+        self._pending = {}              # Partition key -> queued tasks.
+        self._lock = threading.Lock()
+        # Notified when all queued tasks of a partition are handled.
+        self._settled = threading.Condition(self._lock)
+        self._running = False
+        # Metrics
+        self._processed = 0
+        self._failed = 0
+
+    def init_app(self, app):
+        """
+        Configure the pool from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        if not self._running:
+            self.workers = app.config.get('HANDLER_POOL_WORKERS', self.workers)
+            self.queue_size = app.config.get('HANDLER_POOL_QUEUE_SIZE',
+                                             self.queue_size)
+
+    def start(self):
+        """
+        Start the worker threads if they are not running already.
+        :return:
+        """
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._queues = [Queue(self.queue_size) for _ in
+                            range(self.workers)]
+            self._threads = []
+            for index, queue in enumerate(self._queues):
+                thread = threading.Thread(target=self._work, args=(queue,),
+                                          name='handler-worker-{0}'.format(
+                                              index))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, key, func, *args):
+        """
+        Queue func(*args) to the worker of given partition.
+        :param key: Partition key e.g. (bot_id, chat_id).
+        :param func: Callable to be executed.
+        :return:
+        """
+        self.start()
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+        self._queues[hash(key) % len(self._queues)].put((key, func, args))
+
+    def _work(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                queue.task_done()
+                break
+            key, func, args = task
+            try:
+                func(*args)
+                self._processed += 1
+            except Exception as e:
+                self._failed += 1
+                proc_logger.error('Handler for partition:{key} failed. Reason:'
+                                  '{reason}'.format(key=key, reason=e))
+            finally:
+                with self._settled:
+                    self._pending[key] -= 1
+                    if not self._pending[key]:
+                        del self._pending[key]
+                        self._settled.notify_all()
+                queue.task_done()
+
+    def join(self, timeout=None):
+        """
+        Wait until all queued tasks are handled. Workers still busy after
+        timeout (e.g. a handler stuck in a network call) are logged.
+        :param timeout: Maximum time (in seconds) to wait, None to wait until
+        the tasks are handled.
+        :return boolean: False if tasks were still queued after timeout.
+        """
+        if timeout is None:
+            for queue in list(self._queues):
+                queue.join()
+            return True
+        if self.wait(lambda key: True, timeout=timeout):
+            return True
+        busy = [thread.name for thread, queue in
+                zip(self._threads, self._queues) if queue.unfinished_tasks]
+        proc_logger.error('Handler workers:{names} did not finish their tasks '
+                          'within {timeout} seconds.'.format(
+                                names=', '.join(busy), timeout=timeout))
+        return False
+
+    def wait(self, match, timeout=None):
+        """
+        Wait until queued tasks of some partitions are handled, tasks of other
+        partitions which keep being submitted are not waited for.
+        :param match: Callable returning True for partition keys to wait for
+        e.g. lambda key: key[0] == bot_id.
+        :param timeout: Maximum time (in seconds) to wait, None to wait until
+        the tasks are handled.
+        :return boolean: False if tasks were still queued after timeout.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._settled:
+            while any(match(key) for key in self._pending):
+                if deadline is None:
+                    self._settled.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._settled.wait(remaining)
+        return True
+
+    def close(self, timeout=5):
+        """
+        Handle all queued tasks and stop the worker threads, waiting at most
+        timeout seconds. Workers which do not stop in time (e.g. a handler
+        stuck in a network call) are logged and left behind, they are daemon
+        threads and do not keep the process alive.
+        :param timeout: Maximum time (in seconds) to wait for the workers.
+        :return:
+        """
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        deadline = time.time() + timeout
+        for queue in self._queues:
+            try:
+                queue.put(None, timeout=max(deadline - time.time(), 0.01))
+            except Full:
+                pass                    # Worker is stuck, queue stays full.
+        stuck = []
+        for thread in self._threads:
+            thread.join(max(deadline - time.time(), 0))
+            if thread.is_alive():
+                stuck.append(thread.name)
+        if stuck:
+            proc_logger.error('Handler workers:{names} did not stop within '
+                              '{timeout} seconds.'.format(
+                                names=', '.join(stuck), timeout=timeout))
+
+    def stats(self, hot_partitions=10):
+        """
+        :param hot_partitions: Number of partitions with most queued tasks
+        to be reported.
+        :return: Dictionary containing queue depth per worker and partition.
+        """
+        with self._lock:
+            hot = sorted(self._pending.items(), key=lambda item: -item[1])
+        return {
+            'workers': len(self._queues),
+            'processed': self._processed,
+            'failed': self._failed,
+            'queue_depth': [queue.qsize() for queue in self._queues],
+            'hot_partitions': [{'bot_id': key[0], 'chat_id': key[1],
+                                'queued': count}
+                               for key, count in hot[:hot_partitions]]
+        }
@@ -0,0 +1,462 @@
+"""
+This module contains the write-behind buffer used by procedures.log_message.
+Instead of saving every logged message with its own database round trip,
+messages are collected in memory and written to MongoDB with a single bulk
+write once the buffer is full or the flush interval has elapsed.
+"""
+
+import time
+import threading
+from collections import deque
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError, AutoReconnect, \
+    ServerSelectionTimeoutError, NetworkTimeout, NotMasterError
+from botapp.models import Message
+from . import proc_logger
+
+# MongoDB error code for duplicate key violations.
+DUPLICATE_KEY_ERROR = 11000
+# Fields identifying a logged message.
+NATURAL_KEY = ('bot_id', 'chatid', 'msg_id')
+# Errors of the connection to the database, messages are spilled to the
+# journal until a write succeeds again. Other errors concern the written
+# documents or single requests.
+TRANSPORT_ERRORS = (AutoReconnect, ServerSelectionTimeoutError, NetworkTimeout,
+                    NotMasterError)
+
+
+def bulk_write_reason(error):
+    """
+    :param error: pymongo BulkWriteError object.
+    :return: Message of the first failed write, or of the write concern
+    errors if no write failed (e.g. a replica set did not acknowledge it).
+    """
+    if error.details.get('writeErrors'):
+        return error.details['writeErrors'][0].get('errmsg')
+    return '; '.join(item.get('errmsg', '') for item in
+                     error.details.get('writeConcernErrors', [])) or str(error)
+
+
+class MessageWriteBuffer(object):
+    """
+    Write-behind buffer for Message documents. Documents are flushed with an
+    ordered bulk write by a background thread when max_size documents are
+    queued or flush_interval seconds have passed since the last flush.
+    :param max_size: Number of queued messages which triggers a flush.
+    :param flush_interval: Maximum time (in seconds) a message stays queued.
+    :param max_retries: Number of flush attempts before a message is dropped.
+    :param spill_size: Number of queued messages above which new messages are
+    spilled to the journal.
+    """
+
+    def __init__(self, max_size=100, flush_interval=1.0, max_retries=3,
+                 spill_size=1000):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.spill_size = spill_size
+        self.enabled = True
+        # Spill journal (SpillJournal) receiving messages which can not be
+        # written to the database, if None such messages are retried/dropped.
+        self.journal = None
+        # Callables invoked with the list of documents written by a flush.
+        self.flush_listeners = []
+        # Callables invoked with the list of documents which are not queued
+        # anymore i.e. written, already present or dropped.
+        self.settle_listeners = []
+        self._queue = deque()               # (document, attempts) tuples.
+        self._queue_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._running = False
+        self._healthy = True            # Database reachable on last write.
+        # Metrics
+        self._flushes = 0
+        self._written = 0
+        self._duplicates = 0
+        self._dropped = 0
+        self._spilled = 0
+        self._last_error = None
+        self._last_flush_latency = 0.0
+        self._max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+
+    def init_app(self, app):
+        """
+        Configure the buffer from application configuration.
+        :param app: Flask application object.
+        :return:
+        """
+        self.enabled = app.config.get('MESSAGE_BUFFER_ENABLED', True)
+        self.max_size = app.config.get('MESSAGE_BUFFER_SIZE', self.max_size)
+        self.flush_interval = app.config.get('MESSAGE_BUFFER_FLUSH_INTERVAL',
+                                             self.flush_interval)
+        self.max_retries = app.config.get('MESSAGE_BUFFER_MAX_RETRIES',
+                                          self.max_retries)
+        self.spill_size = app.config.get('MESSAGE_BUFFER_SPILL_SIZE',
+                                         self.spill_size)
+
+    def attach_journal(self, journal):
+        """
+        Spill messages to given journal while the database is unavailable or
+        the buffer is saturated. Journaled messages are settled once they are
+        fsynced and replayed through the buffer's bulk write.
+        :param journal: SpillJournal object or None to detach the journal.
+        :return:
+        """
+        if self.journal is not None:
+            self.journal.durable_listeners.remove(self._journaled)
+        self.journal = journal
+        if journal is not None:
+            journal.writer = self.replay
+            journal.durable_listeners.append(self._journaled)
+
+    def put(self, message):
+        """
+        Validate a message and queue it for the next bulk write. If buffering
+        is disabled, the message is written immediately. If a journal is
+        attached, the message is spilled to it while the database is down or
+        the queue holds more than spill_size messages.
+        :param message: botapp.models.Message object.
+        :return:
+        :except mongoengine.ValidationError: If message is not valid.
+        """
+        message.validate()
+        document = message.to_mongo()
+        document.setdefault('_id', ObjectId())
+        if self.journal is not None and \
+                (not self._healthy or self.depth() >= self.spill_size):
+            self._spill([document])
+            return
+        if not self.enabled:
+            written, failed = self._write([(document, 0)])
+            if failed and self.journal is None:
+                raise ValueError('Unable to log message. Reason:{reason}'
+                                 .format(reason=self._last_error))
+            return
+        self.start()
+        with self._queue_lock:
+            self._queue.append((document, 0))
+            depth = len(self._queue)
+        if depth >= self.max_size:
+            self._wakeup.set()              # Flush without waiting.
+
+    def start(self):
+        """
+        Start the background flushing thread if it is not running already.
+        :return:
+        """
+        if self._running:
+            return
+        with self._flush_lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run,
+                                            name='message-write-buffer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        """
+        Stop the background thread and flush all queued messages.
+        :return:
+        """
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join(self.flush_interval + 5)
+        self._thread = None
+        self.flush()
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                proc_logger.error('Unexpected error while flushing message '
+                                  'buffer. Reason:{reason}'.format(reason=e))
+
+    def flush(self):
+        """
+        Write all queued messages to the database, max_size messages per bulk
+        write.
+        :return written: Number of messages written to the database.
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._queue_lock:
+                    batch = [self._queue.popleft() for _ in
+                             range(min(self.max_size, len(self._queue)))]
+                if not batch:
+                    break
+                if self.journal is not None and not self._healthy:
+                    # Database is down, replayer writes messages later.
+                    self._spill(doc for doc, _ in batch)
+                    continue
+                count, failed = self._write(batch)
+                written += count
+                if failed:
+                    break               # Retry remaining messages later.
+        return written
+
+    def replay(self, documents):
+        """
+        Write documents replayed from the journal.
+        :param documents: List of message documents.
+        :return boolean: True if all documents were written.
+        """
+        written, failed = self._write([(doc, 0) for doc in documents],
+                                      replay=True)
+        return not failed
+
+    def _write(self, batch, replay=False):
+        """
+        Write a batch of documents with an ordered bulk write. Messages with a
+        Telegram message ID are upserted on their natural key (bot_id, chatid,
+        msg_id), so messages which are already present are left untouched.
+        Documents before a failing document are already written. A duplicate
+        key error (same message inserted concurrently) skips the document and
+        the remaining documents are written again. A document rejected by
+        the database (e.g. a validation or document size error) is retried
+        alone up to max_retries times, or quarantined by the journal when
+        replayed, and the remaining documents are written again. Any other
+        failure puts the remaining documents back at the head of the queue
+        (or spills them to the journal). Only transport errors mark the
+        database as unavailable, which spills new messages to the journal.
+        :param batch: List of (document, attempts) tuples.
+        :param replay: Whether the documents are replayed from the journal,
+        failed documents are then left to the journal.
+        :return (written, failed): Number of written documents and whether the
+        batch could not be written completely (or a document was rejected).
+        """
+        collection = Message._get_collection()
+        written = []
+        settled = []
+        rejected = False
+        started = time.time()
+        while batch:
+            try:
+                result = collection.bulk_write(
+                    [self._write_request(doc) for doc, _ in batch],
+                    ordered=True)
+                written.extend(self._inserted(batch, len(batch),
+                                              result.upserted_ids))
+                settled.extend(doc for doc, _ in batch)
+                batch = []
+                self._healthy = True
+            except BulkWriteError as e:
+                self._healthy = True            # Database is reachable.
+                if not e.details.get('writeErrors'):
+                    # Only the write concern failed, the whole batch is
+                    # retried (upserts of written messages are no-ops).
+                    self._last_error = bulk_write_reason(e)
+                    proc_logger.warn('Write concern error while flushing '
+                                     'message buffer:{reason}'.format(
+                                        reason=self._last_error))
+                    if not replay:
+                        settled.extend(self._requeue(batch, self._last_error))
+                    break
+                error = e.details['writeErrors'][0]
+                index = error['index']
+                upserted = dict((item['index'], item['_id'])
+                                for item in e.details['upserted'])
+                written.extend(self._inserted(batch, index, upserted))
+                settled.extend(doc for doc, _ in batch[:index])
+                document, attempts = batch[index]
+                if error['code'] == DUPLICATE_KEY_ERROR:
+                    self._duplicates += 1
+                    proc_logger.warn('Skipped duplicate message:{doc_id} while'
+                                     ' flushing message buffer.'.format(
+                                        doc_id=document.get('msg_id')))
+                    settled.append(document)
+                elif replay:
+                    # Replaying it again would fail again, set it aside.
+                    self._last_error = error.get('errmsg')
+                    self.journal.quarantine([document], self._last_error)
+                elif self._reject(document, attempts, error.get('errmsg')):
+                    settled.append(document)
+                    # Caller of an immediate write reports the failure.
+                    rejected = rejected or not self.enabled
+                else:
+                    rejected = True         # Retried by the next flush.
+                # Documents after the failing one are written regardless.
+                batch = batch[index + 1:]
+            except TRANSPORT_ERRORS as e:
+                self._healthy = False
+                self._last_error = e
+                if not replay:
+                    settled.extend(self._requeue(batch, e))
+                break
+            except PyMongoError as e:
+                self._last_error = e
+                if not replay:
+                    settled.extend(self._requeue(batch, e))
+                break
+        self._record_flush(written, time.time() - started)
+        if not replay:              # Journaled documents are settled already.
+            self._notify(self.settle_listeners, settled)
+        return len(written), bool(batch) or rejected
+
+    @staticmethod
+    def _write_request(document):
+        """
+        :param document: Message document (SON) to be written.
+        :return: Bulk write operation inserting the document unless a message
+        with the same natural key is already present.
+        """
+        if document.get('msg_id') is None:
+            return InsertOne(document)
+        return UpdateOne(dict((key, document.get(key)) for key in NATURAL_KEY),
+                         {'$setOnInsert': document}, upsert=True)
+
+    def _inserted(self, batch, count, upserted_ids):
+        """
+        :param batch: List of (document, attempts) tuples written in bulk.
+        :param count: Number of documents at the head of batch which were
+        processed by the bulk write.
+        :param upserted_ids: Dictionary of batch indexes inserted by upserts.
+        :return: List of documents which were newly inserted. Documents
+        already present are counted as duplicates.
+        """
+        inserted = []
+        for index, (document, _) in enumerate(batch[:count]):
+            if document.get('msg_id') is None or index in upserted_ids:
+                inserted.append(document)
+            else:
+                self._duplicates += 1
+        return inserted
+
+    def _requeue(self, batch, reason):
+        """
+        Put documents back at the head of the queue (preserving their order)
+        or drop them if they already failed max_retries times. If a journal is
+        attached, documents are spilled to it instead.
+        :param batch: List of (document, attempts) tuples.
+        :param reason: Reason of the failure used for logging.
+        :return: List of dropped documents.
+        """
+        self._last_error = reason
+        if self.journal is not None:
+            self._spill(doc for doc, _ in batch)
+            return []
+        if not self.enabled:
+            return []               # Caller reports the failure.
+        retry = [(doc, attempts + 1) for doc, attempts in batch
+                 if attempts + 1 < self.max_retries]
+        dropped = len(batch) - len(retry)
+        if dropped:
+            self._dropped += dropped
+            proc_logger.error('Dropped {count} messages after {retries} failed'
+                              ' flush attempts. Reason:{reason}'.format(
+                                count=dropped, retries=self.max_retries,
+                                reason=reason))
+        if retry:
+            proc_logger.warn('Unable to flush {count} messages, retrying '
+                             'later. Reason:{reason}'.format(count=len(retry),
+                                                             reason=reason))
+            with self._queue_lock:
+                self._queue.extendleft(reversed(retry))
+        return [doc for doc, attempts in batch
+                if attempts + 1 >= self.max_retries]
+
+    def _reject(self, document, attempts, reason):
+        """
+        Put a document rejected by the database back at the head of the queue
+        or drop it if it already failed max_retries times. It is not spilled
+        to the journal, where it would be rejected on every replay.
+        :param document: Rejected message document.
+        :param attempts: Number of failed flush attempts of the document.
+        :param reason: Reason of the rejection used for logging.
+        :return boolean: True if the document was dropped.
+        """
+        self._last_error = reason
+        if self.enabled and attempts + 1 < self.max_retries:
+            proc_logger.warn('Message:{msg_id} rejected by the database, '
+                             'retrying later. Reason:{reason}'.format(
+                                msg_id=document.get('msg_id'), reason=reason))
+            with self._queue_lock:
+                self._queue.appendleft((document, attempts + 1))
+            return False
+        self._dropped += 1
+        proc_logger.error('Dropped message:{msg_id} of bot:{bot_id} rejected '
+                          'by the database. Reason:{reason}'.format(
+                            msg_id=document.get('msg_id'),
+                            bot_id=document.get('bot_id'), reason=reason))
+        return True
+
+    def _spill(self, documents):
+        documents = list(documents)
+        self.journal.append(documents)
+        self._spilled += len(documents)
+        proc_logger.warn('Spilled {count} messages to journal. Reason:'
+                         '{reason}'.format(count=len(documents),
+                                           reason=self._last_error if
+                                           not self._healthy else
+                                           'buffer saturated'))
+
+    def _journaled(self, documents):
+        self._notify(self.settle_listeners, documents)
+
+    def _record_flush(self, written, latency):
+        self._flushes += 1
+        self._written += len(written)
+        self._last_flush_latency = latency
+        self._max_flush_latency = max(self._max_flush_latency, latency)
+        self._total_flush_latency += latency
+        if not written:
+            return
+        proc_logger.debug('Flushed {count} messages in {ms:.1f}ms.'.format(
+            count=len(written), ms=latency * 1000))
+        self._notify(self.flush_listeners, written)
+
+    @staticmethod
+    def _notify(listeners, documents):
+        if not documents:
+            return
+        for listener in listeners:
+            try:
+                listener(documents)
+            except Exception as e:
+                proc_logger.error('Flush listener:{name} failed. Reason:'
+                                  '{reason}'.format(name=listener.__name__,
+                                                    reason=e))
+
+    def overloaded(self):
+        """
+        :return boolean: True if the attached journal exceeds its maximum
+        size, message ingestion should be paused.
+        """
+        return self.journal is not None and self.journal.overloaded()
+
+    def depth(self):
+        """
+        :return: Number of messages waiting to be written.
+        """
+        return len(self._queue)
+
+    def stats(self):
+        """
+        :return: Dictionary containing queue depth and flush metrics.
+        """
+        return {
+            'enabled': self.enabled,
+            'queue_depth': self.depth(),
+            'flushes': self._flushes,
+            'written': self._written,
+            'duplicates': self._duplicates,
+            'dropped': self._dropped,
+            'spilled': self._spilled,
+            'healthy': self._healthy,
+            'last_flush_latency_ms': round(self._last_flush_latency * 1000, 3),
+            'max_flush_latency_ms': round(self._max_flush_latency * 1000, 3),
+            'avg_flush_latency_ms': round(
+                self._total_flush_latency * 1000 / self._flushes, 3)
+            if self._flushes else 0.0
+        }
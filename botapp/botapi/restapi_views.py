@@ -1,10 +1,18 @@
 """
 Function calls for RestAPIs.
 """
-from flask import jsonify
-from botapp.api_helpers import procedures
+from datetime import datetime, timedelta
+from flask import jsonify, request, current_app, json, Response, \
+    stream_with_context
+from botapp.api_helpers import procedures, pagination, message_buffer, \
+    update_poller, handler_pool, offset_tracker, spill_journal, filter_cache, \
+    message_counters, message_rollups, heavy_hitters, unique_senders, \
+    trending_terms, sender_directory, bot_registry, forget_bot, \
+    clear_aggregates
+from botapp.api_helpers.result_cache import scope, ALL
 from botapp.botapi import botapi, botapi_logger
-from botapp.models import Message, MyBot
+from botapp.models import Message, MyBot, MessageRecord
+from botapp.exceptions import ValidationError
 from .errors import bad_request, internal_server_error
 
 
@@ -236,64 +244,216 @@ def stop_all_bots():
             message="No to stop previously running bots.")
 
 
+@botapi.route('/ingestion/stats', methods=['GET'])
+def ingestion_stats():
+    """
+    This function addresses RestAPI call to get metrics of the message
+    ingestion pipeline e.g. write buffer queue depth and flush latency.
+    :return:
+    """
+    return jsonify({
+        "result": "success",
+        "write_buffer": message_buffer.stats(),
+        "poller": update_poller.stats(),
+        "handler_pool": handler_pool.stats(),
+        "offsets": offset_tracker.stats(),
+        "journal": spill_journal.stats() if message_buffer.journal else None
+    }), 200
+
+
+@botapi.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    This function addresses RestAPI call to get metrics of the message
+    listing cache e.g. hit ratio and number of invalidations.
+    :return:
+    """
+    return jsonify({
+        "result": "success",
+        "filter_cache": filter_cache.stats()
+    }), 200
+
+
+@botapi.route('/bots', methods=['GET'])
+def list_bots():
+    """
+    This function addresses RestAPI call to get the inventory of registered
+    bots with number of messages logged by each bot, read from message
+    counters.
+    :return:
+    """
+    bots = bot_registry.bots()
+    counts = message_counters.counts('bot', [bot.bot_id for bot in bots])
+    return jsonify({
+        "result": "success",
+        "bots": [{
+            "bot_id": bot.bot_id,
+            "username": bot.username,
+            "first_name": bot.first_name,
+            "last_name": bot.last_name,
+            "test_bot": bot.test_bot,
+            "state": bot.state,
+            "messages": counts.get(str(bot.bot_id), 0)
+        } for bot in bots]
+    }), 200
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def stream_requested():
+    """
+    :return: True if messages should be streamed as newline delimited JSON,
+    requested with ?format=ndjson or an Accept header preferring
+    application/x-ndjson.
+    """
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def stream_messages(msgs, ranked=False):
+    """
+    Stream all messages, newest first, continuing after ?cursor= if given, as
+    newline delimited JSON (one message per line). Messages are fetched from
+    the database API_STREAM_BATCH_SIZE at a time as records and not cached,
+    so memory use does not depend on the number of messages.
+    :param msgs: Query Set of messages.
+    :param ranked: Messages are ordered by relevance, cursor is not used.
+    :return: Streamed response.
+    :except ValidationError: If cursor is invalid.
+    """
+    if not ranked:
+        try:
+            msgs = pagination.older_than(msgs, request.args.get('cursor'))
+        except ValueError as e:
+            raise ValidationError(e.args[0])
+    msgs = msgs.no_cache().batch_size(
+        current_app.config['API_STREAM_BATCH_SIZE'])
+    endpoint = request.endpoint
+
+    def generate():
+        count = 0
+        for msg in MessageRecord.fetch(msgs):
+            yield json.dumps(msg.to_json()) + '\n'
+            count += 1
+        botapi_logger.info('Successfully streamed {count} messages for '
+                           '{endpoint} api call.'.format(count=count,
+                                                         endpoint=endpoint))
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def messages_page(msgs, criteria, scopes, ranked=False):
+    """
+    Get a page of messages, newest first, continuing after ?cursor= (the
+    next cursor of the previous page). Page size is given by ?limit= and
+    capped at API_MAX_PAGE_SIZE. Pages are cached by filter_cache.
+    :param msgs: Query Set of messages.
+    :param criteria: Dictionary of criteria msgs were filtered by.
+    :param scopes: Cache scopes of msgs e.g. [scope('bot', 1)] or [ALL].
+    :param ranked: Messages are ordered by relevance, only the first page is
+    returned as these cannot be continued by date.
+    :return page: MessagePage object.
+    :except ValidationError: If cursor or limit is invalid.
+    """
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'],
+                             type=int)
+    if limit < 1:
+        raise ValidationError('limit should be a positive integer.')
+    limit = min(limit, current_app.config['API_MAX_PAGE_SIZE'])
+    cursor = request.args.get('cursor')
+
+    def fetch_page():
+        if ranked:
+            return pagination.MessagePage(list(MessageRecord.fetch(
+                msgs.limit(limit))))
+        try:
+            return pagination.seek(MessageRecord.project(msgs), limit,
+                                   cursor=cursor, record=MessageRecord)
+        except ValueError as e:
+            raise ValidationError(e.args[0])
+    criteria = dict(criteria, call=request.endpoint, limit=limit,
+                    cursor=cursor, ranked=ranked)
+    return filter_cache.get(criteria, scopes, fetch_page)
+
+
+def messages_response(page, msgs):
+    """
+    :param page: MessagePage object.
+    :param msgs: Query Set of all messages, counted with ?count=1 only.
+    :return: JSON response containing messages of page, cursor of the next
+    page (None on the last page) and number of all messages if requested.
+    Counting stops at MESSAGES_COUNT_LIMIT, count_exact is then False.
+    """
+    response = {
+        "result": "success",
+        "messages": [msg.to_json() for msg in page.items],
+        "next": page.next_cursor
+    }
+    if request.args.get('count', 0, type=int) > 0:
+        total = pagination.bounded_total(
+            msgs, current_app.config['MESSAGES_COUNT_LIMIT'])
+        response["count"] = total.value
+        response["count_exact"] = total.exact
+    return jsonify(response), 200
+
+
 @botapi.route('/<bot_id>/getBotMessages', methods=['GET'])
 def filter_messages_by_bot(bot_id=0):
     """
-    This call addresses RestAPI call to return all messages logged by given bot.
+    This call addresses RestAPI call to return messages logged by given bot,
+    one page (?cursor=, ?limit=) at a time.
     :param bot_id: Bot ID for Bot whose logged messages are requested.
     :return:
     """
     # Get messages
-    msgs = Message.objects(bot_id=bot_id).all().order_by('-date')
+    msgs = Message.objects(bot_id=bot_id)
+    if stream_requested():
+        return stream_messages(msgs)
+    page = messages_page(msgs, {'bot_id': bot_id}, [scope('bot', bot_id)])
     botapi_logger.info('Successfully returned {count} messages logged by {bid}'
                        'filter_messages_by_botid api call.'.format(
-                        count=len(msgs), bid=bot_id))
-    if msgs is not None:
-        return jsonify({
-            "result": "success",
-            "messages": [msg.to_json() for msg in msgs] if len(msgs) > 0 else []
-        }), 200
+                        count=len(page.items), bid=bot_id))
+    return messages_response(page, msgs)
 
 
 @botapi.route('/<username>/getUserMessages', methods=['GET'])
 def filter_messages_by_username(username):
     """
-    This call addresses RestAPI call to return all messages logged from by
-    requested username.
+    This call addresses RestAPI call to return messages logged from by
+    requested username, one page (?cursor=, ?limit=) at a time.
     :param username: Sender's username.
     :return:
     """
     # Get messages
-    msgs = Message.objects(sender_username__iexact=username)\
-                  .all().order_by('-date')
+    msgs = Message.objects(sender_username_lower=username.lower())
+    if stream_requested():
+        return stream_messages(msgs)
+    page = messages_page(msgs, {'username': username}, [ALL])
     botapi_logger.info('Successfully returned {count} messages sent by {uname}'
                        'filter_messages_by_username api call.'.format(
-                        count=len(msgs), uname=username))
-    if msgs is not None:
-        return jsonify({
-            "result": "success",
-            "messages": [msg.to_json() for msg in msgs] if len(msgs) > 0 else []
-        }), 200
+                        count=len(page.items), uname=username))
+    return messages_response(page, msgs)
 
 
 @botapi.route('/<chatid>/getMessages', methods=['GET'])
 def filter_messages_by_chatid(chatid):
     """
-    This call addresses RestAPI call to return all messages logged for a
-    given chat.
+    This call addresses RestAPI call to return messages logged for a given
+    chat, one page (?cursor=, ?limit=) at a time.
     :param chatid: Telegram chat id for the chat in question.
     :return:
     """
     # Get messages
-    msgs = Message.objects(chatid=chatid).all().order_by('-date')
+    msgs = Message.objects(chatid=chatid)
+    if stream_requested():
+        return stream_messages(msgs)
+    page = messages_page(msgs, {'chat_id': chatid}, [scope('chat', chatid)])
     botapi_logger.info('Successfully returned {count} messages logged in chat:'
                        '{chatid} filter_messages_by_chatid api call.'.format(
-                        count=len(msgs), chatid=chatid))
-    if msgs is not None:
-        return jsonify({
-            "result": "success",
-            "messages": [msg.to_json() for msg in msgs] if len(msgs) > 0 else []
-        }), 200
+                        count=len(page.items), chatid=chatid))
+    return messages_response(page, msgs)
 
 
 @botapi.route(
@@ -301,14 +461,28 @@ def filter_messages_by_chatid(chatid):
     methods=['GET'])
 def filter_messages(botid, time_off, text, username, name):
     """
-    This function filters the logged messages based on given criteria.
+    This function filters the logged messages based on given criteria,
+    returning one page (?cursor=, ?limit=) at a time.
     :param time_off: Time (in minutes) for filtering messages by date.
     :param botid: ID of bot from which message was received.
-    :param text: Message text (partially matched.)
+    :param text: Message text (words or "phrase" matched, partially matched
+    with ?text_mode=substring.) Messages are ordered by relevance with ?rank=1
+    (first page only).
     :param username: Senders username (exactly matched.)
-    :param name: Sender's firstname or lastname (partially matched.)
+    :param name: Sender's firstname or lastname (words prefix matched,
+    whole words matched with ?name_mode=token, partially matched with
+    ?name_mode=substring.)
     :return:
     """
+    text_mode = request.args.get('text_mode', 'text')
+    if text_mode not in procedures.TEXT_MODES:
+        return bad_request(message='text_mode should be one of: {modes}'
+                           .format(modes=', '.join(procedures.TEXT_MODES)))
+    name_mode = request.args.get('name_mode', 'prefix')
+    if name_mode not in procedures.NAME_MODES:
+        return bad_request(message='name_mode should be one of: {modes}'
+                           .format(modes=', '.join(procedures.NAME_MODES)))
+    rank = request.args.get('rank', 0, type=int) > 0
     # Resolve wildcards
     username = username
     botid = botid if botid > 0 else None
@@ -316,10 +490,190 @@ def filter_messages(botid, time_off, text, username, name):
     name = name
     # Get filtered messages.
     msgs = procedures.filter_messages(time_min=time_off, botid=botid,
-                                      text=text, username=username, name=name)
+                                      text=text, username=username, name=name,
+                                      text_mode=text_mode, rank=rank,
+                                      name_mode=name_mode)
+    ranked = rank and text not in (None, '#') and text_mode == 'text'
+    if stream_requested():
+        return stream_messages(msgs, ranked=ranked)
+    page = messages_page(msgs, {'bot_id': botid, 'time_off': time_off,
+                                'text': text, 'username': username,
+                                'name': name, 'text_mode': text_mode,
+                                'name_mode': name_mode},
+                         [scope('bot', botid)] if botid else [ALL],
+                         ranked=ranked)
+    return messages_response(page, msgs)
+
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+
+
+def time_arg(name, default):
+    """
+    :param name: Name of the query argument e.g. 'start'.
+    :param default: datetime object used if the argument is not given.
+    :return: datetime object of the argument, e.g. 2016-10-01T12:30
+    :except ValidationError: If the argument is not a valid time.
+    """
+    value = request.args.get(name)
+    if not value:
+        return default
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValidationError('{name} should be a time formatted as '
+                          'YYYY-MM-DDTHH:MM[:SS] or YYYY-MM-DD.'.format(
+                            name=name))
+
+
+@botapi.route('/<int:botid>/activity', methods=['GET'])
+def bot_activity(botid):
+    """
+    This function addresses RestAPI call to get the number of messages
+    logged by given bot per minute, hour or day (?resolution=, hour by
+    default) between ?start= and ?end= (last 24 hours by default), of all
+    chats or of ?chat_id= only. Counts are read from message rollups, empty
+    buckets are omitted.
+    :param botid: ID of the bot.
+    :return:
+    """
+    end = time_arg('end', datetime.now())
+    start = time_arg('start', end - timedelta(days=1))
+    if start >= end:
+        raise ValidationError('start should be before end.')
+    resolution = request.args.get('resolution', 'hour')
+    chatid = request.args.get('chat_id', None, type=int)
+    try:
+        series = message_rollups.series(botid, start, end,
+                                        resolution=resolution, chatid=chatid)
+    except ValueError as e:
+        raise ValidationError(e.args[0])
+    return jsonify({
+        "result": "success",
+        "bot_id": botid,
+        "chat_id": chatid,
+        "resolution": resolution,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "series": [{"time": bucket.isoformat(), "count": count}
+                   for bucket, count in series]
+    }), 200
+
+
+@botapi.route('/<int:botid>/top/<dimension>', methods=['GET'])
+def bot_top(botid, dimension):
+    """
+    This function addresses RestAPI call to get the approximate top ?k=
+    (10 by default) senders or chats of given bot over the last
+    HEAVY_HITTERS_WINDOW seconds. The true count of each entry is between
+    count - error and count, entries not listed occurred at most others_max
+    times.
+    :param botid: ID of the bot.
+    :param dimension: 'senders' or 'chats'.
+    :return:
+    """
+    if dimension not in ('senders', 'chats'):
+        raise ValidationError('dimension should be one of: senders, chats')
+    k = request.args.get('k', 10, type=int)
+    if k < 1:
+        raise ValidationError('k should be a positive integer.')
+    top = heavy_hitters.top(botid, dimension[:-1], k=k)
+    return jsonify(dict(top, result="success", bot_id=botid,
+                        dimension=dimension,
+                        window=heavy_hitters.window)), 200
+
+
+@botapi.route('/<int:botid>/uniqueSenders', methods=['GET'])
+def bot_unique_senders(botid):
+    """
+    This function addresses RestAPI call to get the estimated number of
+    unique senders of given bot, or of its chat ?chat_id=, between ?start=
+    and ?end= (last 24 hours by default, rounded to whole hours). Estimates
+    are merged from sender sketches, error is their relative standard
+    error.
+    :param botid: ID of the bot.
+    :return:
+    """
+    end = time_arg('end', datetime.now())
+    start = time_arg('start', end - timedelta(days=1))
+    if start >= end:
+        raise ValidationError('start should be before end.')
+    chatid = request.args.get('chat_id', None, type=int)
+    if chatid is None:
+        estimate = unique_senders.estimate('bot', botid, start, end)
+    else:
+        estimate = unique_senders.estimate('chat', chatid, start, end)
     return jsonify({
         "result": "success",
-        "messages": [msg.to_json() for msg in msgs] if len(msgs) > 0 else []
+        "bot_id": botid,
+        "chat_id": chatid,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "unique_senders": estimate,
+        "error": round(unique_senders.error(), 4)
+    }), 200
+
+
+@botapi.route('/trending', methods=['GET'])
+def trending():
+    """
+    This function addresses RestAPI call to get the top ?k= (10 by default)
+    trending words and phrases of messages of all bots, or of bot ?bot_id=,
+    in the current TRENDING_WINDOW. Terms are ranked by score, their count
+    in the window relative to their (decayed) count in previous windows.
+    :return:
+    """
+    k = request.args.get('k', 10, type=int)
+    if k < 1:
+        raise ValidationError('k should be a positive integer.')
+    bot_id = request.args.get('bot_id', None, type=int)
+    return jsonify({
+        "result": "success",
+        "bot_id": bot_id,
+        "window": trending_terms.window,
+        "terms": trending_terms.trending(bot_id=bot_id, k=k)
+    }), 200
+
+
+@botapi.route('/typeahead', methods=['GET'])
+def typeahead():
+    """
+    This function addresses RestAPI call to look up sender (?kind=senders,
+    default) or bot (?kind=bots) usernames starting with ?q= (case
+    insensitive), up to ?limit= (TYPEAHEAD_LIMIT by default) in username
+    order. Senders are read from the sender directory, bots from the bot
+    registry.
+    :return:
+    """
+    kind = request.args.get('kind', 'senders')
+    if kind not in ('senders', 'bots'):
+        raise ValidationError('kind should be one of: senders, bots')
+    prefix = request.args.get('q', '').strip()
+    limit = request.args.get('limit', current_app.config['TYPEAHEAD_LIMIT'],
+                             type=int)
+    if limit < 1:
+        raise ValidationError('limit should be a positive integer.')
+    limit = min(limit, current_app.config['API_MAX_PAGE_SIZE'])
+    if kind == 'senders':
+        matches = [{'username': sender['username'],
+                    'messages': sender['messages'],
+                    'last_seen': sender['last_seen'].isoformat()
+                    if sender.get('last_seen') else None}
+                   for sender in sender_directory.lookup(prefix, limit)]
+    else:
+        bots = sorted((bot for bot in bot_registry.bots()
+                       if (bot.username_lower or '').startswith(
+                           prefix.lower())),
+                      key=lambda bot: bot.username_lower)
+        matches = [{'bot_id': bot.bot_id, 'username': bot.username}
+                   for bot in bots[:limit]]
+    return jsonify({
+        "result": "success",
+        "kind": kind,
+        "q": prefix,
+        "matches": matches
     }), 200
 
 
@@ -330,6 +684,7 @@ def delete_all_bots():
     :return:
     """
     deleted = MyBot.objects.delete()
+    bot_registry.changed()
     botapi_logger.info('Successfully deleted {count} bots for delete_all_bots '
                        'api call'.format(count=deleted))
     return jsonify({
@@ -346,6 +701,8 @@ def delete_all_messages():
     :return:
     """
     deleted = Message.objects.delete()
+    filter_cache.clear()
+    clear_aggregates()
     botapi_logger.info('Successfully deleted {count} messages for '
                        'delete_all_messages api call'.format(count=deleted))
     return jsonify({
@@ -380,7 +737,13 @@ def gen_dummy_msgs(count=100):
     :param count: number of dummy messages to be generated.
     :return:
     """
-    Message.generate_fake(entries=count)            # Generate dummy messages.
+    # Generate dummy messages, counted like messages written by the buffer.
+    documents = [message.to_mongo() for message in
+                 Message.generate_fake(entries=count)]
+    filter_cache.clear()
+    message_counters.record(documents)
+    message_rollups.record(documents)
+    sender_directory.record(documents)
     botapi_logger.info('Successfully generated {count} dummy messages for '
                        'gen_dummy_msgs api call'.format(count=count))
     return jsonify({
@@ -398,10 +761,12 @@ def delete_bot_and_message_by_id(botid):
     :param botid: ID of the bot which needs to be removed.
     :return:
     """
-    bot = MyBot.objects(bot_id=botid).first()
+    bot = bot_registry.get(botid)
     if bot:
         bot.delete()
+        forget_bot(botid)
         messages = Message.objects(bot_id=botid).delete()
+        filter_cache.clear()
         botapi_logger.info('Successfully deleted bot:{uname} and {count} '
                            'messages logged by it, via delete_bot_and_message'
                            '_by_id api call'.format(uname=bot.username,
@@ -425,7 +790,7 @@ def delete_only_bot_by_id(botid):
     :param botid: ID of the bot which needs to be removed.
     :return:
     """
-    bot = MyBot.objects(bot_id=botid).first()
+    bot = bot_registry.get(botid)
     if bot:
         bot.delete()
         botapi_logger.info('Successfully deleted bot:{uname} by '
@@ -451,10 +816,12 @@ def delete_bot_and_message_by_uname(username):
     :param username: Username of the bot which needs to be removed.
     :return:
     """
-    bot = MyBot.objects(username=username).first()
-    if bot:
+    bot = bot_registry.by_username(username)
+    if bot and bot.username == username:
         bot.delete()
+        forget_bot(bot.bot_id)
         messages = Message.objects(bot_id=bot.bot_id).delete()
+        filter_cache.clear()
         botapi_logger.info('Successfully deleted bot:{uname} and {count} '
                            'messages logged by it, via delete_bot_and_message_'
                            '_by_uname api call'.format(uname=bot.username,
@@ -479,8 +846,8 @@ def delete_only_bot_by_uname(username):
     :param username: Username of the bot which needs to be removed.
     :return:
     """
-    bot = MyBot.objects(username=username).first()
-    if bot:
+    bot = bot_registry.by_username(username)
+    if bot and bot.username == username:
         bot.delete()
         botapi_logger.info('Successfully deleted bot:{uname} by '
                            'delete_only_bot_by_uname api call'.format(
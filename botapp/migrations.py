@@ -0,0 +1,153 @@
+"""
+Module containing data migrations for existing MongoDB collections. These are
+invoked from manage.py commands.
+"""
+import logging
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+from botapp.models import MyBot, Message, MessageCounter, MessageRollup, \
+    HeavyHitterCheckpoint, SenderSketch, Sender, name_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_message_keys(batch_size=1000):
+    """
+    Migrate messages stored with the old SequenceField primary key (i.e. _id
+    holding the Telegram message ID) to ObjectId primary keys with the message
+    ID stored in msg_id. Messages are upserted on the natural key (bot_id,
+    chatid, msg_id) so repeated copies of a message are dropped. Messages
+    overwritten by the old key scheme before migration cannot be recovered.
+    The obsolete sequence counter is removed and indexes are rebuilt.
+    :param batch_size: Number of messages migrated per bulk write.
+    :return (migrated, duplicates): Number of migrated messages and number of
+    redundant copies removed.
+    """
+    collection = Message._get_collection()
+    old_keys = {'_id': {'$not': {'$type': 7}}}     # 7: ObjectId
+    migrated = duplicates = 0
+    while True:
+        docs = list(collection.find(old_keys).limit(batch_size))
+        if not docs:
+            break
+        requests = []
+        for doc in docs:
+            doc['msg_id'] = doc.pop('_id')
+            doc.setdefault('bot_id', 0)
+            doc.setdefault('chatid', 0)
+            requests.append(UpdateOne({'bot_id': doc['bot_id'],
+                                       'chatid': doc['chatid'],
+                                       'msg_id': doc['msg_id']},
+                                      {'$setOnInsert': doc}, upsert=True))
+        result = collection.bulk_write(requests, ordered=False)
+        collection.delete_many({'_id': {'$in': [doc['msg_id']
+                                                for doc in docs]}})
+        migrated += result.upserted_count
+        duplicates += len(docs) - result.upserted_count
+        logger.info('Migrated {count} messages to natural keys.'.format(
+            count=migrated))
+    # Sequence counter used by the old msg_id field is not needed anymore.
+    collection.database['mongoengine.counters'].delete_one(
+        {'_id': 'message.msg_id'})
+    Message.ensure_indexes()
+    return migrated, duplicates
+
+
+def backfill_lowercase_usernames(batch_size=1000):
+    """
+    Set lowercase shadow fields (MyBot.username_lower and
+    Message.sender_username_lower) for documents saved before these fields
+    were introduced, so case insensitive lookups find them.
+    :param batch_size: Number of documents updated per bulk write.
+    :return (bots, messages): Number of updated bots and messages.
+    """
+    return (_backfill_lowercase(MyBot, 'username', batch_size),
+            _backfill_lowercase(Message, 'sender_username', batch_size))
+
+
+def _backfill_lowercase(document, field, batch_size):
+    collection = document._get_collection()
+    shadow = field + '_lower'
+    missing = {field: {'$type': 2}, shadow: {'$exists': False}}  # 2: string
+    updated = 0
+    while True:
+        docs = list(collection.find(missing, {field: True}).limit(batch_size))
+        if not docs:
+            break
+        collection.bulk_write([UpdateOne({'_id': doc['_id']},
+                                         {'$set': {shadow: doc[field].lower()}})
+                               for doc in docs], ordered=False)
+        updated += len(docs)
+        logger.info('Set {field} for {count} documents of {name}.'.format(
+            field=shadow, count=updated, name=collection.name))
+    return updated
+
+
+def backfill_name_tokens(batch_size=1000):
+    """
+    Set Message.sender_name_tokens for messages saved before the field was
+    introduced, so indexed sender name search finds them.
+    :param batch_size: Number of messages updated per bulk write.
+    :return updated: Number of updated messages.
+    """
+    collection = Message._get_collection()
+    missing = {'sender_name_tokens': {'$exists': False},
+               '$or': [{'sender_firstname': {'$type': 2}},     # 2: string
+                       {'sender_lastname': {'$type': 2}}]}
+    fields = {'sender_firstname': True, 'sender_lastname': True}
+    updated = 0
+    while True:
+        docs = list(collection.find(missing, fields).limit(batch_size))
+        if not docs:
+            break
+        collection.bulk_write([UpdateOne(
+            {'_id': doc['_id']},
+            {'$set': {'sender_name_tokens': name_tokens(
+                doc.get('sender_firstname'), doc.get('sender_lastname'))}})
+            for doc in docs], ordered=False)
+        updated += len(docs)
+        logger.info('Set sender_name_tokens for {count} messages.'.format(
+            count=updated))
+    return updated
+
+
+def build_indexes(documents=(MyBot, Message, MessageCounter,
+                             MessageRollup, HeavyHitterCheckpoint,
+                             SenderSketch, Sender)):
+    """
+    Build indexes declared in the meta of given documents. Indexes are built
+    in the background, so the collections stay available meanwhile.
+    :param documents: Document classes whose indexes are built.
+    :return indexes: Dictionary of collection name and its index names.
+    """
+    indexes = {}
+    for document in documents:
+        document.ensure_indexes()
+        collection = document._get_collection()
+        indexes[collection.name] = sorted(collection.index_information())
+        logger.info('Indexes of {name}: {indexes}'.format(
+            name=collection.name, indexes=', '.join(indexes[collection.name])))
+    return indexes
+
+
+def index_usage(document):
+    """
+    Get usage of a collection's indexes from $indexStats. Counters are kept
+    per server process and reset when the server restarts.
+    :param document: Document class.
+    :return usage: List of dictionaries (name, key, ops, since) ordered by
+    number of operations which used the index, None if $indexStats is not
+    supported by the server.
+    """
+    collection = document._get_collection()
+    try:
+        stats = list(collection.aggregate([{'$indexStats': {}}]))
+    except OperationFailure as e:
+        logger.warn('Unable to get index usage of {name}. Reason:{reason}'
+                    .format(name=collection.name, reason=e))
+        return None
+    usage = [{'name': stat['name'],
+              'key': list(stat['key'].items()),
+              'ops': stat['accesses']['ops'],
+              'since': stat['accesses']['since']} for stat in stats]
+    return sorted(usage, key=lambda index: index['ops'])
@@ -1,6 +1,7 @@
 """
 Modules containing database models for MyBot and Message objects
 """
+import re
 import random
 import logging
 from datetime import datetime, timedelta
@@ -14,6 +15,23 @@ logging.basicConfig(level=logging.DEBUG,
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Separators between tokens of a sender name e.g. spaces, dashes, dots.
+NAME_SEPARATORS = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def name_tokens(*names):
+    """
+    Normalize names into lowercase tokens, used for indexed sender name search.
+    :param names: Names e.g. firstname and lastname, None values are skipped.
+    :return tokens: Sorted list of distinct tokens.
+    """
+    tokens = set()
+    for name in names:
+        if isinstance(name, basestring):
+            tokens.update(token for token in
+                          NAME_SEPARATORS.split(name.lower()) if token)
+    return sorted(tokens)
+
 
 class MyBot(db.Document):
     """
@@ -30,15 +48,48 @@ class MyBot(db.Document):
     """
     token = db.StringField(max_length=64, unique=True, required=True)
     username = db.StringField(max_length=64, unique=True)
+    # Lowercase username for case insensitive lookups, set by clean().
+    username_lower = db.StringField(max_length=64)
     bot_id = db.SequenceField(primary_key=True)
     test_bot = db.BooleanField(default=False)
     state = db.BooleanField(default=False)
+    # Secret URL path on which Telegram delivers updates in webhook mode.
+    webhook_secret = db.StringField(max_length=64)
+    # Last update ID for which the update and the message it logged are
+    # confirmed, polling resumes after it.
+    last_update_id = db.IntField(default=0)
 
     meta = {
-        'indexes': ['#token'],
+        'indexes': ['#token',
+                    {'fields': ['webhook_secret'], 'unique': True,
+                     'sparse': True},
+                    'username_lower'],
         'index_background': True
     }
 
+    # Callables notified with the bot after it is saved or deleted e.g. to
+    # keep cached bots coherent. Queryset updates and deletes bypass them.
+    change_listeners = []
+
+    def save(self, *args, **kwargs):
+        bot = super(MyBot, self).save(*args, **kwargs)
+        for listener in MyBot.change_listeners:
+            listener(self)
+        return bot
+
+    def delete(self, *args, **kwargs):
+        super(MyBot, self).delete(*args, **kwargs)
+        for listener in MyBot.change_listeners:
+            listener(self)
+
+    def clean(self):
+        """
+        Keep lowercase username in sync, called by validate() before saving.
+        Invalid usernames are reported by field validation afterwards.
+        """
+        self.username_lower = self.username.lower() \
+            if isinstance(self.username, basestring) else None
+
     @staticmethod
     def generate_fake(entries=10):
         import forgery_py
@@ -60,16 +111,58 @@ class Message(db.Document):
     """
     Document blueprint for storing Telegram.Message (text message)
     information in MongoDB collection.
+    Telegram message IDs are only unique within a chat, therefore messages are
+    identified by the natural key (bot_id, chatid, msg_id) instead of msg_id
+    alone. Messages logged twice (e.g. redelivered updates) are upserted as
+    no-ops. Documents without msg_id (e.g. generated ones) are not part of the
+    unique index.
     """
-    msg_id = db.SequenceField(primary_key=True)
+    msg_id = db.IntField()
     date = db.DateTimeField(default=datetime.now())
     sender_username = db.StringField()
+    # Lowercase sender username for case insensitive lookups, set by clean().
+    sender_username_lower = db.StringField()
     sender_firstname = db.StringField()
     sender_lastname = db.StringField()
+    # Lowercase tokens of sender firstname and lastname, set by clean().
+    sender_name_tokens = db.ListField(db.StringField())
     chatid = db.IntField(default=0)
     text_content = db.StringField()
     bot_id = db.IntField(default=0)
 
+    # Messages are always returned newest first (ties broken by -id for
+    # keyset pagination), so every query shape has an index ending with
+    # -date, -id which serves both the filter and the sort:
+    # getBotMessages/filter_messages by bot, getMessages by chat,
+    # getUserMessages by sender and filter_messages by date only. Sender name
+    # tokens (multikey) serve prefix and whole-token name search. The text
+    # index serves word/phrase search of message text (no stemming, messages
+    # are not in a single language).
+    meta = {
+        'indexes': [
+            {'fields': ('bot_id', 'chatid', 'msg_id'), 'unique': True,
+             'partialFilterExpression': {'msg_id': {'$exists': True}}},
+            ('bot_id', '-date', '-id'),
+            ('chatid', '-date', '-id'),
+            ('sender_username_lower', '-date', '-id'),
+            ('sender_name_tokens', '-date', '-id'),
+            ('-date', '-id'),
+            {'fields': ['$text_content'], 'default_language': 'none'}
+        ],
+        'index_background': True
+    }
+
+    def clean(self):
+        """
+        Keep lowercase sender username and sender name tokens in sync, called
+        by validate() before saving and before messages are queued by the
+        write buffer.
+        """
+        self.sender_username_lower = self.sender_username.lower() \
+            if isinstance(self.sender_username, basestring) else None
+        self.sender_name_tokens = name_tokens(self.sender_firstname,
+                                              self.sender_lastname)
+
     def to_json(self):
         return {
             'message_id': self.msg_id,
@@ -89,16 +182,16 @@ class Message(db.Document):
         This function is only advised to be used to generate dummy data during
         testing.
         :param entries: Number of fake messages to be generated.
-        :return:
+        :return: List of generated Message objects.
         """
         import forgery_py
         from mongoengine import ValidationError, NotUniqueError
-        fakes = 0
+        fakes = []
         if MyBot.objects.count() == 0:
             MyBot.generate_fake(entries/5)
-        while fakes < entries:
+        while len(fakes) < entries:
             try:
-                Message(msg_id=random.randint(1, 100000),
+                message = Message(msg_id=random.randint(1, 100000),
                         date=(datetime.now()-timedelta(hours=2)) -
                         timedelta(hours=48),        # Between last 2-48hours.
                         sender_username=forgery_py.internet
@@ -109,6 +202,164 @@ class Message(db.Document):
                         text_content=forgery_py.lorem_ipsum.sentence(),
                         bot_id=random.choice(
                             MyBot.objects().all().values_list('bot_id'))).save()
-                fakes += 1
+                fakes.append(message)
             except (ValidationError, NotUniqueError, Exception):
                 pass                    # Do nothing in case of any exception.
+        return fakes
+
+
+class MessageCounter(db.Document):
+    """
+    Number of messages logged for a bot, chat or sender, maintained with
+    atomic increments when messages are written. A counter is split into
+    shards, so concurrent increments for a busy bot update different
+    documents; its value is the sum of its shards.
+    """
+    kind = db.StringField(required=True)        # 'bot', 'chat' or 'sender'
+    key = db.StringField(required=True)         # Bot ID, chat ID, username.
+    shard = db.IntField(default=0)
+    count = db.IntField(default=0)
+
+    meta = {
+        'indexes': [{'fields': ('kind', 'key', 'shard'), 'unique': True}],
+        'index_background': True
+    }
+
+
+class MessageRollup(db.Document):
+    """
+    Number of messages of a chat logged by a bot within a time bucket, a
+    minute or an hour starting at bucket. Recent messages are counted in
+    minute buckets, which are folded into hour buckets by compaction.
+    """
+    bot_id = db.IntField(required=True)
+    chatid = db.IntField(required=True)
+    resolution = db.StringField(required=True)  # 'minute' or 'hour'
+    bucket = db.DateTimeField(required=True)    # Start of the bucket.
+    count = db.IntField(default=0)
+    # ID of the compaction folding the minute bucket and the time it was
+    # claimed, set while folding.
+    compaction = db.ObjectIdField()
+    claimed_at = db.DateTimeField()
+    # IDs of minute buckets folded into the hour bucket.
+    folded = db.ListField(db.ObjectIdField())
+
+    meta = {
+        'indexes': [
+            {'fields': ('bot_id', 'chatid', 'resolution', 'bucket'),
+             'unique': True},
+            ('bot_id', 'resolution', 'bucket'),
+            ('resolution', 'bucket')
+        ],
+        'index_background': True
+    }
+
+
+class HeavyHitterCheckpoint(db.Document):
+    """
+    Space-Saving sketches counting messages of a bot by sender or chat, one
+    sketch per slice of the sliding window. Version is incremented by every
+    update, which is made only if the version did not change since the
+    sketches were read.
+    """
+    bot_id = db.IntField(required=True)
+    dimension = db.StringField(required=True)   # 'sender' or 'chat'
+    # Dictionaries of slice start, total and [key, count, error] counters.
+    slices = db.ListField(db.DictField())
+    version = db.IntField(default=0)
+
+    meta = {
+        'indexes': [{'fields': ('bot_id', 'dimension'), 'unique': True}],
+        'index_background': True
+    }
+
+
+class SenderSketch(db.Document):
+    """
+    HyperLogLog registers of senders of a bot or chat within an hour or a
+    day starting at bucket. Version is incremented by every update, which is
+    made only if the version did not change since the registers were read.
+    """
+    kind = db.StringField(required=True)        # 'bot' or 'chat'
+    key = db.IntField(required=True)            # Bot ID or chat ID.
+    resolution = db.StringField(required=True)  # 'hour' or 'day'
+    bucket = db.DateTimeField(required=True)
+    registers = db.BinaryField()
+    version = db.IntField(default=1)
+
+    meta = {
+        'indexes': [{'fields': ('kind', 'key', 'resolution', 'bucket'),
+                     'unique': True}],
+        'index_background': True
+    }
+
+
+class Sender(db.Document):
+    """
+    Entry of the sender directory, a username messages were received from,
+    maintained when messages are written.
+    """
+    username_lower = db.StringField(required=True)
+    username = db.StringField()
+    messages = db.IntField(default=0)
+    last_seen = db.DateTimeField()
+
+    meta = {
+        # Prefix (^...) lookups of usernames are served by the unique index.
+        'indexes': [{'fields': ['username_lower'], 'unique': True}],
+        'index_background': True
+    }
+
+
+class RegistryVersion(db.Document):
+    """
+    Version stamp of a cached collection (e.g. 'mybot'), incremented on every
+    change so that processes caching the collection notice it and reload.
+    """
+    name = db.StringField(primary_key=True)
+    version = db.IntField(default=0)
+
+
+class MessageRecord(object):
+    """
+    Read-only message built from a raw document, used for listing messages
+    without constructing Message documents (no field conversion, validation
+    or change tracking). Attributes are the same as those of Message.
+    :param doc: Dictionary of a message document projected on FIELDS.
+    """
+    # Message fields loaded for records.
+    FIELDS = ('id', 'msg_id', 'date', 'chatid', 'sender_username',
+              'sender_firstname', 'sender_lastname', 'text_content', 'bot_id')
+    __slots__ = FIELDS
+
+    def __init__(self, doc):
+        get = doc.get
+        self.id = get('_id')
+        self.msg_id = get('msg_id')
+        self.date = get('date')
+        self.chatid = get('chatid', 0)
+        self.sender_username = get('sender_username')
+        self.sender_firstname = get('sender_firstname')
+        self.sender_lastname = get('sender_lastname')
+        self.text_content = get('text_content')
+        self.bot_id = get('bot_id', 0)
+
+    # JSON representation is the same as that of Message.
+    to_json = Message.to_json.im_func
+
+    @classmethod
+    def project(cls, msgs):
+        """
+        :param msgs: Query Set of messages.
+        :return: Query Set returning raw documents projected on FIELDS, each
+        is turned into a record with MessageRecord(doc).
+        """
+        return msgs.only(*cls.FIELDS).as_pymongo()
+
+    @classmethod
+    def fetch(cls, msgs):
+        """
+        :param msgs: Query Set of messages.
+        :return: Generator of MessageRecord objects of messages.
+        """
+        return (cls(doc) for doc in cls.project(msgs))
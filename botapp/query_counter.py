@@ -0,0 +1,73 @@
+"""
+Module containing the per-request database query counter. Commands sent to
+MongoDB (find, getMore, count, insert etc.) are counted by pymongo command
+monitoring for the thread handling a request and reported in the
+X-Query-Count response header.
+"""
+import threading
+from pymongo import monitoring
+
+
+class QueryCounter(monitoring.CommandListener):
+    """
+    Command listener counting database commands per request. It is
+    registered with pymongo on creation, so it has to be created before the
+    database connection.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        monitoring.register(self)
+
+    def init_app(self, app):
+        app.before_request(self.start)
+        app.after_request(self.add_header)
+        app.teardown_request(self.stop)
+
+    def start(self):
+        """
+        Start counting commands sent by the current thread.
+        :return:
+        """
+        self._local.commands = {}
+
+    def stop(self, exception=None):
+        """
+        Stop counting commands sent by the current thread.
+        :param exception: Exception raised while handling the request, if any.
+        :return commands: Dictionary of command name and number of times it
+        was sent since start, None if commands were not counted.
+        """
+        commands = getattr(self._local, 'commands', None)
+        self._local.commands = None
+        return commands
+
+    def commands(self):
+        """
+        :return: Dictionary of command name and number of times it was sent
+        by the current thread, empty if commands are not counted.
+        """
+        return dict(getattr(self._local, 'commands', None) or {})
+
+    def count(self):
+        """
+        :return: Number of commands sent by the current thread.
+        """
+        return sum(self.commands().values())
+
+    def add_header(self, response):
+        # Streamed responses report commands sent before streaming started.
+        response.headers['X-Query-Count'] = str(self.count())
+        return response
+
+    def started(self, event):
+        commands = getattr(self._local, 'commands', None)
+        if commands is not None:
+            commands[event.command_name] = \
+                commands.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
@@ -8,7 +8,6 @@ from wtforms import StringField, SelectField, IntegerField, SubmitField, \
     BooleanField
 from wtforms.validators import NumberRange
 from wtforms_components import read_only
-from botapp.models import MyBot, Message
 
 
 class FilteringForm(FlaskForm):
@@ -19,14 +18,17 @@ class FilteringForm(FlaskForm):
     :parameter time_int_field: Input field for getting time (in minutes) for
     filtering.
     :parameter text_field: Input field for entering text for filtering.
-    :parameter username_field: Usernames of all users from which messages
-    were recieved.
-    :parameter name_field: (Partial) name for sender's firstname, lastname.
+    :parameter substring_field: Checked if text should be matched as substring
+    instead of words.
+    :parameter username_field: Username of the sender (exactly matched),
+    suggested by typeahead lookups.
+    :parameter name_field: Start of sender's firstname, lastname.
+    :parameter name_substring_field: Checked if name should be matched as
+    substring instead of start of words.
     """
-    bot_field = SelectField(
-        'Choose Bot', coerce=int,
-        choices=[(0, 'Select an option')] +
-                list(MyBot.objects().all().values_list('bot_id', 'username')))
+    # Bot choices are populated from the bot registry by the view.
+    bot_field = SelectField('Choose Bot', coerce=int,
+                            choices=[(0, 'Select an option')])
 
     time_field = SelectField('Time', coerce=int,
                              choices=[(0, 'Choose'), (10, '10 minutes'),
@@ -37,12 +39,17 @@ class FilteringForm(FlaskForm):
         validators=[NumberRange(0, int(time.time())/60,
                                 message="Please enter valid time or 0.")])
 
-    text_field = StringField('Text (contains)')
-
-    username_field = SelectField('Sender username', coerce=str,
-        choices=[('#', 'Select')] + list(Message.objects(sender_username__nin=[
-            'unknown', '']) .values_list('sender_username', 'sender_username')))
-    fn_ln_field = StringField('First name/ Last name (contains)')
+    text_field = StringField('Text (words or "phrase")')
+    substring_field = BooleanField('Match text as substring (slow)',
+                                   default=False)
+
+    # Suggestions are looked up from the sender directory while typing.
+    username_field = StringField('Sender username',
+                                 render_kw={'list': 'sender-list',
+                                            'autocomplete': 'off'})
+    fn_ln_field = StringField('First name/ Last name (starts with)')
+    name_substring_field = BooleanField('Match name as substring (slow)',
+                                        default=False)
     submit = SubmitField('Filter')
 
 
@@ -63,9 +70,7 @@ class GetBot(FlaskForm):
     messages received.
     """
     choose_bot = SelectField('Choose Bot', coerce=str,
-                             choices=[('#', 'Select')] + list(
-                                 MyBot.objects.values_list(
-                                     'username', 'username')))
+                             choices=[('#', 'Select')])
     submit = SubmitField('Get Info')
 
 
@@ -73,10 +78,8 @@ class EditBot(FlaskForm):
     """
     Flask form for editing a bot status i.e. enable/disable polling for the bot.
     """
-    choose_bot = SelectField('Choose Bot', coerce=str, choices=
-                             [('#', 'Select')] +
-                               list(MyBot.objects().values_list(
-                                   'username', 'username')))
+    choose_bot = SelectField('Choose Bot', coerce=str,
+                             choices=[('#', 'Select')])
     status_field = StringField('Status')
     toggle = SubmitField()
 
@@ -95,10 +98,15 @@ class FilterCriteria:
     text = ''
     username = None
     name = None
+    text_mode = 'text'
+    name_mode = 'prefix'
 
-    def __init__(self, botid, time_off, text, username, name):
+    def __init__(self, botid, time_off, text, username, name,
+                 text_mode='text', name_mode='prefix'):
         self.botid = botid
         self.time_off = time_off
         self.text = text
         self.username = username
         self.name = name
+        self.text_mode = text_mode
+        self.name_mode = name_mode
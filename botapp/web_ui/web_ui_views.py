@@ -5,11 +5,15 @@ Module containing view functions for WEB interfaces.
 import time
 from flask import flash, redirect, url_for, abort
 from flask import render_template, request, current_app
-from botapp.api_helpers import procedures
+from botapp.api_helpers import procedures, filter_cache, message_counters, \
+    bot_registry
+from botapp.api_helpers.result_cache import scope, ALL
+from botapp.api_helpers.pagination import seek, bounded_total, \
+    estimated_total, Total
 from botapp.web_ui.forms import FilteringForm, AddBotForm, GetBot, \
     FilterCriteria, EditBot
 from botapp.web_ui import web_ui, web_logger
-from botapp.models import MyBot, Message
+from botapp.models import Message, MessageRecord
 
 
 @web_ui.route('/shutdown')
@@ -27,6 +31,43 @@ def server_shutdown():
     return 'Shutting down...'
 
 
+def seek_messages(msgs, criteria, scopes, estimate=False, total=None):
+    """
+    Get the page of messages following ?cursor= (older messages) or preceding
+    ?before= (newer messages), MESSAGES_PER_PAGE messages per page. Pages are
+    cached by filter_cache.
+    :param msgs: Query Set of messages.
+    :param criteria: Dictionary of criteria msgs were filtered by.
+    :param scopes: Cache scopes of msgs e.g. [scope('bot', 1)] or [ALL].
+    :param estimate: Total of messages is estimated from collection metadata
+    (for unfiltered listings), else counting stops at MESSAGES_COUNT_LIMIT.
+    :param total: Total object of msgs e.g. read from message counters, used
+    instead of counting messages.
+    :return page: MessagePage object of MessageRecord objects.
+    """
+    cursor = request.args.get('cursor')
+    before = request.args.get('before')
+
+    def fetch_page():
+        try:
+            page = seek(MessageRecord.project(msgs),
+                        current_app.config['MESSAGES_PER_PAGE'],
+                        cursor=cursor, before=before, record=MessageRecord)
+        except ValueError:
+            abort(404)
+        if total is not None:
+            page.total = total
+        elif estimate:
+            page.total = estimated_total(Message)
+        else:
+            page.total = bounded_total(
+                msgs, current_app.config['MESSAGES_COUNT_LIMIT'])
+        return page
+    criteria = dict(criteria, view=request.endpoint, cursor=cursor,
+                    before=before)
+    return filter_cache.get(criteria, scopes, fetch_page)
+
+
 @web_ui.route('/index', methods=['GET', 'POST'])
 def index():
     """
@@ -36,15 +77,12 @@ def index():
     :return: ../index
     """
     # get all messages.
-    page = request.args.get('page', 1, type=int)
-    pagination = procedures.filter_messages(time_min=int(time.time())/60)\
-        .paginate(page, per_page=current_app.config['MESSAGES_PER_PAGE'],
-                  error_out=False)
-    msgs = pagination.items
+    page = seek_messages(procedures.filter_messages(
+        time_min=int(time.time())/60), {}, [ALL], estimate=True)
+    msgs = page.items
     web_logger.info('index page displayed with {count} messages.'.format(
         count=len(msgs)))
-    return render_template('index.html', messages=msgs,
-                           pagination=pagination)
+    return render_template('index.html', messages=msgs, pagination=page)
 
 
 @web_ui.route('/filter', methods=['GET', 'POST'])
@@ -61,12 +99,8 @@ def filtering():
                          time_field=0,
                          username_field='')
     # Populate form fields initially.
-    form.bot_field.choices = [(0, 'Select an option')] + list(
-        MyBot.objects().all().values_list('bot_id', 'username'))
-    form.username_field.choices = \
-        [('#', 'Select')] + \
-        list(Message.objects(sender_username__nin=['unknown', ''])
-             .values_list('sender_username', 'sender_username'))
+    form.bot_field.choices = [(0, 'Select an option')] + \
+        bot_registry.choices()
 
     if form.validate_on_submit():
         # Get filtering criteria from the submitted form.
@@ -93,9 +127,12 @@ def filtering():
                 time_off=time_offset,
                 text=form.text_field.data
                 if form.text_field.data != '' else '#',
-                username=form.username_field.data,
+                username=form.username_field.data.strip() or '#',
                 name=form.fn_ln_field.data
-                if form.fn_ln_field.data != '' else '#'
+                if form.fn_ln_field.data != '' else '#',
+                text_mode='substring' if form.substring_field.data else 'text',
+                name_mode='substring' if form.name_substring_field.data
+                else 'prefix'
             ))
         except Exception as e:
             web_logger.error('Error:{msg} during redirecting user to filtered'
@@ -114,9 +151,15 @@ def filtered_messages(botid, time_off, text, username, name):
     :param time_off: Time offset (in minutes).
     :param text: Message text (partially matched).
     :param username: Sender username (exactly matched).
-    :param name: Sender firstname/lastname (partially matched).
+    :param name: Sender firstname/lastname (prefix matched).
     :return: .../filtered/botid/time_off/text/username/name
     """
+    text_mode = request.args.get('text_mode', 'text')
+    if text_mode not in procedures.TEXT_MODES:
+        text_mode = 'text'
+    name_mode = request.args.get('name_mode', 'prefix')
+    if name_mode not in procedures.NAME_MODES:
+        name_mode = 'prefix'
     # Resolve wildcards
     username_field = username if username != '#' else '#'
     botid = botid if botid != -1 else None
@@ -125,14 +168,18 @@ def filtered_messages(botid, time_off, text, username, name):
     # Filter messages
     msgs = procedures.filter_messages(username=username_field, botid=botid,
                                       time_min=time_off, text=text,
-                                      name=name)
+                                      name=name, text_mode=text_mode,
+                                      name_mode=name_mode)
     fc = FilterCriteria(botid=botid, time_off=time_off, text=text, name=name,
-                        username=username_field)
+                        username=username_field, text_mode=text_mode,
+                        name_mode=name_mode)
 
     # get filtered messages.
-    page = request.args.get('page', 1, type=int)
-    pagination = msgs.paginate(page, error_out=False,
-                               per_page=current_app.config['MESSAGES_PER_PAGE'])
+    pagination = seek_messages(
+        msgs, {'bot_id': botid, 'time_off': time_off, 'text': text,
+               'username': username_field, 'name': name,
+               'text_mode': text_mode, 'name_mode': name_mode},
+        [scope('bot', botid)] if botid else [ALL])
 
     msgs = pagination.items
     return render_template('filtered_msgs.html', criteria=fc, messages=msgs,
@@ -148,7 +195,7 @@ def add_bot():
     """
     form = AddBotForm()
     if form.validate_on_submit():
-        bot = MyBot.objects(token=form.token.data).first()
+        bot = bot_registry.by_token(form.token.data)
         if bot is not None:         # Duplicate token user for adding bot.
             flash('Another bot Bot:{username} is already registered with '
                   'given token.'.format(username=bot.username))
@@ -163,8 +210,7 @@ def add_bot():
                   'database.'.format(username=status[0]))
             return redirect(
                 url_for('web_ui.bot_info',
-                        botid=MyBot.objects(username__iexact=status[
-                            0]).first().bot_id))
+                        botid=bot_registry.by_username(status[0]).bot_id))
         else:
             try:
                 # Add the bot.
@@ -178,8 +224,8 @@ def add_bot():
                           'started polling.'.format(username=status[0]))
                     return redirect(
                         url_for('web_ui.bot_info',
-                                botid=MyBot.objects(username__iexact=status[
-                                    0]).first().bot_id))
+                                botid=bot_registry.by_username(
+                                    status[0]).bot_id))
                 else:
                     # Redirect to Edit bot page to start polling again.
                     web_logger.info('New live bot:{uname} added by web api and '
@@ -189,8 +235,8 @@ def add_bot():
                           'did not start polling.'.format(username=status[0]))
                     return redirect(
                         url_for('web_ui.edit_bot',
-                                bot_choice=MyBot.objects(
-                                    username__iexact=status[0]).first().bot_id))
+                                bot_choice=bot_registry.by_username(
+                                    status[0]).bot_id))
 
             except Exception as e:
                 web_logger.error('Error:{msg} during adding new bot.'.format(
@@ -207,8 +253,7 @@ def bot_info(botid):
     :param botid: ID of the bot whose information is requested.
     :return: .../bot_info
     """
-    page = request.args.get('page', 1, type=int)
-    bot = MyBot.objects(bot_id=botid).first()
+    bot = bot_registry.get(botid)
     if bot is None:
         # Requested bot not found, redirect to selection page for choosing
         # another bot.
@@ -217,11 +262,12 @@ def bot_info(botid):
         flash('Requested bot with ID:{bid} does not exist in the '
               'database.'.format(bid=botid))
         return redirect(url_for('.get_bot_info', bot_choice=0))
-    msgs = procedures.filter_messages(botid=botid)
-    pagination = msgs.paginate(page, error_out=False,
-                               per_page=current_app.config['MESSAGES_PER_PAGE'])
+    message_count = message_counters.count('bot', botid)
+    pagination = seek_messages(procedures.filter_messages(botid=botid),
+                               {'bot_id': botid}, [scope('bot', botid)],
+                               total=Total(message_count))
     return render_template('botinfo.html', bot=bot, messages=pagination.items,
-                           pagination=pagination)
+                           pagination=pagination, message_count=message_count)
 
 
 @web_ui.route('/getbotinfo', methods=['GET', 'POST'])
@@ -236,17 +282,15 @@ def get_bot_info(bot_choice=0):
     form = GetBot(choose_bot=bot_choice)
     # Populate the initial set of choices for Bot DropDownList.
     form.choose_bot.choices = [('#', 'Select')] + \
-                              list(MyBot.objects().values_list(
-                                  'username', 'username'))
+        bot_registry.choices(key='username')
 
     if form.validate_on_submit():
         # Redirect to bot_info page.
-        bot = MyBot.objects(username__iexact=form.choose_bot.data).first()
+        bot = bot_registry.by_username(form.choose_bot.data)
         if bot is not None:
             web_logger.info('Successfully redirected user to bot_info page '
                             'for bot:{uname}'.format(uname=bot.username))
-            return redirect(url_for('.bot_info', page=1,
-                                    botid=bot.bot_id))
+            return redirect(url_for('.bot_info', botid=bot.bot_id))
         else:
             web_logger.info('Web request to get info for a non existing bot '
                             'with ID:{bid}'.format(bid=form.choose_bot.data))
@@ -268,12 +312,11 @@ def edit_bot(bot_choice=0):
 
     # Populate the initial set of choices for Bot DropDownList.
     form.choose_bot.choices = [(0, 'Select')] + \
-                              list(MyBot.objects().values_list(
-                                  'username', 'username'))
+        bot_registry.choices(key='username')
 
     if form.validate_on_submit():
         # Get list of bots
-        bot = MyBot.objects(username__iexact=form.choose_bot.data).first()
+        bot = bot_registry.by_username(form.choose_bot.data)
         if bot is None:
             # Redirect to same page because no option selected.
             flash('Please select an option and then press submit.')
@@ -0,0 +1,33 @@
+"""
+Initialize blueprint receiving Telegram updates via webhooks.
+"""
+from flask import Blueprint
+
+webhook = Blueprint('webhook', __name__)
+
+# Setup the logger
+import logging
+from logging.handlers import RotatingFileHandler
+
+webhook_logger = logging.getLogger(__name__)
+webhook_logger.setLevel(logging.INFO)
+
+# Formatter for logs.
+webhook_log_format = logging.Formatter('%(asctime)s - %(name)s - '
+                                       '%(levelname)s - %(message)s')
+
+# Setup FileHandler for the logs.
+webhook_log_fh = RotatingFileHandler('logs/webhook.log', maxBytes=1000000,
+                                     backupCount=5)
+webhook_log_fh.setLevel(logging.INFO)
+webhook_log_fh.setFormatter(webhook_log_format)
+
+# Setup StreamHandler for important logs.
+webhook_log_stream = logging.StreamHandler()
+webhook_log_stream.setLevel(logging.ERROR)
+
+# Add handlers to the logger.
+webhook_logger.addHandler(webhook_log_fh)
+webhook_logger.addHandler(webhook_log_stream)
+
+from . import webhook_views
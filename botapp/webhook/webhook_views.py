@@ -0,0 +1,47 @@
+"""
+Function calls receiving updates pushed by Telegram for bots running in
+webhook ingestion mode.
+"""
+from flask import jsonify, request, abort
+from telegram import Update
+from botapp.api_helpers import procedures, message_buffer
+from botapp.webhook import webhook, webhook_logger
+
+
+@webhook.route('/<secret>', methods=['POST'])
+def receive_update(secret):
+    """
+    This function receives an update delivered by Telegram for the bot
+    registered with given webhook secret and queues it to the handler pool
+    shared with polling bots.
+    :param secret: Webhook secret of the bot receiving the update.
+    :return:
+    """
+    bot = procedures.get_webhook_bot(secret)
+    if bot is None:
+        webhook_logger.warn('Update received for unknown webhook secret:'
+                            '{secret}'.format(secret=secret))
+        abort(404)
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        webhook_logger.warn('Update without JSON body received for bot:'
+                            '{uname}'.format(uname=bot.username))
+        return jsonify({'error': 'bad request',
+                        'message': 'JSON update expected.'}), 400
+    if message_buffer.overloaded():
+        # Telegram redelivers the update later.
+        webhook_logger.warn('Update for bot:{uname} rejected, spill journal '
+                            'is overloaded.'.format(uname=bot.username))
+        return jsonify({'error': 'service unavailable',
+                        'message': 'Try again later.'}), 503
+    update = Update.de_json(data, bot)
+    try:
+        procedures.submit_update(bot, update)
+    except Exception as e:
+        # Telegram redelivers updates which are not acknowledged, a failing
+        # update is logged and acknowledged to avoid redelivery loops.
+        webhook_logger.error('Unable to handle update:{uid} for bot:{uname}. '
+                             'Reason:{reason}'.format(uid=update.update_id,
+                                                      uname=bot.username,
+                                                      reason=e))
+    return jsonify({'result': 'ok'}), 200
@@ -10,6 +10,115 @@ class Config:
     SSL_DISABLE = False
     # Number of messages shown on each page in pagination.
     MESSAGES_PER_PAGE = 20
+    # Messages are counted up to MESSAGES_COUNT_LIMIT for showing totals of
+    # listings (shown as e.g. 10,000+ beyond it).
+    MESSAGES_COUNT_LIMIT = 10000
+    # Number of messages returned by RestAPI message calls per page unless
+    # ?limit= is given, which is capped at API_MAX_PAGE_SIZE.
+    API_PAGE_SIZE = 50
+    API_MAX_PAGE_SIZE = 200
+    # Messages fetched from the database per batch while streaming messages
+    # as newline delimited JSON (?format=ndjson).
+    API_STREAM_BATCH_SIZE = 500
+    # Cache of message listing results (pages), 'lru' (in-process, up to
+    # FILTER_CACHE_SIZE results) or 'redis' (requires the redis package).
+    # Results are invalidated when messages of their bot or chat are written
+    # and expire after FILTER_CACHE_TTL seconds.
+    FILTER_CACHE_ENABLED = True
+    FILTER_CACHE_BACKEND = os.environ.get('FILTER_CACHE_BACKEND') or 'lru'
+    FILTER_CACHE_SIZE = 1000
+    FILTER_CACHE_TTL = 60.0
+    FILTER_CACHE_REDIS_URL = os.environ.get('FILTER_CACHE_REDIS_URL') or \
+        'redis://localhost:6379/0'
+    # Messages written are counted per bot, chat and sender, each counter
+    # is split into MESSAGE_COUNTER_SHARDS documents so increments for a busy
+    # bot do not contend on a single document.
+    MESSAGE_COUNTERS_ENABLED = True
+    MESSAGE_COUNTER_SHARDS = 8
+    # Messages written are counted per chat and minute for activity charts,
+    # minute counts older than MESSAGE_ROLLUP_MINUTE_RETENTION (seconds) are
+    # folded into hour counts every MESSAGE_ROLLUP_COMPACT_INTERVAL seconds.
+    # Minutes claimed by a compaction which did not finish are folded again
+    # after MESSAGE_ROLLUP_CLAIM_TIMEOUT seconds.
+    MESSAGE_ROLLUPS_ENABLED = True
+    MESSAGE_ROLLUP_MINUTE_RETENTION = 86400
+    MESSAGE_ROLLUP_COMPACT_INTERVAL = 3600
+    MESSAGE_ROLLUP_CLAIM_TIMEOUT = 600
+    # Top senders and chats of bots are counted over the last
+    # HEAVY_HITTERS_WINDOW seconds (advancing in HEAVY_HITTERS_SLICES steps)
+    # by sketches of HEAVY_HITTERS_CAPACITY counters, counts are off by at
+    # most the number of messages in the window divided by the capacity.
+    # Sketches are merged into the database every
+    # HEAVY_HITTERS_CHECKPOINT_INTERVAL seconds.
+    HEAVY_HITTERS_ENABLED = True
+    HEAVY_HITTERS_CAPACITY = 100
+    HEAVY_HITTERS_WINDOW = 3600
+    HEAVY_HITTERS_SLICES = 12
+    HEAVY_HITTERS_CHECKPOINT_INTERVAL = 10
+    # Unique senders of bots and chats are estimated by hourly and daily
+    # HyperLogLog sketches of 2 ** UNIQUE_SENDERS_PRECISION registers (1.6%
+    # standard error for 12), merged into the database every
+    # UNIQUE_SENDERS_PERSIST_INTERVAL seconds.
+    UNIQUE_SENDERS_ENABLED = True
+    UNIQUE_SENDERS_PRECISION = 12
+    UNIQUE_SENDERS_PERSIST_INTERVAL = 10
+    # Words and phrases of messages are counted per TRENDING_WINDOW seconds
+    # and compared with previous windows (decayed by TRENDING_DECAY per
+    # window). Terms occurring less than TRENDING_MIN_COUNT times in a window
+    # are not trending, TRENDING_CANDIDATES terms are tracked per bot.
+    TRENDING_ENABLED = True
+    TRENDING_WINDOW = 300
+    TRENDING_DECAY = 0.9
+    TRENDING_CANDIDATES = 200
+    TRENDING_MIN_COUNT = 5
+    # Senders of written messages are recorded in the sender directory used
+    # by /api/typeahead. Number of usernames returned per lookup.
+    SENDER_DIRECTORY_ENABLED = True
+    TYPEAHEAD_LIMIT = 10
+    # Bots are cached in memory by every process; changes of other processes
+    # are noticed within BOT_REGISTRY_CHECK_INTERVAL seconds.
+    BOT_REGISTRY_ENABLED = True
+    BOT_REGISTRY_CHECK_INTERVAL = 1.0
+    # Logged messages are written in bulk once MESSAGE_BUFFER_SIZE messages
+    # are queued or MESSAGE_BUFFER_FLUSH_INTERVAL (seconds) has elapsed.
+    MESSAGE_BUFFER_ENABLED = True
+    MESSAGE_BUFFER_SIZE = 100
+    MESSAGE_BUFFER_FLUSH_INTERVAL = 1.0
+    # Flush attempts before a message failing to be written is dropped.
+    MESSAGE_BUFFER_MAX_RETRIES = 3
+    # Ingestion mode for live bots: 'polling' (an Updater polling Telegram
+    # per bot), 'multiplexed' (one event loop polling Telegram for all bots)
+    # or 'webhook' (Telegram pushes updates to /webhook/<secret>).
+    INGESTION_MODE = os.environ.get('INGESTION_MODE') or 'polling'
+    # Bot API address used by bots and the multiplexed poller, token is
+    # appended to it.
+    TELEGRAM_API_URL = 'https://api.telegram.org/bot'
+    # Long-poll timeout (seconds) of getUpdates requests in multiplexed mode.
+    POLLER_TIMEOUT = 10
+    # Idle keep-alive connections to the Bot API kept by multiplexed poller.
+    POLLER_MAX_IDLE_CONNECTIONS = 16
+    # Worker threads handling updates of all bots and the number of updates
+    # queued per worker before receiving updates blocks.
+    HANDLER_POOL_WORKERS = 8
+    HANDLER_POOL_QUEUE_SIZE = 1000
+    # Journal spilling messages to disk while MongoDB is unavailable or the
+    # write buffer holds more than MESSAGE_BUFFER_SPILL_SIZE messages.
+    # Polling is paused while the journal is larger than JOURNAL_MAX_SIZE.
+    MESSAGE_BUFFER_SPILL_SIZE = 1000
+    JOURNAL_ENABLED = True
+    JOURNAL_DIR = os.path.join(basedir, 'logs', 'journal')
+    JOURNAL_SEGMENT_SIZE = 4 * 1024 * 1024
+    JOURNAL_MAX_SIZE = 256 * 1024 * 1024
+    JOURNAL_FSYNC_INTERVAL = 0.1
+    JOURNAL_REPLAY_INTERVAL = 1.0
+    # Public HTTPS address of this server, used for registering webhooks e.g.
+    # https://example.com:8443 (Telegram only supports ports 443, 80, 88, 8443)
+    WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+    # Certificate and key used by secureserver. The self-signed certificate is
+    # uploaded to Telegram while registering webhooks.
+    SSL_CERTIFICATE = os.path.join(basedir, 'server.crt')
+    SSL_PRIVATE_KEY = os.path.join(basedir, 'server.key')
+    WEBHOOK_UPLOAD_CERTIFICATE = True
 
     @staticmethod
     def init_app(app):
@@ -39,12 +148,27 @@ class TestingConfig(Config):
     TESTING = True
     WTF_CSRF_ENABLED = False
     PRESERVE_CONTEXT_ON_EXCEPTION = False
+    MESSAGE_BUFFER_ENABLED = False      # Write logged messages immediately.
+    JOURNAL_ENABLED = False
+    FILTER_CACHE_ENABLED = False
+    # Tests change bots directly in the database.
+    BOT_REGISTRY_ENABLED = False
     MONGODB_DB = 'testing_db'
     MONGODB_HOST = '127.0.0.1'
     MONGODB_PORT = 27017
     PRESERVE_CONTEXT_ON_EXCEPTION = False
 
 
+class BenchmarkConfig(DevelopmentConfig):
+    """
+    Configuration for benchmarks run by manage.py, which add and remove bots
+    and messages in their own database.
+    """
+    DEBUG = False
+    MONGODB_DB = 'benchmark_db'
+    JOURNAL_DIR = os.path.join(basedir, 'logs', 'benchmark_journal')
+
+
 class ProductionConfig(Config):
     """
     Configuration for production.
@@ -65,6 +189,7 @@ class ProductionConfig(Config):
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
+    'benchmark': BenchmarkConfig,
     'production': ProductionConfig,
 
     'default': DevelopmentConfig
@@ -0,0 +1,217 @@
+"""
+Module containing the end-to-end ingestion benchmark and the message read
+benchmark. Fake bots served by FakeTelegramServer are added and started
+through procedures, so updates go through the configured ingestion mode, the
+handler pool, log_message and the write buffer into MongoDB.
+"""
+import gc
+import os
+import time
+import resource
+from datetime import datetime, timedelta
+from helper.fake_telegram import FakeTelegramServer
+
+
+def percentile(values, fraction):
+    """
+    :param values: Sorted list of values.
+    :param fraction: Percentile as fraction e.g. 0.99
+    :return: Value at given percentile or 0 for an empty list.
+    """
+    if not values:
+        return 0.0
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def _summary(values):
+    values = sorted(values)
+    return {'count': len(values),
+            'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3) if values else 0.0}
+
+
+def run_ingestion_benchmark(app, bots=4, rate=50.0, duration=10.0, chats=10,
+                            recorded=None, drain_timeout=30.0):
+    """
+    Run the ingestion path against a fake Bot API server and measure it.
+    Fake bots and their messages are removed from the database afterwards,
+    run it against a dedicated database (manage.py uses BenchmarkConfig).
+    :param app: Flask application object, its ingestion settings are used.
+    :param bots: Number of fake bots.
+    :param rate: Updates per second sent to each bot.
+    :param duration: Time (in seconds) updates are generated.
+    :param chats: Number of chats per bot.
+    :param recorded: Path of a file of recorded updates (one JSON per line).
+    :param drain_timeout: Maximum time (in seconds) to wait for generated
+    updates to be written after the stream is stopped.
+    :return report: Dictionary containing throughput, end-to-end latency and
+    per-stage timing.
+    """
+    from botapp.models import MyBot, Message
+    from botapp import api_helpers
+    from botapp.api_helpers import procedures, message_buffer, handler_pool, \
+        bot_registry
+
+    server = FakeTelegramServer(bots=bots, rate=rate, chats=chats,
+                                recorded=recorded)
+    server.start()
+    api_url = app.config.get('TELEGRAM_API_URL')
+    app.config['TELEGRAM_API_URL'] = server.api_url
+    api_helpers.init_app(app)
+    bot_ids = [bot.bot_id for bot in server.bots]
+
+    handled = {}                # Message key -> (handler start, handler end)
+    written = {}                # Message key -> written timestamp
+    dispatch_update = procedures.dispatch_update
+
+    def timed_dispatch(bot, update):
+        started = time.time()
+        try:
+            return dispatch_update(bot, update)
+        finally:
+            message = update.message
+            if message is not None:
+                handled[(bot.id, message.chat_id, message.message_id)] = \
+                    (started, time.time())
+
+    def record_written(documents):
+        now = time.time()
+        for document in documents:
+            written[(document.get('bot_id'), document.get('chatid'),
+                     document.get('msg_id'))] = now
+
+    MyBot.objects(bot_id__in=bot_ids).delete()
+    bot_registry.changed()
+    Message.objects(bot_id__in=bot_ids).delete()
+    procedures.dispatch_update = timed_dispatch
+    message_buffer.flush_listeners.append(record_written)
+    try:
+        for token in server.tokens:
+            procedures.add_bot(token=token)
+        server.start_stream()
+        started = time.time()
+        time.sleep(duration)
+        server.stop_stream()
+        deadline = time.time() + drain_timeout
+        while len(written) < server.generated() and time.time() < deadline:
+            time.sleep(0.1)
+        finished = max(written.values()) if written else time.time()
+        # Only fake bots are stopped, other bots are left untouched.
+        for bot_id in bot_ids:
+            procedures.stop_bot(botid=bot_id)
+        handler_pool.join()
+        message_buffer.flush()
+    finally:
+        procedures.dispatch_update = dispatch_update
+        message_buffer.flush_listeners.remove(record_written)
+        server.stop()
+        app.config['TELEGRAM_API_URL'] = api_url
+        api_helpers.init_app(app)
+        MyBot.objects(bot_id__in=bot_ids).delete()
+        bot_registry.changed()
+        Message.objects(bot_id__in=bot_ids).delete()
+
+    stages = dict((name, []) for name in ('delivery', 'dispatch', 'handle',
+                                          'write', 'end_to_end'))
+    for key, written_at in written.items():
+        created, served = server.timings.get(key, (None, None))
+        if created is None or served is None or key not in handled:
+            continue
+        handle_start, handle_end = handled[key]
+        stages['delivery'].append(served - created)
+        stages['dispatch'].append(handle_start - served)
+        stages['handle'].append(handle_end - handle_start)
+        stages['write'].append(written_at - handle_end)
+        stages['end_to_end'].append(written_at - created)
+    elapsed = max(finished - started, 0.001)
+    return {
+        'mode': api_helpers.ingestion_settings['mode'],
+        'bots': bots,
+        'offered_rate': rate * bots,
+        'generated': server.generated(),
+        'written': len(written),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(written) / elapsed, 1),
+        'api_requests': server.requests,
+        'latency': _summary(stages.pop('end_to_end')),
+        'stages': dict((name, _summary(values))
+                       for name, values in stages.items())
+    }
+
+
+# Bot ID of messages inserted by the read benchmark.
+READ_BENCHMARK_BOT_ID = 900000
+
+
+def _rss():
+    """
+    :return: Resident memory (in bytes) of the process, peak resident memory
+    if the current one is not available (i.e. outside Linux).
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure_read(read, rows):
+    """
+    Read messages and build their JSON representation like a RestAPI call.
+    Messages are kept until memory is measured, i.e. like a page of them.
+    :param read: Callable returning an iterable of messages.
+    :param rows: Number of messages read.
+    :return: Dictionary of CPU time and memory per message.
+    """
+    gc.collect()
+    memory = _rss()
+    started = time.clock()
+    messages = list(read())
+    for message in messages:
+        message.to_json()
+    cpu = time.clock() - started
+    memory = _rss() - memory
+    assert len(messages) == rows
+    return {'cpu_us_per_doc': round(cpu * 10 ** 6 / rows, 2),
+            'memory_bytes_per_doc': round(float(memory) / rows, 1)}
+
+
+def run_read_benchmark(sizes=(10000, 100000)):
+    """
+    Compare reading messages as Message documents and as MessageRecord
+    objects (projected raw documents). Benchmark messages are inserted for
+    each size and removed afterwards.
+    :param sizes: Number of messages read in each run.
+    :return report: Dictionary of size and CPU time/memory per message of
+    each read path.
+    """
+    from botapp.models import Message, MessageRecord
+
+    collection = Message._get_collection()
+    report = {}
+    now = datetime.now()
+    try:
+        for rows in sizes:
+            collection.delete_many({'bot_id': READ_BENCHMARK_BOT_ID})
+            for start in range(0, rows, 10000):
+                collection.insert_many([{
+                    'msg_id': msg_id, 'bot_id': READ_BENCHMARK_BOT_ID,
+                    'chatid': msg_id % 100,
+                    'date': now - timedelta(seconds=msg_id),
+                    'sender_username': 'user{0}'.format(msg_id % 100),
+                    'sender_username_lower': 'user{0}'.format(msg_id % 100),
+                    'sender_firstname': 'User', 'sender_lastname': 'Name',
+                    'sender_name_tokens': ['name', 'user'],
+                    'text_content': 'Benchmark message {0}'.format(msg_id)}
+                    for msg_id in range(start, min(start + 10000, rows))])
+            msgs = Message.objects(bot_id=READ_BENCHMARK_BOT_ID)\
+                .order_by('-date').no_cache()
+            report[rows] = {
+                'document': _measure_read(lambda: msgs, rows),
+                'record': _measure_read(lambda: MessageRecord.fetch(msgs),
+                                        rows)
+            }
+    finally:
+        collection.delete_many({'bot_id': READ_BENCHMARK_BOT_ID})
+    return report
@@ -0,0 +1,319 @@
+"""
+Module containing a local stand-in for the Telegram Bot API. It serves
+getMe, getUpdates and sendMessage for a number of fake bots, delivering
+synthetic (or recorded) text message updates at a configurable rate, so the
+ingestion path can be measured without Telegram.
+"""
+import json
+import time
+import socket
+import threading
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+# First bot ID of fake bots, ID of each further bot is incremented by one.
+FIRST_BOT_ID = 900001
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = set()        # Open keep-alive connections.
+
+    def close_connections(self):
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        pass                # Clients closing long-polls on shutdown.
+
+
+class FakeBot(object):
+    """
+    State of a fake bot i.e. its update stream and pending updates.
+    :param bot_id: Telegram ID of the bot.
+    """
+
+    def __init__(self, bot_id):
+        self.bot_id = bot_id
+        self.token = '{0}:FAKE-{0}-token'.format(bot_id)
+        self.username = 'fakebot{0}'.format(bot_id)
+        self.pending = []           # Generated updates not yet confirmed.
+        self.generated = 0
+        self.sent_messages = 0
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        return {'id': self.bot_id, 'first_name': 'Fake',
+                'last_name': 'Bot {0}'.format(self.bot_id),
+                'username': self.username}
+
+
+class FakeTelegramServer(object):
+    """
+    HTTP server implementing the subset of the Bot API used by the
+    application. Each bot receives rate updates per second, spread over
+    chats chats, once the stream is started.
+    :param host: Address to listen on.
+    :param port: Port to listen on, 0 picks a free port.
+    :param bots: Number of fake bots.
+    :param rate: Updates per second generated for each bot.
+    :param chats: Number of chats updates of a bot are spread over.
+    :param recorded: Path of a file containing recorded updates (one JSON
+    update per line), used instead of synthetic text messages.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, bots=4, rate=100.0, chats=10,
+                 recorded=None):
+        self.rate = float(rate)
+        self.chats = chats
+        self.bots = [FakeBot(FIRST_BOT_ID + index) for index in range(bots)]
+        self._tokens = dict((bot.token, bot) for bot in self.bots)
+        self._recorded = self._load(recorded) if recorded else None
+        self._started = None
+        self._stopped = None
+        # (bot_id, chat_id, message_id) -> [created, served] timestamps.
+        self.timings = {}
+        self._server = _ThreadingHTTPServer((host, port),
+                                            self._handler_class())
+        self._thread = None
+        # Metrics
+        self.requests = 0
+
+    @staticmethod
+    def _load(path):
+        with open(path) as recorded:
+            updates = [json.loads(line) for line in recorded if line.strip()]
+        return [update['message'] for update in updates
+                if 'message' in update]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(_BotApiHandler):
+            fake = server
+        return Handler
+
+    @property
+    def api_url(self):
+        """
+        :return: Bot API base URL of the server, token is appended to it.
+        """
+        host, port = self._server.server_address
+        return 'http://{host}:{port}/bot'.format(host=host, port=port)
+
+    @property
+    def tokens(self):
+        return [bot.token for bot in self.bots]
+
+    def start(self):
+        """
+        Start serving requests, updates are not generated before the stream
+        is started.
+        :return:
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='fake-telegram')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def start_stream(self):
+        """
+        Start generating updates for all bots.
+        :return:
+        """
+        self._started = time.time()
+        self._stopped = None
+
+    def stop_stream(self):
+        """
+        Stop generating updates, pending updates are still served.
+        :return:
+        """
+        self._generate_all()
+        self._stopped = time.time()
+
+    def stop(self):
+        """
+        Stop the server.
+        :return:
+        """
+        self._server.shutdown()
+        self._server.close_connections()
+        self._server.server_close()
+
+    def generated(self):
+        """
+        :return: Number of updates generated for all bots.
+        """
+        return sum(bot.generated for bot in self.bots)
+
+    def _due(self, now):
+        """
+        :param now: Current time.
+        :return: Number of updates each bot should have received by now.
+        """
+        if self._started is None:
+            return 0
+        end = now if self._stopped is None else self._stopped
+        return int((end - self._started) * self.rate)
+
+    def _generate_all(self):
+        now = time.time()
+        for bot in self.bots:
+            self._generate(bot, now)
+
+    def _generate(self, bot, now):
+        """
+        Append updates which are due for a bot to its pending updates. An
+        update's creation time is the time it was scheduled at.
+        :param bot: FakeBot object.
+        :param now: Current time.
+        :return:
+        """
+        with bot.lock:
+            while bot.generated < self._due(now):
+                bot.generated += 1
+                created = self._started + bot.generated / self.rate
+                message = self._message(bot, bot.generated, created)
+                self.timings[(bot.bot_id, message['chat']['id'],
+                              message['message_id'])] = [created, None]
+                bot.pending.append({'update_id': bot.generated,
+                                    'message': message})
+
+    def _message(self, bot, number, created):
+        chat_id = (number % self.chats) + 1
+        if self._recorded:
+            message = dict(self._recorded[(number - 1) % len(self._recorded)])
+            chat_id = message.get('chat', {}).get('id', chat_id)
+        else:
+            message = {
+                'from': {'id': chat_id, 'first_name': 'User',
+                         'last_name': str(chat_id),
+                         'username': 'user{0}'.format(chat_id)},
+                'text': 'Message {0} for bot {1}'.format(number, bot.bot_id)
+            }
+        message.update({'message_id': number, 'date': int(created),
+                        'chat': {'id': chat_id, 'type': 'private'}})
+        return message
+
+    def get_updates(self, bot, offset, timeout, limit=100):
+        """
+        Confirm updates before offset and return pending updates, waiting up
+        to timeout seconds for an update to be generated.
+        :param bot: FakeBot object.
+        :param offset: First update ID to be returned.
+        :param timeout: Long-poll timeout (in seconds).
+        :param limit: Maximum number of returned updates.
+        :return: List of updates.
+        """
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            self._generate(bot, now)
+            with bot.lock:
+                bot.pending = [update for update in bot.pending
+                               if update['update_id'] >= offset]
+                updates = bot.pending[:limit]
+            if updates or now >= deadline:
+                break
+            next_update = (self._started + (bot.generated + 1) / self.rate
+                           if self._started and self._stopped is None
+                           else deadline)
+            # Check at least every 100ms, the stream may be started meanwhile.
+            time.sleep(max(0.001, min(next_update, deadline, now + 0.1) - now))
+        for update in updates:
+            message = update['message']
+            timing = self.timings.get((bot.bot_id, message['chat']['id'],
+                                       message['message_id']))
+            if timing is not None and timing[1] is None:
+                timing[1] = now             # First time update is served.
+        return updates
+
+    def send_message(self, bot, chat_id, text):
+        bot.sent_messages += 1
+        return {'message_id': 0, 'date': int(time.time()), 'text': text,
+                'from': bot.to_dict(),
+                'chat': {'id': int(chat_id), 'type': 'private'}}
+
+
+class _BotApiHandler(BaseHTTPRequestHandler):
+    """
+    Serves Bot API methods of the fake bots, parameters are read from the
+    query string, JSON or form encoded request body.
+    """
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        self.server.connections.discard(self.connection)
+        BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _params(self, url):
+        params = dict((key, values[0]) for key, values in
+                      parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                params.update(json.loads(body))
+            else:
+                params.update((key, values[0]) for key, values in
+                              parse_qs(body).items())
+        return params
+
+    def _handle(self):
+        self.fake.requests += 1
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        bot = self.fake._tokens.get(parts[0][len('bot'):]) \
+            if len(parts) == 2 else None
+        if bot is None:
+            return self._reply(401, {'ok': False, 'error_code': 401,
+                                     'description': 'Unauthorized'})
+        params = self._params(url)
+        method = parts[1]
+        if method == 'getMe':
+            result = bot.to_dict()
+        elif method == 'getUpdates':
+            result = self.fake.get_updates(
+                bot, int(params.get('offset') or 0),
+                min(float(params.get('timeout') or 0), 30),
+                int(params.get('limit') or 100))
+        elif method == 'sendMessage':
+            result = self.fake.send_message(bot, params.get('chat_id'),
+                                            params.get('text'))
+        elif method == 'setWebhook':
+            result = True
+        else:
+            return self._reply(404, {'ok': False, 'error_code': 404,
+                                     'description': 'Not Found'})
+        self._reply(200, {'ok': True, 'result': result})
+
+    def _reply(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
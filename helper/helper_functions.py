@@ -19,6 +19,17 @@ def generate_secret_key(length=32):
                    for _ in range(length))
 
 
+def generate_url_token(length=32):
+    """
+    Generates a random token consisting of ascii letters and digits only, so
+    it can be used as part of an URL e.g. webhook path of a bot.
+    :param: length of token (default=32)
+    """
+    rand = random.SystemRandom()
+    return ''.join(rand.choice(string.ascii_letters + string.digits)
+                   for _ in range(length))
+
+
 def load_live_bots():
     """
     This function adds the set of live bots whose tokens are given in
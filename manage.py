@@ -1,6 +1,7 @@
 """
 Main module for managing Telegram application.
 """
+from __future__ import print_function
 import sys
 import logging
 from botapp import create_app, db
@@ -14,8 +15,12 @@ logging.basicConfig(level=logging.DEBUG,
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Benchmarks add and remove bots and messages, they use their own database.
+BENCHMARK_COMMANDS = ('benchmark', 'read_benchmark')
+
 try:
-    app = create_app('default')
+    app = create_app('benchmark' if sys.argv[1:2] and
+                     sys.argv[1] in BENCHMARK_COMMANDS else 'default')
 except NetworkError:
     logger.error('Network error while communicating with Telegram API, please '
                  'try again.')
@@ -54,15 +59,158 @@ def test(coverage=False, test_name=None):
 
 
 @manager.command
-def secureserver():
+def migrate_messages():
+    """
+    Migrate logged messages from sequence number primary keys to natural key
+    (bot ID, chat ID, message ID) storage.
+    """
+    from botapp.migrations import migrate_message_keys
+    migrated, duplicates = migrate_message_keys()
+    logger.info('{count} messages migrated, {dups} duplicate messages '
+                'removed.'.format(count=migrated, dups=duplicates))
+
+
+@manager.command
+def backfill_usernames():
+    """
+    Set lowercase usernames of bots and message senders saved by older
+    versions, used for case insensitive username lookups.
+    """
+    from botapp.migrations import backfill_lowercase_usernames
+    bots, messages = backfill_lowercase_usernames()
+    logger.info('Lowercase usernames set for {bots} bots and {msgs} '
+                'messages.'.format(bots=bots, msgs=messages))
+
+
+@manager.command
+def backfill_names():
+    """
+    Set sender name tokens of messages saved by older versions, used for
+    indexed sender name search.
+    """
+    from botapp.migrations import backfill_name_tokens
+    messages = backfill_name_tokens()
+    logger.info('Sender name tokens set for {msgs} messages.'.format(
+        msgs=messages))
+
+
+@manager.command
+def rebuild_counters():
+    """
+    Recompute message counters per bot, chat and sender from logged
+    messages e.g. after messages were removed outside the application.
+    """
+    from botapp.api_helpers import message_counters
+    counts = message_counters.rebuild()
+    logger.info('Rebuilt message counters of {bots} bots, {chats} chats and '
+                '{senders} senders.'.format(bots=counts['bot'],
+                                            chats=counts['chat'],
+                                            senders=counts['sender']))
+
+
+@manager.command
+def rebuild_rollups():
+    """
+    Recompute per minute and per hour message rollups from logged messages
+    e.g. for messages logged by older versions.
+    """
+    from botapp.api_helpers import message_rollups
+    rollups = message_rollups.rebuild()
+    logger.info('Rebuilt {count} message rollups.'.format(count=rollups))
+
+
+@manager.command
+def rebuild_senders():
+    """
+    Recompute the sender directory used for sender lookups from logged
+    messages.
+    """
+    from botapp.api_helpers import sender_directory
+    senders = sender_directory.rebuild()
+    logger.info('Rebuilt sender directory of {count} senders.'.format(
+        count=senders))
+
+
+@manager.command
+def indexes():
+    """
+    Build indexes declared on the models in the background and report how
+    often each index was used since the database server started. Indexes
+    without operations (other than _id_) are candidates for removal.
+    """
+    from botapp.migrations import build_indexes, index_usage
+    build_indexes()
+    for document in (MyBot, Message):
+        usage = index_usage(document)
+        if usage is None:
+            continue
+        for index in usage:
+            logger.info('{collection}.{name}: {ops} operations since {since}'
+                        '{unused}'.format(
+                            collection=document._get_collection_name(),
+                            name=index['name'], ops=index['ops'],
+                            since=index['since'],
+                            unused=' (unused)' if not index['ops'] and
+                            index['name'] != '_id_' else ''))
+
+
+@manager.option('-b', '--bots', dest='bots', type=int, default=4,
+                help='Number of fake bots.')
+@manager.option('-r', '--rate', dest='rate', type=float, default=50.0,
+                help='Updates per second sent to each bot.')
+@manager.option('-d', '--duration', dest='duration', type=float, default=10.0,
+                help='Time (in seconds) updates are sent.')
+@manager.option('-c', '--chats', dest='chats', type=int, default=10,
+                help='Number of chats per bot.')
+@manager.option('-m', '--mode', dest='mode', default=None,
+                help='Ingestion mode: polling or multiplexed.')
+@manager.option('-f', '--recorded', dest='recorded', default=None,
+                help='File of recorded updates, one JSON update per line.')
+def benchmark(bots, rate, duration, chats, mode, recorded):
+    """
+    Measure ingestion throughput and latency of the real ingestion path
+    against a local fake Telegram Bot API server.
+    """
+    import json
+    from helper.benchmark import run_ingestion_benchmark
+    if mode is not None:
+        app.config['INGESTION_MODE'] = mode
+    with app.app_context():
+        report = run_ingestion_benchmark(app, bots=bots, rate=rate,
+                                         duration=duration, chats=chats,
+                                         recorded=recorded)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+@manager.option('-n', '--sizes', dest='sizes', default='10000,100000',
+                help='Comma separated numbers of messages read.')
+def read_benchmark(sizes):
+    """
+    Measure CPU time and memory per message of reading messages as Message
+    documents and as raw document records (used by RestAPI and web UI).
+    """
+    import json
+    from helper.benchmark import run_read_benchmark
+    with app.app_context():
+        report = run_read_benchmark(
+            sizes=[int(size) for size in sizes.split(',')])
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+@manager.command
+def secureserver(host='127.0.0.1', port=5000):
     """
     Start secure server with self-signed Certificates. It will give a
     untrusted connection warning on web browsers. To avoid the warning,
-    please use CA signed certificates.
+    please use CA signed certificates. The same server receives webhook
+    updates when INGESTION_MODE is 'webhook'.
+    :param host: Address to listen on.
+    :param port: Port to listen on (Telegram webhooks: 443, 80, 88 or 8443).
     :return:
     """
-    context = ('server.crt', 'server.key')
-    app.run(ssl_context=context, threaded=True, debug=True)
+    context = (app.config['SSL_CERTIFICATE'], app.config['SSL_PRIVATE_KEY'])
+    app.run(host=host, port=int(port), ssl_context=context, threaded=True,
+            debug=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,156 @@
+"""
+Module containing tests cases for the in-memory bot registry.
+"""
+import unittest
+from flask import url_for
+from botapp import create_app
+from botapp.models import MyBot, Message, RegistryVersion
+from botapp.api_helpers import bot_registry
+from botapp.api_helpers.bot_registry import BotRegistry
+
+
+class BotRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.registry = BotRegistry(check_interval=0)
+        MyBot.change_listeners.append(self.registry.changed)
+
+    def tearDown(self):
+        MyBot.change_listeners.remove(self.registry.changed)
+        # Drop all collections
+        MyBot.drop_collection()
+        RegistryVersion.drop_collection()
+        self.app_context.pop()
+
+    def add_bot(self, bot_id, username):
+        return MyBot(bot_id=bot_id, username=username,
+                     token='token-{0}'.format(bot_id)).save()
+
+    def test_lookups(self):
+        self.add_bot(1, 'FirstBot')
+        self.add_bot(2, 'secondbot')
+        self.assertEqual(self.registry.get(1).username, 'FirstBot')
+        self.assertEqual(self.registry.by_username('firstbot').bot_id, 1)
+        self.assertEqual(self.registry.by_token('token-2').bot_id, 2)
+        self.assertEqual(self.registry.find(botid=3, username='SECONDBOT')
+                         .bot_id, 2)
+        self.assertIsNone(self.registry.find(botid=3, username='other'))
+        self.assertEqual(self.registry.choices(key='username'),
+                         [('FirstBot', 'FirstBot'),
+                          ('secondbot', 'secondbot')])
+
+    def test_changes_are_seen(self):
+        self.registry.reload()
+        bot = self.add_bot(1, 'firstbot')
+        self.assertEqual(self.registry.get(1).username, 'firstbot')
+        bot.state = True
+        bot.save()
+        self.assertTrue(self.registry.get(1).state)
+        self.registry.get(1).delete()
+        self.assertIsNone(self.registry.get(1))
+        self.assertEqual(self.registry.stats()['version'], 3)
+
+    def test_lookups_return_copies(self):
+        self.add_bot(1, 'firstbot')
+        bot = self.registry.get(1)
+        bot.webhook_secret = 'secret'           # Changed but not saved.
+        self.assertIsNone(self.registry.get(1).webhook_secret)
+        self.assertIsNone(self.registry.by_username('firstbot')
+                          .webhook_secret)
+        bot.save()
+        self.assertEqual(self.registry.by_token('token-1').webhook_secret,
+                         'secret')
+
+    def test_changes_of_other_processes_are_seen(self):
+        other = BotRegistry(check_interval=60)
+        self.assertEqual(other.bots(), [])
+        self.add_bot(1, 'firstbot')
+        self.assertIsNone(other.get(1))             # Not checked yet.
+        other.check_interval = 0
+        self.assertEqual(other.get(1).username, 'firstbot')
+        MyBot.objects(bot_id=1).delete()
+        self.assertIsNotNone(other.get(1))          # Not notified.
+        self.registry.changed()
+        self.assertIsNone(other.get(1))
+
+    def test_disabled(self):
+        registry = BotRegistry(enabled=False)
+        self.add_bot(1, 'firstbot')
+        MyBot.objects(bot_id=1).update_one(set__state=True)
+        self.assertTrue(registry.get(1).state)
+        self.assertEqual(registry.stats()['loads'], 0)
+
+
+class BotRegistryViewsTest(unittest.TestCase):
+    """
+    Web UI and Rest API views looking up bots in the application's registry.
+    """
+
+    def setUp(self):
+        self.app = create_app('testing', BOT_REGISTRY_ENABLED=True)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        # Drop all collections
+        MyBot.drop_collection()
+        Message.drop_collection()
+        RegistryVersion.drop_collection()
+        self.app_context.pop()
+        create_app('testing')       # Disable the bot registry again.
+
+    def add_test_bot(self, token='dummy-token'):
+        response = self.client.post(url_for('web_ui.add_bot'),
+                                    data={'token': token, 'is_test_bot': 'y'})
+        self.assertEqual(response.status_code, 302)
+        return MyBot.objects(token=token).first()
+
+    def test_add_bot_and_bot_info(self):
+        bot = self.add_test_bot()
+        # Token of a registered bot redirects to the registered bot.
+        response = self.client.post(url_for('web_ui.add_bot'),
+                                    data={'token': 'dummy-token',
+                                          'is_test_bot': 'y'})
+        self.assertTrue(response.location.endswith(
+            url_for('web_ui.bot_info', botid=bot.bot_id)))
+        self.assertEqual(MyBot.objects.count(), 1)
+        response = self.client.get(url_for('web_ui.bot_info',
+                                           botid=bot.bot_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(bot.username, response.data.decode('utf-8'))
+        MyBot.objects(bot_id=bot.bot_id).update_one(
+            set__username='renamedbot', set__username_lower='renamedbot')
+        bot_registry.changed()
+        response = self.client.get(url_for('web_ui.bot_info',
+                                           botid=bot.bot_id))
+        self.assertIn('renamedbot', response.data.decode('utf-8'))
+        MyBot.objects(bot_id=bot.bot_id).delete()
+        bot_registry.changed()
+        response = self.client.get(url_for('web_ui.bot_info',
+                                           botid=bot.bot_id))
+        self.assertEqual(response.status_code, 302)
+
+    def test_get_bot_info_and_edit_bot(self):
+        bot = self.add_test_bot()
+        response = self.client.post(url_for('web_ui.get_bot_info'),
+                                    data={'choose_bot': bot.username})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith(
+            url_for('web_ui.bot_info', botid=bot.bot_id)))
+        response = self.client.post(url_for('web_ui.edit_bot'),
+                                    data={'choose_bot': bot.username})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Cannot be enabled.', response.data.decode('utf-8'))
+        self.assertFalse(bot_registry.get(bot.bot_id).state)
+
+    def test_delete_bot_by_username(self):
+        bot = self.add_test_bot()
+        url = url_for('botapi.delete_bot_and_message_by_uname',
+                      username=bot.username)
+        self.assertEqual(self.client.delete(url).status_code, 200)
+        self.assertIsNone(bot_registry.get(bot.bot_id))
+        self.assertEqual(self.client.delete(url).status_code, 400)
@@ -0,0 +1,122 @@
+"""
+Module containing tests cases for materialized message counters.
+"""
+import json
+import unittest
+from datetime import datetime
+from flask import url_for
+from botapp import create_app
+from botapp.models import MyBot, Message, MessageCounter
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from botapp.api_helpers.counters import MessageCounters, bulk_upsert
+from botapp.api_helpers.write_buffer import MessageWriteBuffer
+
+
+class FailingCollection(object):
+    """
+    Collection whose bulk writes fail with given BulkWriteError details.
+    """
+
+    def __init__(self, details):
+        self.details = details
+        self.calls = 0
+
+    def bulk_write(self, requests, ordered=True):
+        self.calls += 1
+        raise BulkWriteError(self.details)
+
+
+class BulkUpsertTest(unittest.TestCase):
+
+    def test_write_concern_error_is_raised(self):
+        collection = FailingCollection({'writeErrors': [],
+                                        'writeConcernErrors': [
+                                            {'errmsg': 'timed out'}]})
+        with self.assertRaises(BulkWriteError):
+            bulk_upsert(collection, [UpdateOne({'key': 1},
+                                               {'$inc': {'count': 1}},
+                                               upsert=True)])
+        self.assertEqual(collection.calls, 1)
+
+
+class MessageCountersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.counters = MessageCounters(shards=4)
+        self.buffer = MessageWriteBuffer(max_size=100, flush_interval=60)
+        self.buffer.flush_listeners.append(self.counters.record)
+
+    def tearDown(self):
+        self.buffer.close()
+        # Drop all collections
+        MyBot.drop_collection()
+        Message.drop_collection()
+        MessageCounter.drop_collection()
+        self.app_context.pop()
+
+    def log(self, msg_id, bot_id=1, chatid=10, username='Tester'):
+        self.buffer.put(Message(msg_id=msg_id, date=datetime.now(),
+                                chatid=chatid, bot_id=bot_id,
+                                sender_username=username, text_content='hi'))
+
+    def test_written_messages_are_counted(self):
+        for msg_id in range(1, 11):
+            self.log(msg_id, bot_id=1 + msg_id % 2, chatid=10 + msg_id % 3)
+        self.log(1, bot_id=2, chatid=11)           # Duplicate, not counted.
+        self.buffer.flush()
+        self.assertEqual(self.counters.count('bot', 1), 5)
+        self.assertEqual(self.counters.count('bot', 2), 5)
+        self.assertEqual(self.counters.count('chat', 11), 4)
+        self.assertEqual(self.counters.count('sender', 'tester'), 10)
+        self.assertEqual(self.counters.count('bot', 3), 0)
+        self.assertEqual(self.counters.counts('bot'), {'1': 5, '2': 5})
+
+    def test_counters_are_sharded(self):
+        for batch in range(20):
+            self.log(batch)
+            self.buffer.flush()
+        shards = MessageCounter.objects(kind='bot', key='1')
+        self.assertTrue(1 < shards.count() <= 4)
+        self.assertEqual(self.counters.count('bot', 1), 20)
+
+    def test_forget_bot(self):
+        for msg_id in range(1, 4):
+            self.log(msg_id, bot_id=1)
+            self.log(msg_id, bot_id=2)
+        self.buffer.flush()
+        self.counters.forget_bot(1)
+        Message.objects(bot_id=1).delete()
+        self.assertEqual(self.counters.count('bot', 1), 0)
+        self.assertEqual(self.counters.count('bot', 2), 3)
+        self.assertEqual(self.counters.count('chat', 10), 3)
+        self.assertEqual(self.counters.count('sender', 'tester'), 3)
+
+    def test_rebuild(self):
+        for msg_id in range(1, 6):
+            self.log(msg_id, chatid=msg_id % 2)
+        self.buffer.flush()
+        Message.objects(msg_id=5).delete()          # Not counted anymore.
+        MessageCounter.objects(kind='chat').delete()
+        counts = self.counters.rebuild(batch_size=1)
+        self.assertEqual(counts, {'bot': 1, 'chat': 2, 'sender': 1})
+        self.assertEqual(self.counters.count('bot', 1), 4)
+        self.assertEqual(self.counters.count('chat', 0), 2)
+        self.assertEqual(self.counters.count('chat', 1), 2)
+
+    def test_list_bots(self):
+        MyBot(bot_id=1, username='testbot', token='dummy-token').save()
+        self.log(1)
+        self.log(2)
+        self.buffer.flush()
+        self.counters.rebuild()
+        response = self.client.get(url_for('botapi.list_bots'))
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(json_response['bots']), 1)
+        self.assertEqual(json_response['bots'][0]['username'], 'testbot')
+        self.assertEqual(json_response['bots'][0]['messages'], 2)
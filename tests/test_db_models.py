@@ -6,7 +6,7 @@ import unittest
 import mongoengine
 from datetime import datetime
 from botapp import create_app
-from botapp.models import MyBot, Message
+from botapp.models import MyBot, Message, MessageRecord
 from helper import CONSTANTS
 
 
@@ -112,6 +112,20 @@ class DocumentModelTestCase(unittest.TestCase):
         self.assertEqual(msg.text_content, 'text message')
         self.assertEqual(Message.objects.count(), 1)
 
+    def test_message_natural_key_is_unique(self):
+        Message(msg_id=1, chatid=1, bot_id=1, text_content='first').save()
+        # Same message ID in another chat or for another bot is a new message.
+        Message(msg_id=1, chatid=2, bot_id=1, text_content='second').save()
+        Message(msg_id=1, chatid=1, bot_id=2, text_content='third').save()
+        with self.assertRaises(mongoengine.NotUniqueError):
+            Message(msg_id=1, chatid=1, bot_id=1, text_content='again').save()
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_messages_without_msg_id(self):
+        Message(bot_id=1).save()
+        Message(bot_id=1).save()
+        self.assertEqual(Message.objects(bot_id=1).count(), 2)
+
     def test_invalid_message_creation(self):
         with self.assertRaises(mongoengine.ValidationError):
             # Invalid datetime
@@ -168,3 +182,33 @@ class DocumentModelTestCase(unittest.TestCase):
         msgs = Message.objects.all()
         self.assertEqual(len(bots), 4)
         self.assertEqual(len(msgs), 20)
+
+    def test_lowercase_usernames(self):
+        bot = MyBot(token='dummy-token', username='MyTestBot').save()
+        self.assertEqual(bot.username_lower, 'mytestbot')
+        msg = Message(msg_id=1, sender_username='Tester', bot_id=1).save()
+        self.assertEqual(msg.sender_username_lower, 'tester')
+        msg = Message(msg_id=2, bot_id=1)
+        msg.validate()
+        self.assertIsNone(msg.to_mongo().get('sender_username_lower'))
+
+    def test_message_record(self):
+        Message(msg_id=1, date=datetime(2016, 10, 1, 12, 0, 0), chatid=10,
+                sender_username='Tester', sender_firstname='Test',
+                text_content='hello', bot_id=1).save()
+        Message(msg_id=2, bot_id=1).save()
+        msgs = Message.objects.order_by('msg_id')
+        records = list(MessageRecord.fetch(msgs))
+        self.assertEqual([record.to_json() for record in records],
+                         [msg.to_json() for msg in msgs])
+        self.assertEqual(records[0].id, msgs[0].id)
+        self.assertRaises(AttributeError, setattr, records[0], 'other', 1)
+
+    def test_sender_name_tokens(self):
+        msg = Message(msg_id=1, sender_firstname='Mary-Ann',
+                      sender_lastname=u'M\xfcller Smith', bot_id=1).save()
+        self.assertEqual(msg.sender_name_tokens,
+                         ['ann', 'mary', u'm\xfcller', 'smith'])
+        msg = Message(msg_id=2, bot_id=1)
+        msg.validate()
+        self.assertEqual(msg.sender_name_tokens, [])
@@ -0,0 +1,76 @@
+"""
+Module containing tests cases for the fake Telegram Bot API server used by
+the ingestion benchmark.
+"""
+import time
+import unittest
+from telegram.bot import Bot
+from telegram.error import TelegramError
+from helper.fake_telegram import FakeTelegramServer, FIRST_BOT_ID
+from helper.benchmark import percentile
+
+
+class FakeTelegramServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeTelegramServer(bots=2, rate=200, chats=3)
+        self.server.start()
+        self.bot = Bot(token=self.server.tokens[0],
+                       base_url=self.server.api_url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get_me(self):
+        user = self.bot.getMe()
+        self.assertEqual(user.id, FIRST_BOT_ID)
+        self.assertEqual(user.username, 'fakebot{0}'.format(FIRST_BOT_ID))
+
+    def test_unknown_token(self):
+        bot = Bot(token='123:unknown', base_url=self.server.api_url)
+        self.assertRaises(TelegramError, bot.getMe)
+
+    def test_no_updates_before_stream_started(self):
+        self.assertEqual(self.bot.getUpdates(timeout=0), [])
+
+    def test_updates_are_generated_at_rate(self):
+        self.server.start_stream()
+        time.sleep(0.1)
+        self.server.stop_stream()
+        updates = self.bot.getUpdates(timeout=0)
+        generated = self.server.bots[0].generated
+        self.assertTrue(10 <= generated <= 30)
+        self.assertEqual([update.update_id for update in updates],
+                         range(1, min(generated, 100) + 1))
+        message = updates[0].message
+        self.assertTrue(1 <= message.chat_id <= 3)
+        self.assertTrue(message.text.startswith('Message 1'))
+        key = (FIRST_BOT_ID, message.chat_id, message.message_id)
+        self.assertIsNotNone(self.server.timings[key][1])
+
+    def test_offset_confirms_updates(self):
+        self.server.start_stream()
+        time.sleep(0.05)
+        self.server.stop_stream()
+        updates = self.bot.getUpdates(timeout=0)
+        last = updates[-1].update_id
+        self.assertEqual(self.bot.getUpdates(offset=last + 1, timeout=0), [])
+        self.assertEqual(self.server.bots[0].pending, [])
+
+    def test_long_poll_waits_for_updates(self):
+        self.server.start_stream()
+        self.bot.getUpdates(timeout=0)
+        updates = self.bot.getUpdates(offset=10 ** 6, timeout=0.2)
+        self.assertEqual(updates, [])
+        self.server.stop_stream()
+
+    def test_send_message(self):
+        message = self.bot.sendMessage(chat_id=5, text='hello')
+        self.assertEqual(message.text, 'hello')
+        self.assertEqual(self.server.bots[0].sent_messages, 1)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([], 0.5), 0.0)
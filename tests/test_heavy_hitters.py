@@ -0,0 +1,152 @@
+"""
+Module containing tests cases for approximate top senders and chats.
+"""
+import json
+import random
+import unittest
+from collections import Counter
+from flask import url_for
+from botapp import create_app
+from botapp.models import HeavyHitterCheckpoint
+from botapp.api_helpers.heavy_hitters import SpaceSaving, HeavyHitters
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+    def stream(self, length=5000, seed=1):
+        # Skewed stream, key n occurs about twice as often as key n+1.
+        rand = random.Random(seed)
+        return ['key{0}'.format(min(int(rand.expovariate(0.7)), 200))
+                for _ in range(length)]
+
+    def check_bounds(self, sketch, counts):
+        for key, count, error in sketch.top(sketch.capacity):
+            self.assertTrue(count - error <= counts[key] <= count)
+        for key in counts:
+            if key not in sketch.counters:
+                self.assertTrue(counts[key] <= sketch.minimum())
+
+    def test_counts_are_exact_below_capacity(self):
+        sketch = SpaceSaving(capacity=10)
+        for key in 'abacab':
+            sketch.offer(key)
+        self.assertEqual(sketch.top(2), [('a', 3, 0), ('b', 2, 0)])
+        self.assertEqual(sketch.minimum(), 0)
+        self.assertEqual(sketch.total, 6)
+
+    def test_counts_are_bounded(self):
+        stream = self.stream()
+        sketch = SpaceSaving(capacity=10)
+        for key in stream:
+            sketch.offer(key)
+        self.assertEqual(len(sketch.counters), 10)
+        self.check_bounds(sketch, Counter(stream))
+        most_common = Counter(stream).most_common(3)
+        self.assertEqual([key for key, count, error in sketch.top(3)],
+                         [key for key, count in most_common])
+
+    def test_merge(self):
+        stream = self.stream()
+        sketches = []
+        for part in range(4):
+            sketch = SpaceSaving(capacity=10)
+            for key in stream[part::4]:
+                sketch.offer(key)
+            sketches.append(sketch)
+        merged = SpaceSaving.merge(sketches, 10)
+        self.assertEqual(merged.total, len(stream))
+        self.assertEqual(len(merged.counters), 10)
+        self.check_bounds(merged, Counter(stream))
+
+    def test_serialization(self):
+        sketch = SpaceSaving(capacity=3)
+        for key in 'abcdab':
+            sketch.offer(key)
+        restored = SpaceSaving.from_list(sketch.to_list(), sketch.total, 3)
+        self.assertEqual(restored.counters, sketch.counters)
+        self.assertEqual(restored.total, 6)
+
+
+class HeavyHittersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.hitters = HeavyHitters(capacity=5, window=60, slices=6)
+
+    def tearDown(self):
+        self.hitters.close()
+        HeavyHitterCheckpoint.drop_collection()
+        self.app_context.pop()
+
+    def record(self, now, chatid=10, username='tester', count=1, bot_id=1):
+        self.hitters.record([{'bot_id': bot_id, 'chatid': chatid,
+                              'sender_username_lower': username}] * count,
+                            now=now)
+
+    def test_top_senders_and_chats(self):
+        self.record(1000, username='flooder', count=20)
+        self.record(1005, chatid=11, count=5)
+        self.record(1010, chatid=12, username=None)
+        self.record(1010, bot_id=2, count=50)
+        top = self.hitters.top(1, 'sender', k=1, now=1010)
+        self.assertEqual(top['messages'], 25)
+        self.assertEqual(top['top'], [{'key': 'flooder', 'count': 20,
+                                       'error': 0, 'guaranteed': True}])
+        self.assertEqual(top['others_max'], 5)
+        top = self.hitters.top(1, 'chat', now=1010)
+        self.assertEqual([(entry['key'], entry['count'])
+                          for entry in top['top']], [(10, 20), (11, 5),
+                                                     (12, 1)])
+        self.assertRaises(ValueError, self.hitters.top, 1, 'text')
+
+    def test_window_slides(self):
+        self.record(1000, username='old', count=10)
+        self.record(1030, username='new', count=2)
+        top = self.hitters.top(1, 'sender', now=1059)
+        self.assertEqual(top['messages'], 12)
+        top = self.hitters.top(1, 'sender', now=1065)
+        self.assertEqual(top['top'][0]['key'], 'new')
+        self.assertEqual(top['messages'], 2)
+
+    def test_checkpoint_and_restore(self):
+        self.record(1000, count=3)
+        self.assertEqual(self.hitters.checkpoint(now=1000), 2)
+        self.assertEqual(self.hitters.checkpoint(now=1000), 0)
+        restored = HeavyHitters(capacity=5, window=10 ** 10, slices=6)
+        top = restored.top(1, 'sender')
+        self.assertEqual(top['top'][0]['key'], 'tester')
+        self.assertEqual(top['messages'], 3)
+
+    def test_concurrent_processes_are_merged(self):
+        other = HeavyHitters(capacity=5, window=60, slices=6)
+        self.record(1000, username='alice', count=3)
+        other.record([{'bot_id': 1, 'chatid': 10,
+                       'sender_username_lower': 'bob'}] * 2, now=1001)
+        other.record([{'bot_id': 1, 'chatid': 10,
+                       'sender_username_lower': 'alice'}], now=1021)
+        self.assertEqual(self.hitters.checkpoint(now=1021), 2)
+        self.assertEqual(other.checkpoint(now=1021), 2)
+        other.close()
+        reader = HeavyHitters(capacity=5, window=60, slices=6)
+        top = reader.top(1, 'sender', now=1021)
+        self.assertEqual(top['messages'], 6)
+        self.assertEqual([(entry['key'], entry['count'])
+                          for entry in top['top']], [('alice', 4),
+                                                     ('bob', 2)])
+        document = HeavyHitterCheckpoint.objects(bot_id=1,
+                                                 dimension='sender').first()
+        self.assertEqual(document.version, 2)
+        self.assertEqual(len(document.slices), 2)
+
+    def test_bot_top(self):
+        response = self.client.get(url_for('botapi.bot_top', botid=1,
+                                           dimension='senders', k=5))
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(json_response['top'], [])
+        response = self.client.get(url_for('botapi.bot_top', botid=1,
+                                           dimension='texts'))
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,124 @@
+"""
+Module containing tests cases for the spill journal of the write buffer.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from bson import ObjectId
+from botapp.api_helpers.journal import SpillJournal, QUARANTINE_NAME
+
+
+class SpillJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.written = []
+        self.available = True
+        self.journal = self.new_journal()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def new_journal(self, **kwargs):
+        journal = SpillJournal(directory=self.directory, fsync_interval=60,
+                               replay_interval=60, **kwargs)
+        journal.writer = self.write
+        return journal
+
+    def write(self, documents):
+        if not self.available:
+            return False
+        if any(document.get('invalid') for document in documents):
+            raise ValueError('invalid document')
+        self.written.extend(documents)
+        return True
+
+    def new_document(self, msg_id):
+        return {'_id': ObjectId(), 'msg_id': msg_id, 'bot_id': 1, 'chatid': 1,
+                'date': datetime(2016, 10, 1, 12, 0, 0)}
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name != QUARANTINE_NAME)
+
+    def test_documents_are_durable_after_sync(self):
+        durable = []
+        self.journal.durable_listeners.append(durable.extend)
+        self.journal.append([self.new_document(1), self.new_document(2)])
+        self.assertEqual(durable, [])
+        self.journal.sync()
+        self.assertEqual([doc['msg_id'] for doc in durable], [1, 2])
+        self.assertEqual(self.journal.stats()['pending'], 2)
+
+    def test_replay_writes_and_removes_segments(self):
+        documents = [self.new_document(msg_id) for msg_id in range(5)]
+        self.journal.append(documents)
+        self.journal.sync()
+        self.assertEqual(self.journal.replay(), 5)
+        self.assertEqual(self.written, documents)
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.journal.size(), 0)
+        self.assertEqual(self.journal.stats()['pending'], 0)
+
+    def test_failed_replay_keeps_segment(self):
+        self.journal.append([self.new_document(1)])
+        self.journal.sync()
+        self.available = False
+        self.assertEqual(self.journal.replay(), 0)
+        self.assertEqual(len(self.segments()), 1)
+        self.assertEqual(self.journal.stats()['replay_failures'], 1)
+        self.available = True
+        self.assertEqual(self.journal.replay(), 1)
+        self.assertEqual(self.segments(), [])
+
+    def test_segments_are_rotated(self):
+        self.journal.close()
+        self.journal = self.new_journal(segment_size=200)
+        for msg_id in range(6):
+            self.journal.append([self.new_document(msg_id)])
+        self.assertTrue(len(self.segments()) > 1)
+        self.journal.sync()
+        self.assertEqual(self.journal.replay(), 6)
+        self.assertEqual([doc['msg_id'] for doc in self.written], range(6))
+
+    def test_segments_are_replayed_after_restart(self):
+        self.journal.append([self.new_document(1), self.new_document(2)])
+        self.journal.close()
+        self.journal = self.new_journal()
+        self.journal.start()
+        self.assertEqual(self.journal.stats()['pending'], 2)
+        self.assertEqual(self.journal.replay(), 2)
+        self.journal.append([self.new_document(3)])
+        self.journal.sync()
+        self.assertEqual(self.journal.replay(), 1)
+        self.assertEqual([doc['msg_id'] for doc in self.written], [1, 2, 3])
+
+    def test_overloaded_and_lag(self):
+        self.journal.close()
+        self.journal = self.new_journal(max_size=100)
+        self.assertFalse(self.journal.overloaded())
+        self.assertEqual(self.journal.lag(), 0.0)
+        self.journal.append([self.new_document(msg_id) for msg_id in
+                             range(3)])
+        self.assertTrue(self.journal.overloaded())
+        self.assertTrue(self.journal.lag() >= 0.0)
+        self.journal.sync()
+        self.journal.replay()
+        self.assertFalse(self.journal.overloaded())
+
+    def test_invalid_document_is_quarantined(self):
+        invalid = dict(self.new_document(2), invalid=True)
+        self.journal.append([self.new_document(1), invalid,
+                             self.new_document(3)])
+        self.journal.sync()
+        self.assertEqual(self.journal.replay(), 3)
+        self.assertEqual([doc['msg_id'] for doc in self.written], [1, 3])
+        self.assertEqual(self.segments(), [])
+        self.assertEqual(self.journal.stats()['quarantined'], 1)
+        self.assertEqual(self.journal.stats()['pending'], 0)
+        with open(os.path.join(self.directory, QUARANTINE_NAME)) as lines:
+            self.assertIn('invalid document', lines.read())
+        self.assertEqual(self.journal.replay(), 0)
@@ -0,0 +1,91 @@
+"""
+Module containing tests cases for data migrations.
+"""
+import unittest
+from bson import ObjectId
+from datetime import datetime
+from botapp import create_app
+from botapp.models import MyBot, Message
+from botapp.migrations import migrate_message_keys, build_indexes, \
+    index_usage, backfill_lowercase_usernames, backfill_name_tokens
+
+
+class MigrationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        # Drop all collections
+        MyBot.drop_collection()
+        Message.drop_collection()
+        self.app_context.pop()
+
+    def test_migrate_message_keys(self):
+        collection = Message._get_collection()
+        # Messages stored with Telegram message ID as primary key.
+        for msg_id in range(1, 4):
+            collection.insert_one({'_id': msg_id, 'date': datetime.now(),
+                                   'chatid': 10, 'bot_id': 1,
+                                   'text_content': 'old message'})
+        # Message already stored with the natural key.
+        Message(msg_id=3, chatid=10, bot_id=1, text_content='new').save()
+
+        migrated, duplicates = migrate_message_keys(batch_size=2)
+        self.assertEqual(migrated, 2)
+        self.assertEqual(duplicates, 1)
+        self.assertEqual(Message.objects.count(), 3)
+        for msg in Message.objects:
+            self.assertIsInstance(msg.id, ObjectId)
+        self.assertEqual(Message.objects(msg_id=1, chatid=10).first()
+                         .text_content, 'old message')
+        self.assertEqual(Message.objects(msg_id=3).first().text_content, 'new')
+
+    def test_migrate_message_keys_without_old_messages(self):
+        Message(msg_id=1, chatid=10, bot_id=1).save()
+        self.assertEqual(migrate_message_keys(), (0, 0))
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_build_indexes(self):
+        indexes = build_indexes()
+        for name in ('bot_id_1_date_-1__id_-1', 'chatid_1_date_-1__id_-1',
+                     'sender_username_lower_1_date_-1__id_-1',
+                     'sender_name_tokens_1_date_-1__id_-1',
+                     'date_-1__id_-1'):
+            self.assertIn(name, indexes['message'])
+
+    def test_index_usage(self):
+        Message(msg_id=1, chatid=10, bot_id=1, date=datetime.now()).save()
+        list(Message.objects(bot_id=1).order_by('-date', '-id'))
+        usage = index_usage(Message)
+        if usage is None:
+            self.skipTest('$indexStats is not supported by the server.')
+        ops = dict((index['name'], index['ops']) for index in usage)
+        self.assertTrue(ops['bot_id_1_date_-1__id_-1'] >= 1)
+
+    def test_backfill_lowercase_usernames(self):
+        # Documents saved before lowercase fields were introduced.
+        MyBot._get_collection().insert_one({'_id': 1, 'token': 'token-1',
+                                            'username': 'OldBot'})
+        Message._get_collection().insert_one({'sender_username': 'Tester',
+                                              'date': datetime.now()})
+        Message(sender_username='NewTester').save()
+        self.assertEqual(backfill_lowercase_usernames(batch_size=1), (1, 1))
+        self.assertEqual(MyBot.objects(username_lower='oldbot').count(), 1)
+        self.assertEqual(Message.objects(
+            sender_username_lower='tester').count(), 1)
+        self.assertEqual(backfill_lowercase_usernames(), (0, 0))
+
+    def test_backfill_name_tokens(self):
+        # Message saved before sender name tokens were introduced.
+        Message._get_collection().insert_one({'sender_firstname': 'Tom',
+                                              'sender_lastname': 'Hanks',
+                                              'date': datetime.now()})
+        Message(sender_firstname='New').save()
+        Message._get_collection().insert_one({'date': datetime.now()})
+        self.assertEqual(backfill_name_tokens(batch_size=1), 1)
+        self.assertEqual(Message.objects(sender_name_tokens='hanks').count(),
+                         1)
+        self.assertEqual(backfill_name_tokens(), 0)
@@ -0,0 +1,70 @@
+"""
+Module containing tests cases for tracking confirmed update offsets.
+"""
+import unittest
+from botapp import create_app
+from botapp.models import MyBot
+from botapp.api_helpers.offsets import UpdateOffsetTracker
+
+
+class UpdateOffsetTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.bot = MyBot(token='dummy-token', test_bot=True).save()
+        self.tracker = UpdateOffsetTracker()
+
+    def tearDown(self):
+        # Drop all collections
+        MyBot.drop_collection()
+        self.app_context.pop()
+
+    def document(self, msg_id):
+        return {'bot_id': self.bot.bot_id, 'chatid': 1, 'msg_id': msg_id}
+
+    def test_offset_waits_for_written_messages(self):
+        bot_id = self.bot.bot_id
+        for update_id in (1, 2, 3):
+            self.assertTrue(self.tracker.received(bot_id, update_id))
+            self.tracker.expect(bot_id, update_id, (bot_id, 1, update_id))
+            self.tracker.handled(bot_id, update_id)
+        self.assertEqual(self.tracker.confirmed(bot_id), 0)
+        self.tracker.settled([self.document(1), self.document(3)])
+        self.assertEqual(self.tracker.confirmed(bot_id), 1)
+        self.assertEqual(MyBot.objects.get(bot_id=bot_id).last_update_id, 1)
+        self.tracker.settled([self.document(2)])
+        self.assertEqual(self.tracker.confirmed(bot_id), 3)
+        self.assertEqual(MyBot.objects.get(bot_id=bot_id).last_update_id, 3)
+
+    def test_updates_without_messages_are_confirmed_when_handled(self):
+        bot_id = self.bot.bot_id
+        self.tracker.received(bot_id, 5)
+        self.tracker.received(bot_id, 6)
+        self.tracker.handled(bot_id, 6)
+        self.assertEqual(self.tracker.confirmed(bot_id), 4)
+        self.tracker.handled(bot_id, 5, failed=True)
+        self.assertEqual(self.tracker.confirmed(bot_id), 6)
+        self.assertEqual(self.tracker.commit(), 1)
+        self.assertEqual(MyBot.objects.get(bot_id=bot_id).last_update_id, 6)
+
+    def test_resume_skips_redundant_updates(self):
+        bot_id = self.bot.bot_id
+        self.assertEqual(self.tracker.resume(bot_id, 10), 11)
+        self.assertFalse(self.tracker.received(bot_id, 9))
+        self.assertFalse(self.tracker.received(bot_id, 10))
+        self.assertTrue(self.tracker.received(bot_id, 11))
+        self.assertFalse(self.tracker.received(bot_id, 11))
+        stats = self.tracker.stats()
+        self.assertEqual(stats['redundant_updates_skipped'], 3)
+        self.assertEqual(stats['resumed_bots'], 1)
+        self.assertEqual(stats['bots'][0]['pending'], 1)
+
+    def test_committed_offset_does_not_move_backwards(self):
+        bot_id = self.bot.bot_id
+        MyBot.objects(bot_id=bot_id).update_one(set__last_update_id=20)
+        self.tracker.received(bot_id, 3)
+        self.tracker.handled(bot_id, 3)
+        self.tracker.commit()
+        self.assertEqual(MyBot.objects.get(bot_id=bot_id).last_update_id, 20)
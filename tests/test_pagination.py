@@ -0,0 +1,88 @@
+"""
+Module containing tests cases for keyset pagination of messages.
+"""
+import unittest
+from datetime import datetime, timedelta
+from bson import ObjectId
+from botapp import create_app
+from botapp.models import MyBot, Message
+from botapp.api_helpers.pagination import encode_cursor, decode_cursor, \
+    seek, Total, bounded_total, estimated_total
+
+
+class PaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        # Drop all collections
+        MyBot.drop_collection()
+        Message.drop_collection()
+        self.app_context.pop()
+
+    def add_messages(self, count):
+        # Pairs of messages share a date, so ties are ordered by id.
+        now = datetime.now().replace(microsecond=0)
+        for msg_id in range(count):
+            Message(msg_id=msg_id, bot_id=1,
+                    date=now - timedelta(minutes=msg_id // 2)).save()
+        return [msg.msg_id for msg in
+                Message.objects.order_by('-date', '-id')]
+
+    def test_cursor_round_trip(self):
+        message = Message(id=ObjectId(),
+                          date=datetime(2016, 10, 1, 12, 30, 15, 250000))
+        cursor = encode_cursor(message)
+        self.assertNotIn('=', cursor)
+        self.assertEqual(decode_cursor(cursor), (message.date, message.id))
+
+    def test_invalid_cursor(self):
+        truncated = encode_cursor(Message(id=ObjectId(),
+                                          date=datetime.now()))[:-4]
+        for cursor in ('abc', 'MTIzNA', truncated, u'\xe9t\xe9'):
+            self.assertRaises(ValueError, decode_cursor, cursor)
+
+    def test_seek_pages_forward(self):
+        expected = self.add_messages(7)
+        page = seek(Message.objects(bot_id=1), 3)
+        self.assertFalse(page.has_prev)
+        seen = [msg.msg_id for msg in page.items]
+        while page.has_next:
+            page = seek(Message.objects(bot_id=1), 3, cursor=page.next_cursor)
+            self.assertTrue(page.has_prev)
+            seen.extend(msg.msg_id for msg in page.items)
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(page.items), 1)
+
+    def test_seek_pages_backward(self):
+        expected = self.add_messages(7)
+        first = seek(Message.objects(bot_id=1), 3)
+        second = seek(Message.objects(bot_id=1), 3, cursor=first.next_cursor)
+        page = seek(Message.objects(bot_id=1), 3, before=second.prev_cursor)
+        self.assertEqual([msg.msg_id for msg in page.items], expected[:3])
+        self.assertFalse(page.has_prev)
+        self.assertEqual(page.next_cursor, first.next_cursor)
+
+    def test_seek_empty(self):
+        page = seek(Message.objects(bot_id=1), 3)
+        self.assertEqual(page.items, [])
+        self.assertFalse(page.has_prev)
+        self.assertFalse(page.has_next)
+
+    def test_total(self):
+        self.assertEqual(str(Total(12345)), '12,345')
+        self.assertEqual(str(Total(10000, exact=False)), '10,000+')
+        self.assertEqual(str(Total(12345, estimated=True)), '~12,345')
+        self.assertFalse(Total(12345, estimated=True).exact)
+
+    def test_bounded_total(self):
+        self.add_messages(7)
+        total = bounded_total(Message.objects(bot_id=1), 5)
+        self.assertEqual((total.value, total.exact), (5, False))
+        total = bounded_total(Message.objects(bot_id=1), 7)
+        self.assertEqual((total.value, total.exact), (7, True))
+        total = estimated_total(Message)
+        self.assertEqual((total.value, total.estimated), (7, True))
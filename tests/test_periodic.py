@@ -0,0 +1,54 @@
+"""
+Module containing tests cases for the periodic background worker.
+"""
+import time
+import unittest
+import threading
+from botapp.api_helpers.periodic import PeriodicWorker
+
+
+class PeriodicWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.worker = PeriodicWorker('test-periodic', self.call,
+                                     lambda: 0.01)
+
+    def tearDown(self):
+        self.worker.close()
+
+    def call(self):
+        self.calls.append(threading.current_thread().name)
+        if len(self.calls) == 1:
+            raise ValueError('First call fails.')
+
+    def test_calls_until_closed(self):
+        self.worker.start()
+        self.worker.start()                 # Already running.
+        time.sleep(0.2)
+        self.worker.close()
+        self.assertFalse(self.worker.running)
+        calls = len(self.calls)
+        self.assertTrue(calls > 2)          # Kept running after the failure.
+        self.assertEqual(set(self.calls), {'test-periodic'})
+        time.sleep(0.05)
+        self.assertEqual(len(self.calls), calls)
+
+    def test_restart_after_close(self):
+        self.worker.start()
+        self.worker.close()
+        self.worker.start()
+        time.sleep(0.1)
+        self.assertTrue(self.worker.running)
+        self.assertTrue(len(self.calls) > 0)
+
+    def test_close_does_not_wait_for_stuck_call(self):
+        release = threading.Event()
+        worker = PeriodicWorker('stuck-periodic', release.wait,
+                                lambda: 0.01)
+        worker.start()
+        time.sleep(0.05)
+        started = time.time()
+        worker.close(timeout=0.1)
+        self.assertTrue(time.time() - started < 1)
+        release.set()
@@ -0,0 +1,186 @@
+"""
+Module containing tests cases for the multiplexed update poller.
+"""
+import json
+import time
+import socket
+import unittest
+import threading
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from telegram import User
+from telegram.bot import Bot
+from botapp.api_helpers.poller import MultiplexedPoller, _HttpResponse
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass                # Poller closing long-polls on teardown.
+
+
+class _BotApiHandler(BaseHTTPRequestHandler):
+    """
+    Serves two updates per bot token and empty long-polls afterwards.
+    """
+    protocol_version = 'HTTP/1.1'
+    tokens = {}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        token = url.path.split('/')[1][len('bot'):]
+        offset = int(parse_qs(url.query).get('offset', ['0'])[0])
+        self.tokens.setdefault(token, []).append(offset)
+        updates = [{'update_id': update_id,
+                    'message': {'message_id': update_id, 'date': 0,
+                                'chat': {'id': 1, 'type': 'private'},
+                                'text': 'message {0}'.format(update_id)}}
+                   for update_id in (1, 2) if update_id >= offset]
+        if not updates:
+            time.sleep(0.2)         # Long-poll without updates.
+        body = json.dumps({'ok': True, 'result': updates})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpResponseTest(unittest.TestCase):
+
+    def test_content_length_response(self):
+        response = _HttpResponse()
+        self.assertFalse(response.feed('HTTP/1.1 200 OK\r\nContent-Le'))
+        self.assertFalse(response.feed('ngth: 4\r\n\r\nab'))
+        self.assertTrue(response.feed('cd'))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, 'abcd')
+        self.assertTrue(response.keep_alive)
+
+    def test_chunked_response(self):
+        response = _HttpResponse()
+        self.assertFalse(response.feed('HTTP/1.1 200 OK\r\nTransfer-Encoding: '
+                                       'chunked\r\n\r\n2\r\nab\r\n'))
+        self.assertTrue(response.feed('3\r\ncde\r\n0\r\n\r\n'))
+        self.assertEqual(response.body, 'abcde')
+
+    def test_response_until_close(self):
+        response = _HttpResponse()
+        self.assertFalse(response.feed('HTTP/1.0 409 Conflict\r\n\r\nab'))
+        self.assertTrue(response.feed('c', eof=True))
+        self.assertEqual(response.status, 409)
+        self.assertEqual(response.body, 'abc')
+        self.assertFalse(response.keep_alive)
+
+    def test_connection_closed_early(self):
+        response = _HttpResponse()
+        response.feed('HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nab')
+        with self.assertRaises(EOFError):
+            response.feed('', eof=True)
+
+
+class MultiplexedPollerTest(unittest.TestCase):
+
+    def setUp(self):
+        _BotApiHandler.tokens = {}
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _BotApiHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.poller = MultiplexedPoller(
+            api_url='http://127.0.0.1:{port}/bot'.format(
+                port=self.server.server_address[1]),
+            timeout=1, network_delay=1)
+        self.received = []
+        self.poller.dispatch = lambda bot, update: self.received.append(
+            (bot.id, update.update_id))
+
+    def tearDown(self):
+        self.poller.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_bot(self, bot_id):
+        bot = Bot(token='{bid}:dummy-token'.format(bid=bot_id))
+        bot.bot = User(id=bot_id, first_name='test')
+        return bot
+
+    def wait_for(self, count):
+        deadline = time.time() + 5
+        while len(self.received) < count and time.time() < deadline:
+            time.sleep(0.05)
+
+    def test_updates_polled_for_all_bots(self):
+        for bot_id in (101, 102, 103):
+            self.poller.add(self.get_bot(bot_id))
+        self.wait_for(6)
+        self.assertEqual(sorted(self.received),
+                         [(101, 1), (101, 2), (102, 1), (102, 2), (103, 1), (103, 2)])
+        self.assertEqual(self.poller.stats()['bots'], 3)
+        self.assertEqual(self.poller.stats()['updates_received'], 6)
+
+    def test_offset_confirms_received_updates(self):
+        self.poller.add(self.get_bot(101))
+        self.wait_for(2)
+        time.sleep(0.5)
+        offsets = _BotApiHandler.tokens['101:dummy-token']
+        self.assertEqual(offsets[0], 0)
+        self.assertTrue(all(offset == 3 for offset in offsets[1:]))
+
+    def test_resume_from_offset(self):
+        self.poller.add(self.get_bot(101), offset=2)
+        self.wait_for(1)
+        time.sleep(0.2)
+        self.assertEqual(self.received, [(101, 2)])
+
+    def test_address_is_resolved_outside_event_loop(self):
+        resolving = []
+        getaddrinfo = socket.getaddrinfo
+
+        def record(*args):
+            resolving.append(threading.current_thread().name)
+            return getaddrinfo(*args)
+
+        socket.getaddrinfo = record
+        try:
+            self.poller.add(self.get_bot(101))
+            self.wait_for(2)
+        finally:
+            socket.getaddrinfo = getaddrinfo
+        self.assertEqual(len(self.received), 2)
+        self.assertTrue(resolving)
+        self.assertNotIn('multiplexed-poller', resolving)
+
+    def test_restart_after_stop(self):
+        self.poller.add(self.get_bot(101))
+        self.wait_for(2)
+        thread = self.poller._thread
+        self.poller.stop()
+        self.assertFalse(thread.is_alive())
+        self.poller.add(self.get_bot(102))      # Starts the poller again.
+        self.wait_for(4)
+        self.assertEqual(sorted(self.received),
+                         [(101, 1), (101, 2), (102, 1), (102, 2)])
+
+    def test_remove_bot(self):
+        self.poller.add(self.get_bot(101))
+        self.wait_for(2)
+        self.assertTrue(self.poller.is_polling(101))
+        self.assertTrue(self.poller.remove(101))
+        self.assertFalse(self.poller.is_polling(101))
+        self.assertFalse(self.poller.remove(101))
+        self.assertEqual(self.poller.bot_ids(), [])
+
+    def test_connections_are_reused(self):
+        for bot_id in (101, 102):
+            self.poller.add(self.get_bot(bot_id))
+        self.wait_for(4)
+        time.sleep(1)
+        stats = self.poller.stats()
+        self.assertTrue(stats['connections_reused'] > 0)
+        self.assertTrue(stats['connections_opened'] <= 4)
@@ -6,8 +6,8 @@ from mongoengine import Q
 from datetime import datetime, timedelta
 from telegram.bot import Bot
 from botapp import create_app
-from botapp.models import MyBot, Message
-from botapp.api_helpers import procedures
+from botapp.models import MyBot, Message, RegistryVersion
+from botapp.api_helpers import procedures, bot_registry
 from helper import CONSTANTS
 
 
@@ -494,5 +494,73 @@ class ProceduresTest(unittest.TestCase):
                 bot_id=12345).save()
         # Get messages
         msgs = procedures.filter_messages(botid=12345, time_min=15, text='test',
-                                          username='tester1', name='test')
+                                          username='tester1', name='test',
+                                          text_mode='substring')
         self.assertEqual(len(msgs), 1)
+
+    def test_filter_messages_by_text_words_and_phrase(self):
+        Message(text_content='meet me at the station').save()
+        Message(text_content='the station is closed today').save()
+        Message(text_content='stationary shop').save()
+        msgs = procedures.filter_messages(text='station')
+        self.assertEqual(len(msgs), 2)
+        msgs = procedures.filter_messages(text='"station is"')
+        self.assertEqual(len(msgs), 1)
+        msgs = procedures.filter_messages(text='station', text_mode='substring')
+        self.assertEqual(len(msgs), 3)
+
+    def test_filter_messages_by_text_rank(self):
+        Message(text_content='hello hello world world',
+                date=datetime.now() - timedelta(minutes=1)).save()
+        Message(text_content='hello world').save()
+        msgs = procedures.filter_messages(text='hello world', rank=True)
+        self.assertEqual(msgs[0].text_content, 'hello hello world world')
+        msgs = procedures.filter_messages(text='hello world')     # By date.
+        self.assertEqual(msgs[0].text_content, 'hello world')
+
+    def test_filter_messages_by_unknown_text_mode(self):
+        with self.assertRaises(ValueError):
+            procedures.filter_messages(text='hello', text_mode='regex')
+
+    def test_filter_messages_by_name_modes(self):
+        Message(sender_firstname='Mary Ann', sender_lastname='Smith').save()
+        Message(sender_firstname='Annabel', sender_lastname='Lee').save()
+        Message(sender_firstname='Joanna', sender_lastname='Doe').save()
+        msgs = procedures.filter_messages(name='ann')
+        self.assertEqual(len(msgs), 2)
+        msgs = procedures.filter_messages(name='ann', name_mode='token')
+        self.assertEqual(len(msgs), 1)
+        msgs = procedures.filter_messages(name='ann', name_mode='substring')
+        self.assertEqual(len(msgs), 3)
+        msgs = procedures.filter_messages(name='ANN smi')  # Every word.
+        self.assertEqual(len(msgs), 1)
+        msgs = procedures.filter_messages(name='--')
+        self.assertEqual(len(msgs), 0)
+
+    def test_filter_messages_by_unknown_name_mode(self):
+        with self.assertRaises(ValueError):
+            procedures.filter_messages(name='ann', name_mode='regex')
+
+
+class RegistryProceduresTest(ProceduresTest):
+    """
+    Procedure tests with bot lookups answered by the bot registry.
+    """
+
+    def setUp(self):
+        self.app = create_app('testing', BOT_REGISTRY_ENABLED=True)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        super(RegistryProceduresTest, self).tearDown()
+        RegistryVersion.drop_collection()
+        create_app('testing')       # Disable the bot registry again.
+
+    def test_queryset_update_is_seen_after_changed(self):
+        bot = MyBot(token=CONSTANTS.LIVE_BOTS.get(1)).save()
+        self.assertEqual(procedures.stop_bot(botid=bot.bot_id), -2)
+        MyBot.objects(bot_id=bot.bot_id).update_one(set__test_bot=True)
+        bot_registry.changed()
+        self.assertEqual(procedures.start_bot(botid=bot.bot_id), -2)
+        self.assertEqual(procedures.start_all(), [])
@@ -6,7 +6,8 @@ import json
 import unittest
 from flask import url_for
 from botapp import create_app
-from botapp.models import MyBot, Message
+from botapp.models import MyBot, Message, MessageRollup, Sender
+from botapp.api_helpers import clear_aggregates, message_counters
 
 
 class ProceduresTest(unittest.TestCase):
@@ -21,6 +22,7 @@ class ProceduresTest(unittest.TestCase):
         # Drop all collections
         MyBot.drop_collection()
         Message.drop_collection()
+        clear_aggregates()
         self.app_context.pop()
 
     def get_api_headers(self):
@@ -52,6 +54,10 @@ class ProceduresTest(unittest.TestCase):
         count = Message.objects.count()
         self.assertEqual(count, 100)
         self.assertTrue(str(count) in json_response['message'])
+        # Generated messages are counted without rebuilding the counters.
+        self.assertEqual(sum(message_counters.counts('bot').values()), 100)
+        self.assertEqual(MessageRollup.objects.sum('count'), 100)
+        self.assertEqual(Sender.objects.sum('messages'), 100)
 
     def test_delete_all_bots(self):
         MyBot.generate_fake(10)
@@ -77,6 +77,93 @@ class ProceduresTest(unittest.TestCase):
         self.assertEqual(json_response['result'], 'success')
         self.assertEqual(len(json_response['messages']), 3)
 
+    def test_filter_messages_by_bot_pages(self):
+        for _ in range(5):
+            Message(bot_id=1234).save()
+        cursor, seen = None, []
+        while True:
+            response = self.client.get(
+                url_for('botapi.filter_messages_by_bot', bot_id=1234,
+                        limit=2, cursor=cursor),
+                headers=self.get_api_headers()
+            )
+            self.assertEqual(response.status_code, 200)
+            json_response = json.loads(response.data.decode('utf-8'))
+            self.assertTrue(len(json_response['messages']) <= 2)
+            seen.extend(json_response['messages'])
+            cursor = json_response['next']
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 5)
+
+    def test_filter_messages_by_bot_page_size_is_capped(self):
+        self.app.config['API_MAX_PAGE_SIZE'] = 3
+        for _ in range(5):
+            Message(bot_id=1234).save()
+        response = self.client.get(
+            url_for('botapi.filter_messages_by_bot', bot_id=1234, limit=100),
+            headers=self.get_api_headers()
+        )
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(json_response['messages']), 3)
+        self.assertIsNotNone(json_response['next'])
+
+    def test_filter_messages_by_bot_stream(self):
+        self.app.config['API_STREAM_BATCH_SIZE'] = 2
+        for _ in range(5):
+            Message(bot_id=1234).save()
+        Message(bot_id=1).save()
+        for query, headers in (({'format': 'ndjson'}, {}),
+                               ({}, {'Accept': 'application/x-ndjson'})):
+            response = self.client.get(
+                url_for('botapi.filter_messages_by_bot', bot_id=1234,
+                        **query), headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            lines = response.data.decode('utf-8').splitlines()
+            self.assertEqual(len(lines), 5)
+            for line in lines:
+                self.assertEqual(json.loads(line)['bot_id'], 1234)
+
+    def test_filter_messages_stream(self):
+        Message(sender_firstname='Tom', sender_lastname='Hanks').save()
+        Message(sender_firstname='Ann', sender_lastname='Lee').save()
+        response = self.client.get(
+            url_for('botapi.filter_messages', botid=0, time_off=0, text='#',
+                    username='#', name='tom', format='ndjson'))
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['sender_firstname'], 'Tom')
+
+    def test_filter_messages_query_count(self):
+        for _ in range(3):
+            Message(bot_id=1234, sender_firstname='Tom').save()
+        response = self.client.get(
+            url_for('botapi.filter_messages_by_bot', bot_id=1234),
+            headers=self.get_api_headers())
+        self.assertEqual(response.headers['X-Query-Count'], '1')
+        response = self.client.get(
+            url_for('botapi.filter_messages_by_bot', bot_id=1234, count=1),
+            headers=self.get_api_headers())
+        self.assertEqual(response.headers['X-Query-Count'], '2')
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(json_response['count'], 3)
+        response = self.client.get(
+            url_for('botapi.filter_messages', botid=1234, time_off=0,
+                    text='#', username='#', name='tom'),
+            headers=self.get_api_headers())
+        self.assertEqual(response.headers['X-Query-Count'], '1')
+
+    def test_filter_messages_by_bot_invalid_cursor(self):
+        for cursor, limit in (('invalid', 10), (None, 0)):
+            response = self.client.get(
+                url_for('botapi.filter_messages_by_bot', bot_id=1234,
+                        cursor=cursor, limit=limit),
+                headers=self.get_api_headers()
+            )
+            self.assertEqual(response.status_code, 400)
+
     def test_filter_messages_using_botid(self):
         # Add some dummy messages
         MyBot.generate_fake(1)
@@ -239,10 +326,27 @@ class ProceduresTest(unittest.TestCase):
         # Get filtered messages
         response = self.client.get(
             url_for('botapi.filter_messages', botid=12345, time_off=15,
-                    text='test', username='tester1', name='test'),
+                    text='test', username='tester1', name='test',
+                    text_mode='substring'),
             headers=self.get_api_headers()
         )
         self.assertEqual(response.status_code, 200)
         json_response = json.loads(response.data.decode('utf-8'))
         self.assertEqual(json_response['result'], 'success')
         self.assertEqual(len(json_response['messages']), 1)
+
+    def test_filter_messages_using_unknown_text_mode(self):
+        response = self.client.get(
+            url_for('botapi.filter_messages', botid=0, time_off=0,
+                    text='message', username='#', name='#', text_mode='regex'),
+            headers=self.get_api_headers()
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_filter_messages_using_unknown_name_mode(self):
+        response = self.client.get(
+            url_for('botapi.filter_messages', botid=0, time_off=0,
+                    text='#', username='#', name='tom', name_mode='regex'),
+            headers=self.get_api_headers()
+        )
+        self.assertEqual(response.status_code, 400)
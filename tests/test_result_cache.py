@@ -0,0 +1,105 @@
+"""
+Module containing tests cases for the cache of message listing results.
+"""
+import sys
+import time
+import unittest
+from flask import Flask
+from botapp.api_helpers.result_cache import FilterCache, LRUBackend, scope, \
+    ALL
+
+
+class FilterCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = FilterCache(backend=LRUBackend(max_entries=3), ttl=60)
+        self.computed = 0
+
+    def compute(self):
+        self.computed += 1
+        return ['page', self.computed]
+
+    def get(self, criteria, scopes):
+        return self.cache.get(criteria, scopes, self.compute)
+
+    def test_results_are_cached(self):
+        first = self.get({'bot_id': 1, 'text': 'hello'}, [scope('bot', 1)])
+        second = self.get({'text': 'Hello ', 'bot_id': 1}, [scope('bot', 1)])
+        self.assertEqual(first, second)
+        self.assertEqual(self.computed, 1)
+        self.get({'bot_id': 1, 'text': 'hello', 'cursor': 'abc'},
+                 [scope('bot', 1)])
+        self.assertEqual(self.computed, 2)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertEqual(stats['hit_ratio'], 0.333)
+
+    def test_wildcards_are_normalized(self):
+        self.get({'text': '#', 'name': None}, [ALL])
+        self.get({'text': '', 'name': '#'}, [ALL])
+        self.assertEqual(self.computed, 1)
+
+    def test_written_messages_invalidate_their_bot_and_chat(self):
+        self.get({'bot_id': 1}, [scope('bot', 1)])
+        self.get({'bot_id': 2}, [scope('bot', 2)])
+        self.get({'chat_id': 5}, [scope('chat', '5')])
+        self.cache.invalidate([{'bot_id': 1, 'chatid': 5}])
+        self.get({'bot_id': 1}, [scope('bot', 1)])
+        self.get({'bot_id': 2}, [scope('bot', 2)])
+        self.get({'chat_id': 5}, [scope('chat', '5')])
+        self.assertEqual(self.computed, 5)      # Bot 2 is still cached.
+
+    def test_written_messages_invalidate_unscoped_results(self):
+        self.get({'username': 'tester'}, [ALL])
+        self.cache.invalidate([{'bot_id': 2, 'chatid': 1}])
+        self.get({'username': 'tester'}, [ALL])
+        self.assertEqual(self.computed, 2)
+
+    def test_clear(self):
+        self.get({'bot_id': 1}, [scope('bot', 1)])
+        self.cache.clear()
+        self.get({'bot_id': 1}, [scope('bot', 1)])
+        self.assertEqual(self.computed, 2)
+
+    def test_least_recently_used_results_are_evicted(self):
+        for bot_id in range(4):
+            self.get({'bot_id': bot_id}, [ALL])
+        self.get({'bot_id': 3}, [ALL])
+        self.get({'bot_id': 0}, [ALL])
+        self.assertEqual(self.computed, 5)
+        self.assertEqual(self.cache.stats()['entries'], 3)
+
+    def test_results_expire(self):
+        self.cache.ttl = 0.01
+        self.get({'bot_id': 1}, [ALL])
+        time.sleep(0.02)
+        self.get({'bot_id': 1}, [ALL])
+        self.assertEqual(self.computed, 2)
+
+    def test_disabled_cache(self):
+        self.cache.enabled = False
+        self.get({'bot_id': 1}, [ALL])
+        self.get({'bot_id': 1}, [ALL])
+        self.assertEqual(self.computed, 2)
+
+    def test_unavailable_backend(self):
+        def unavailable(*args):
+            raise IOError('Connection refused')
+        self.cache.backend.get = unavailable
+        self.assertEqual(self.get({'bot_id': 1}, [ALL]), ['page', 1])
+        self.assertEqual(self.cache.stats()['errors'], 1)
+
+    def test_missing_redis_package_falls_back_to_lru(self):
+        app = Flask(__name__)
+        app.config.update(FILTER_CACHE_BACKEND='redis', FILTER_CACHE_SIZE=5)
+        redis = sys.modules.get('redis')
+        sys.modules['redis'] = None             # Import raises ImportError.
+        try:
+            self.cache.init_app(app)
+        finally:
+            if redis is None:
+                del sys.modules['redis']
+            else:
+                sys.modules['redis'] = redis
+        self.assertIsInstance(self.cache.backend, LRUBackend)
+        self.assertEqual(self.cache.backend.max_entries, 5)
@@ -0,0 +1,154 @@
+"""
+Module containing tests cases for time bucketed message rollups.
+"""
+import json
+import unittest
+import threading
+from datetime import datetime, timedelta
+from bson import ObjectId
+from flask import url_for
+from botapp import create_app
+from botapp.models import MyBot, Message, MessageRollup
+from botapp.api_helpers.rollups import MessageRollups, floor
+
+
+class MessageRollupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.rollups = MessageRollups(retention=3600)
+        self.now = floor(datetime.now(), 3600) + timedelta(minutes=30)
+
+    def tearDown(self):
+        self.rollups.close()
+        # Drop all collections
+        MyBot.drop_collection()
+        Message.drop_collection()
+        MessageRollup.drop_collection()
+        self.app_context.pop()
+
+    def record(self, minutes_ago, chatid=10, bot_id=1, count=1):
+        date = self.now - timedelta(minutes=minutes_ago)
+        self.rollups.record([{'bot_id': bot_id, 'chatid': chatid,
+                              'date': date} for _ in range(count)])
+
+    def series(self, resolution, chatid=None, hours=6):
+        return [count for bucket, count in self.rollups.series(
+            1, self.now - timedelta(hours=hours), self.now + timedelta(1),
+            resolution=resolution, chatid=chatid)]
+
+    def test_floor(self):
+        date = datetime(2016, 10, 1, 12, 34, 56, 789)
+        self.assertEqual(floor(date, 60), datetime(2016, 10, 1, 12, 34))
+        self.assertEqual(floor(date, 3600), datetime(2016, 10, 1, 12))
+        self.assertEqual(floor(date, 86400), datetime(2016, 10, 1))
+
+    def test_written_messages_are_counted_per_minute(self):
+        self.record(0, count=3)
+        self.record(0, chatid=11)
+        self.record(5)
+        self.record(0, bot_id=2)
+        self.assertEqual(self.series('minute'), [1, 4])
+        self.assertEqual(self.series('minute', chatid=11), [1])
+        self.assertEqual(self.series('hour'), [5])
+        self.assertEqual(MessageRollup.objects(resolution='minute').count(),
+                         4)
+
+    def test_late_messages_are_counted_per_hour(self):
+        self.record(180, count=2)
+        self.assertEqual(MessageRollup.objects(resolution='hour').count(), 1)
+        self.assertEqual(self.series('minute'), [])
+        self.assertEqual(self.series('hour'), [2])
+
+    def test_compact(self):
+        self.rollups.retention = 86400
+        for minutes_ago in (0, 20, 70, 80, 80, 140):
+            self.record(minutes_ago)
+        self.rollups.retention = 0
+        # Minutes before the previous hour are folded.
+        self.assertEqual(self.rollups.compact(
+            now=self.now + timedelta(hours=1)), 3)
+        self.assertEqual(MessageRollup.objects(resolution='hour').count(), 2)
+        self.assertEqual(self.series('hour'), [1, 3, 2])
+        self.assertEqual(sum(self.series('day', hours=48)), 6)
+        self.assertEqual(self.rollups.stats()['compacted'], 3)
+
+    def test_concurrent_compactions_fold_buckets_once(self):
+        self.rollups.retention = 86400
+        for minutes_ago in range(0, 600, 3):
+            self.record(minutes_ago, chatid=10 + minutes_ago % 4)
+        total = sum(self.series('hour', hours=12))
+        now = self.now + timedelta(hours=1)
+        compactions = [MessageRollups(retention=0) for _ in range(4)]
+        threads = [threading.Thread(target=rollups.compact, args=(now,))
+                   for rollups in compactions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(self.series('hour', hours=12)), total)
+        self.assertEqual(sum(rollups.stats()['compacted']
+                             for rollups in compactions),
+                         len(range(33, 600, 3)))
+        # Minutes of the previous hour are kept.
+        self.assertEqual(MessageRollup.objects(resolution='minute').count(),
+                         len(range(0, 33, 3)))
+
+    def test_expired_claims_are_folded_once(self):
+        self.rollups.retention = 86400
+        for minutes_ago in (70, 80, 140):
+            self.record(minutes_ago)
+        total = sum(self.series('hour'))
+        now = self.now + timedelta(hours=1)
+        # A compaction claimed the minutes and folded one before it crashed.
+        collection = MessageRollup._get_collection()
+        collection.update_many({'resolution': 'minute'},
+                               {'$set': {'compaction': ObjectId(),
+                                         'claimed_at': now -
+                                         timedelta(seconds=60)}})
+        minute = collection.find_one({'resolution': 'minute',
+                                      'bucket': self.now -
+                                      timedelta(minutes=80)})
+        collection.update_one({'bot_id': 1, 'chatid': 10,
+                               'resolution': 'hour',
+                               'bucket': floor(minute['bucket'], 3600)},
+                              {'$inc': {'count': minute['count']},
+                               '$push': {'folded': minute['_id']}},
+                              upsert=True)
+        self.rollups.retention = 0
+        self.assertEqual(self.rollups.compact(now=now), 0)  # Not expired.
+        self.rollups.claim_timeout = 30
+        self.assertEqual(self.rollups.compact(now=now), 3)
+        self.assertEqual(sum(self.series('hour')), total)
+        self.assertEqual(MessageRollup.objects(resolution='minute').count(),
+                         0)
+
+    def test_rebuild(self):
+        for minutes_ago in (0, 1, 180):
+            Message(msg_id=minutes_ago + 1, chatid=10, bot_id=1,
+                    date=self.now - timedelta(minutes=minutes_ago)).save()
+        self.record(0, count=5)                 # Replaced by rebuild.
+        self.assertEqual(self.rollups.rebuild(now=self.now), 3)
+        self.assertEqual(self.series('hour'), [1, 2])
+        self.assertEqual(self.series('minute'), [1, 1])
+
+    def test_bot_activity(self):
+        self.record(0, count=2)
+        response = self.client.get(url_for(
+            'botapi.bot_activity', botid=1, resolution='minute',
+            start=(self.now - timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M'),
+            end=(self.now + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M')))
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(json_response['series'], [
+            {'time': self.now.isoformat(), 'count': 2}])
+
+    def test_bot_activity_invalid_arguments(self):
+        for args in ({'resolution': 'week'}, {'start': 'yesterday'},
+                     {'start': '2016-10-02', 'end': '2016-10-01'}):
+            response = self.client.get(url_for('botapi.bot_activity',
+                                               botid=1, **args))
+            self.assertEqual(response.status_code, 400)
@@ -0,0 +1,97 @@
+"""
+Module containing tests cases for the sender directory and typeahead lookups.
+"""
+import json
+import unittest
+from datetime import datetime
+from flask import url_for
+from botapp import create_app
+from botapp.models import MyBot, Message, Sender
+from botapp.api_helpers.sender_directory import SenderDirectory, \
+    prefix_pattern
+from botapp.api_helpers.write_buffer import MessageWriteBuffer
+
+
+class PrefixPatternTest(unittest.TestCase):
+
+    def test_special_characters_are_escaped(self):
+        self.assertEqual(prefix_pattern('ab'), '^ab')
+        self.assertEqual(prefix_pattern('a.b*'), r'^a\.b\*')
+
+
+class SenderDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.directory = SenderDirectory()
+        self.buffer = MessageWriteBuffer(max_size=100, flush_interval=60)
+        self.buffer.flush_listeners.append(self.directory.record)
+
+    def tearDown(self):
+        self.buffer.close()
+        # Drop all collections
+        MyBot.drop_collection()
+        Message.drop_collection()
+        Sender.drop_collection()
+        self.app_context.pop()
+
+    def log(self, msg_id, username, bot_id=1, day=1):
+        self.buffer.put(Message(msg_id=msg_id, date=datetime(2016, 10, day),
+                                chatid=10, bot_id=bot_id,
+                                sender_username=username, text_content='hi'))
+
+    def test_record_and_lookup(self):
+        self.log(1, 'Alice', day=1)
+        self.log(2, 'alice', day=3)
+        self.log(3, 'Albert')
+        self.log(4, 'bob')
+        self.log(5, 'unknown')
+        self.buffer.flush()
+        senders = self.directory.lookup('AL')
+        self.assertEqual([sender['username'] for sender in senders],
+                         ['Albert', 'alice'])
+        self.assertEqual(senders[1]['messages'], 2)
+        self.assertEqual(senders[1]['last_seen'], datetime(2016, 10, 3))
+        self.assertEqual(len(self.directory.lookup('', limit=2)), 2)
+        self.assertEqual(self.directory.lookup('unk'), [])
+
+    def test_forget_bot(self):
+        self.log(1, 'alice', bot_id=1)
+        self.log(2, 'alice', bot_id=2)
+        self.log(3, 'bob', bot_id=1)
+        self.buffer.flush()
+        self.directory.forget_bot(1)
+        Message.objects(bot_id=1).delete()
+        senders = self.directory.lookup('')
+        self.assertEqual(len(senders), 1)
+        self.assertEqual(senders[0]['messages'], 1)
+
+    def test_rebuild(self):
+        for msg_id in range(1, 6):
+            self.log(msg_id, 'user{0}'.format(msg_id % 2))
+        self.buffer.flush()
+        Sender.drop_collection()
+        self.assertEqual(self.directory.rebuild(batch_size=1), 2)
+        self.assertEqual([sender['messages'] for sender in
+                          self.directory.lookup('user')], [2, 3])
+
+    def test_typeahead(self):
+        from botapp.api_helpers import sender_directory
+        sender_directory.record([{'sender_username_lower': 'carol',
+                                  'sender_username': 'Carol',
+                                  'date': datetime(2016, 10, 1)}])
+        MyBot(bot_id=1, username='carbot', token='dummy-token').save()
+        response = self.client.get(url_for('botapi.typeahead', q='Ca'))
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(json_response['matches'][0]['username'], 'Carol')
+        response = self.client.get(url_for('botapi.typeahead', kind='bots',
+                                           q='car'))
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(json_response['matches'],
+                         [{'bot_id': 1, 'username': 'carbot'}])
+        response = self.client.get(url_for('botapi.typeahead', kind='chats'))
+        self.assertEqual(response.status_code, 400)
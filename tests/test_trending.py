@@ -0,0 +1,71 @@
+"""
+Module containing tests cases for the trending terms detector.
+"""
+import unittest
+from botapp.api_helpers.trending import TrendingTerms, CountMinSketch, terms
+
+
+class TrendingTermsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trending = TrendingTerms(window=60, decay=0.5, candidates=20,
+                                      min_count=3, width=256)
+
+    def record(self, now, text, count=1, bot_id=1):
+        self.trending.record([{'bot_id': bot_id, 'text_content': text}] *
+                             count, now=now)
+
+    def test_terms(self):
+        self.assertEqual(terms(u'Server is DOWN, 500 errors!'),
+                         [u'server', u'down', u'errors', u'server down',
+                          u'down errors'])
+        self.assertEqual(terms(None), [])
+
+    def test_count_min_sketch(self):
+        sketch = CountMinSketch(width=64, depth=4)
+        for value in range(500):
+            sketch.add('term{0}'.format(value % 50))
+        for value in range(50):
+            self.assertTrue(sketch.estimate('term{0}'.format(value)) >= 10)
+        self.assertEqual(sketch.add('term1', 5), sketch.estimate('term1'))
+        self.assertEqual(sketch.total, 505)
+
+    def test_spiking_terms_trend(self):
+        for window in range(4):
+            self.record(1200 + window * 60, u'good morning', count=10)
+        self.record(1440, u'good morning', count=10)
+        self.record(1440, u'outage again', count=5)
+        result = self.trending.trending(now=1499)
+        self.assertEqual(set(entry['term'] for entry in result[:3]),
+                         set([u'outage', u'again', u'outage again']))
+        morning = [entry for entry in result if entry['term'] == u'morning']
+        self.assertTrue(morning[0]['expected'] > 9)
+        self.assertTrue(morning[0]['score'] < result[0]['score'])
+
+    def test_trending_per_bot(self):
+        self.record(1200, u'hello there', count=5)
+        self.record(1200, u'other bot', count=5, bot_id=2)
+        self.assertEqual(set(entry['term'] for entry in
+                             self.trending.trending(bot_id=2, now=1210)),
+                         set([u'other', u'bot', u'other bot']))
+        self.assertEqual(len(self.trending.trending(now=1210, k=100)), 6)
+        self.assertEqual(self.trending.trending(bot_id=3, now=1210), [])
+        self.trending.forget_bot(2)
+        self.assertEqual(self.trending.trending(bot_id=2, now=1210), [])
+
+    def test_candidates_are_bounded(self):
+        for value in range(100):
+            self.record(1200, u'word{0}'.format(value))
+        self.record(1200, u'frequent', count=10)
+        scope = self.trending._scopes[1]
+        self.assertEqual(len(scope.candidates), 20)
+        self.assertIn(u'frequent', scope.candidates)
+
+    def test_quiet_windows_decay_baseline(self):
+        self.record(1200, u'daily report', count=20)
+        self.record(1200 + 60 * 10, u'daily report', count=5)
+        result = self.trending.trending(now=1200 + 60 * 10 + 30)
+        self.assertEqual(len(result), 3)
+        for entry in result:
+            self.assertEqual(entry['count'], 5)
+            self.assertTrue(entry['expected'] < 0.1)
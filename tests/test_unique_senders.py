@@ -0,0 +1,114 @@
+"""
+Module containing tests cases for approximate unique sender counts.
+"""
+import json
+import unittest
+from datetime import datetime, timedelta
+from flask import url_for
+from botapp import create_app
+from botapp.models import SenderSketch
+from botapp.api_helpers.unique_senders import HyperLogLog, UniqueSenders
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+    def sketch(self, values):
+        sketch = HyperLogLog(precision=12)
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+    def assertEstimate(self, estimate, count, error=0.05):
+        self.assertTrue(abs(estimate - count) <= count * error,
+                        '{0} is not about {1}'.format(estimate, count))
+
+    def test_count(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+        self.assertEqual(self.sketch(['a', 'b', 'a', u'\xe4']).count(), 3)
+        self.assertEstimate(self.sketch('user{0}'.format(i)
+                                        for i in range(50000)).count(), 50000)
+
+    def test_merge(self):
+        first = self.sketch('user{0}'.format(i) for i in range(3000))
+        second = self.sketch('user{0}'.format(i) for i in range(2000, 6000))
+        self.assertEstimate(first.merge(second).count(), 6000)
+
+    def test_serialization(self):
+        for count in (5, 20000):
+            sketch = self.sketch('user{0}'.format(i) for i in range(count))
+            data = sketch.to_bytes()
+            self.assertEqual(HyperLogLog.from_bytes(data).registers,
+                             sketch.registers)
+        self.assertTrue(len(self.sketch(['a', 'b']).to_bytes()) < 10)
+
+
+class UniqueSendersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.senders = UniqueSenders()
+        self.day = datetime(2016, 10, 1)
+
+    def tearDown(self):
+        self.senders.close()
+        SenderSketch.drop_collection()
+        self.app_context.pop()
+
+    def record(self, hours, senders, chatid=10, bot_id=1):
+        self.senders.record([{'bot_id': bot_id, 'chatid': chatid,
+                              'sender_username_lower': sender,
+                              'date': self.day + timedelta(hours=hours)}
+                             for sender in senders])
+
+    def estimate(self, start_hours, end_hours, kind='bot', key=1):
+        return self.senders.estimate(
+            kind, key, self.day + timedelta(hours=start_hours),
+            self.day + timedelta(hours=end_hours))
+
+    def test_estimate(self):
+        self.record(1, ['a', 'b', 'c'])
+        self.record(5, ['a', 'd'], chatid=11)
+        self.record(30, ['e'])
+        self.record(1, ['x'], bot_id=2)
+        self.assertEqual(self.estimate(0, 48), 5)
+        self.assertEqual(self.estimate(0, 24), 4)
+        self.assertEqual(self.estimate(2, 31), 3)         # Hours and a day.
+        self.assertEqual(self.estimate(0, 48, kind='chat', key=11), 2)
+        self.senders.persist()
+        self.assertEqual(self.estimate(0, 48), 5)
+        self.assertEqual(self.estimate(1.5, 5.5), 4)        # Whole hours.
+
+    def test_concurrent_processes_are_merged(self):
+        other = UniqueSenders()
+        self.record(1, ['a', 'b'])
+        other.record([{'bot_id': 1, 'chatid': 10, 'date': self.day,
+                       'sender_username_lower': 'c'}])
+        self.senders.persist()
+        other.persist()
+        self.assertEqual(self.estimate(0, 24), 3)
+        self.assertEqual(SenderSketch.objects(kind='bot', resolution='day')
+                         .first().version, 2)
+
+    def test_forget_bot(self):
+        self.record(1, ['a'])
+        self.senders.persist()
+        self.senders.forget_bot(1)
+        self.assertEqual(self.estimate(0, 24), 0)
+        self.assertEqual(self.estimate(0, 24, kind='chat', key=10), 1)
+
+    def test_bot_unique_senders(self):
+        self.record(1, ['a', 'b'])
+        self.senders.persist()
+        response = self.client.get(url_for(
+            'botapi.bot_unique_senders', botid=1, start='2016-10-01',
+            end='2016-10-02'))
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(json_response['unique_senders'], 2)
+        response = self.client.get(url_for(
+            'botapi.bot_unique_senders', botid=1, start='2016-10-02',
+            end='2016-10-01'))
+        self.assertEqual(response.status_code, 400)
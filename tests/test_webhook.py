@@ -0,0 +1,124 @@
+"""
+Module containing tests cases for receiving updates via webhook.
+"""
+import json
+import time
+import unittest
+from flask import url_for
+from botapp import create_app
+from botapp.models import MyBot, Message, RegistryVersion
+from botapp.api_helpers import procedures, webhook_bots, handler_pool, \
+    bot_registry, ingestion_settings
+
+
+class WebhookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing', INGESTION_MODE='webhook',
+                              WEBHOOK_URL='https://127.0.0.1:8443')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        webhook_bots.clear()
+        # Drop all collections
+        MyBot.drop_collection()
+        Message.drop_collection()
+        self.app_context.pop()
+        create_app('testing')       # Restore default ingestion settings.
+
+    def get_update(self, update_id, text):
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': 42, 'type': 'private'},
+                'from': {'id': 7, 'first_name': 'test', 'last_name': 'user',
+                         'username': 'tester'},
+                'text': text
+            }
+        }
+
+    def add_webhook_bot(self):
+        return MyBot(bot_id=1234, token='1234:dummy-token', username='hookbot',
+                     first_name='hook', webhook_secret='secret123',
+                     state=True).save()
+
+    def test_webhook_url(self):
+        self.assertEqual(procedures.webhook_url('abc'),
+                         'https://127.0.0.1:8443/webhook/abc')
+
+    def test_update_for_unknown_secret(self):
+        response = self.client.post(
+            url_for('webhook.receive_update', secret='unknown'),
+            data=json.dumps(self.get_update(1, 'hello')),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_update_without_body(self):
+        self.add_webhook_bot()
+        response = self.client.post(
+            url_for('webhook.receive_update', secret='secret123'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_for_stopped_bot(self):
+        bot = self.add_webhook_bot()
+        bot.state = False
+        bot.save()
+        response = self.client.post(
+            url_for('webhook.receive_update', secret='secret123'),
+            data=json.dumps(self.get_update(1, 'hello')),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_text_update_is_logged(self):
+        self.add_webhook_bot()
+        for update_id in (1, 2, 2):     # Last update is redelivered.
+            response = self.client.post(
+                url_for('webhook.receive_update', secret='secret123'),
+                data=json.dumps(self.get_update(update_id, 'hello')),
+                content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        handler_pool.join()             # Wait for queued updates.
+        msgs = Message.objects(bot_id=1234)
+        self.assertEqual(msgs.count(), 2)
+        self.assertEqual(msgs.first().chatid, 42)
+        self.assertEqual(msgs.first().sender_username, 'tester')
+        self.assertEqual(msgs.first().text_content, 'hello')
+
+    def test_stop_bot_not_receiving_updates(self):
+        bot = self.add_webhook_bot()
+        bot.state = False
+        bot.save()
+        self.assertEqual(procedures.stop_bot(botid=bot.bot_id), -2)
+
+
+class RegistryWebhookTest(WebhookTest):
+    """
+    Webhook tests with bot lookups answered by the bot registry.
+    """
+
+    def setUp(self):
+        self.app = create_app('testing', INGESTION_MODE='webhook',
+                              WEBHOOK_URL='https://127.0.0.1:8443',
+                              BOT_REGISTRY_ENABLED=True)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        ingestion_settings['webhook_certificate'] = None
+        super(RegistryWebhookTest, self).tearDown()
+        RegistryVersion.drop_collection()
+
+    def test_failed_registration_does_not_change_registered_bot(self):
+        bot = MyBot(bot_id=1234, token='1234:dummy-token', username='hookbot',
+                    first_name='hook').save()
+        # Certificate can not be read, so the webhook is not registered.
+        ingestion_settings['webhook_certificate'] = '/nonexistent/cert.pem'
+        self.assertEqual(procedures.start_bot(botid=bot.bot_id), 0)
+        self.assertIsNone(bot_registry.get(bot.bot_id).webhook_secret)
+        self.assertFalse(bot_registry.get(bot.bot_id).state)
+        self.assertEqual(webhook_bots, {})
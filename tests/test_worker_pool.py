@@ -0,0 +1,114 @@
+"""
+Module containing tests cases for the handler worker pool shared by all bots.
+"""
+import time
+import unittest
+import threading
+from botapp.api_helpers.worker_pool import PartitionedWorkerPool
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = PartitionedWorkerPool(workers=4, queue_size=100)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_partition_order_is_preserved(self):
+        handled = {}
+
+        def handle(key, value):
+            time.sleep(0.001)
+            handled.setdefault(key, []).append(value)
+
+        for value in range(20):
+            for chat_id in range(1, 6):
+                key = (1, chat_id)
+                self.pool.submit(key, handle, key, value)
+        self.pool.join()
+        self.assertEqual(len(handled), 5)
+        for values in handled.values():
+            self.assertEqual(values, range(20))
+
+    def test_partitions_are_handled_in_parallel(self):
+        release = threading.Event()
+        handled = []
+        keys = [(1, chat_id) for chat_id in range(10)]
+        blocked = keys[0]
+        # Find a partition which is not handled by worker of blocked one.
+        other = [key for key in keys
+                 if hash(key) % 4 != hash(blocked) % 4][0]
+        self.pool.submit(blocked, release.wait, 5)
+        self.pool.submit(other, handled.append, other)
+        time.sleep(0.2)
+        self.assertEqual(handled, [other])
+        release.set()
+
+    def test_failing_task_does_not_stop_worker(self):
+        handled = []
+
+        def fail():
+            raise ValueError('failed')
+
+        self.pool.submit((1, 1), fail)
+        self.pool.submit((1, 1), handled.append, 1)
+        self.pool.join()
+        self.assertEqual(handled, [1])
+        self.assertEqual(self.pool.stats()['failed'], 1)
+        self.assertEqual(self.pool.stats()['processed'], 1)
+
+    def test_stats_report_hot_partitions(self):
+        release = threading.Event()
+        self.pool.submit((1, 1), release.wait, 5)
+        for _ in range(3):
+            self.pool.submit((1, 1), len, [])
+        self.pool.submit((2, 7), len, [])
+        time.sleep(0.1)
+        stats = self.pool.stats()
+        self.assertEqual(stats['workers'], 4)
+        self.assertEqual(stats['hot_partitions'][0],
+                         {'bot_id': 1, 'chat_id': 1, 'queued': 4})
+        self.assertEqual(sum(stats['queue_depth']), 3 + (
+            0 if hash((2, 7)) % 4 != hash((1, 1)) % 4 else 1))
+        release.set()
+        self.pool.join()
+        self.assertEqual(self.pool.stats()['hot_partitions'], [])
+
+    def test_close_handles_queued_tasks(self):
+        handled = []
+        for value in range(10):
+            self.pool.submit((1, value), handled.append, value)
+        self.pool.close()
+        self.assertEqual(sorted(handled), range(10))
+
+    def test_close_does_not_wait_for_stuck_handler(self):
+        release = threading.Event()
+        self.pool.submit((1, 1), release.wait, 10)
+        started = time.time()
+        self.pool.close(timeout=0.2)
+        self.assertTrue(time.time() - started < 2)
+        release.set()
+
+    def test_join_does_not_wait_for_stuck_handler(self):
+        release = threading.Event()
+        handled = []
+        self.pool.submit((1, 1), release.wait, 10)
+        self.pool.submit((1, 2), handled.append, 2)
+        self.assertFalse(self.pool.join(timeout=0.2))
+        release.set()
+        self.assertTrue(self.pool.join(timeout=2))
+        self.assertEqual(handled, [2])
+
+    def test_wait_for_partitions_of_one_bot(self):
+        release = threading.Event()
+        handled = []
+        self.pool.submit((1, 1), release.wait, 5)
+        self.pool.submit((2, 1), time.sleep, 0.1)
+        self.pool.submit((2, 2), handled.append, 2)
+        self.assertTrue(self.pool.wait(lambda key: key[0] == 2, timeout=2))
+        self.assertEqual(handled, [2])
+        self.assertFalse(self.pool.wait(lambda key: key[0] == 1,
+                                        timeout=0.1))
+        release.set()
+        self.assertTrue(self.pool.wait(lambda key: key[0] == 1, timeout=2))
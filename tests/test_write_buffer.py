@@ -0,0 +1,176 @@
+"""
+Module containing tests cases for the write-behind message buffer.
+"""
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from botapp import create_app
+from botapp.models import MyBot, Message
+from pymongo.errors import BulkWriteError
+from botapp.api_helpers.write_buffer import MessageWriteBuffer, \
+    bulk_write_reason
+from botapp.api_helpers.journal import SpillJournal
+
+
+class BulkWriteReasonTest(unittest.TestCase):
+
+    def test_write_error(self):
+        error = BulkWriteError({'writeErrors': [{'index': 0, 'code': 2,
+                                                 'errmsg': 'bad document'}],
+                                'writeConcernErrors': []})
+        self.assertEqual(bulk_write_reason(error), 'bad document')
+
+    def test_write_concern_error_only(self):
+        error = BulkWriteError({'writeErrors': [], 'writeConcernErrors': [
+            {'code': 64, 'errmsg': 'waiting for replication timed out'}]})
+        self.assertEqual(bulk_write_reason(error),
+                         'waiting for replication timed out')
+
+
+class WriteBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.buffer = MessageWriteBuffer(max_size=10, flush_interval=60)
+
+    def tearDown(self):
+        self.buffer.close()
+        # Drop all collections
+        MyBot.drop_collection()
+        Message.drop_collection()
+        self.app_context.pop()
+
+    def new_message(self, msg_id, chatid=1):
+        return Message(msg_id=msg_id, date=datetime.now(), chatid=chatid,
+                       sender_username='tester', text_content='text',
+                       bot_id=1)
+
+    def test_messages_queued_until_flush(self):
+        for msg_id in range(1, 6):
+            self.buffer.put(self.new_message(msg_id))
+        self.assertEqual(self.buffer.depth(), 5)
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(self.buffer.flush(), 5)
+        self.assertEqual(self.buffer.depth(), 0)
+        self.assertEqual(Message.objects.count(), 5)
+
+    def test_flush_skips_duplicate_messages(self):
+        self.new_message(3).save()
+        for msg_id in range(1, 6):
+            self.buffer.put(self.new_message(msg_id))
+        self.assertEqual(self.buffer.flush(), 4)
+        self.assertEqual(Message.objects.count(), 5)
+        self.assertEqual(self.buffer.stats()['duplicates'], 1)
+
+    def test_flush_is_idempotent_for_redelivered_messages(self):
+        for _ in range(2):
+            for msg_id in range(1, 4):
+                self.buffer.put(self.new_message(msg_id))
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual(self.buffer.stats()['duplicates'], 3)
+
+    def test_flush_keeps_same_msg_id_from_different_chats(self):
+        self.buffer.put(self.new_message(1, chatid=1))
+        self.buffer.put(self.new_message(1, chatid=2))
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(Message.objects(msg_id=1).count(), 2)
+
+    def test_flush_notifies_listeners(self):
+        flushed = []
+        self.buffer.flush_listeners.append(flushed.extend)
+        for msg_id in range(1, 4):
+            self.buffer.put(self.new_message(msg_id))
+        self.buffer.flush()
+        self.assertEqual(len(flushed), 3)
+
+    def test_flush_settles_written_and_duplicate_messages(self):
+        settled = []
+        self.buffer.settle_listeners.append(settled.extend)
+        self.new_message(2).save()
+        for msg_id in range(1, 4):
+            self.buffer.put(self.new_message(msg_id))
+        self.buffer.flush()
+        self.assertEqual(sorted(doc['msg_id'] for doc in settled), [1, 2, 3])
+
+    def test_saturated_buffer_spills_to_journal(self):
+        directory = tempfile.mkdtemp()
+        journal = SpillJournal(directory=directory, fsync_interval=60,
+                               replay_interval=60)
+        self.buffer.spill_size = 2
+        self.buffer.attach_journal(journal)
+        try:
+            for msg_id in range(1, 5):
+                self.buffer.put(self.new_message(msg_id))
+            self.assertEqual(self.buffer.depth(), 2)
+            self.assertEqual(self.buffer.stats()['spilled'], 2)
+            self.buffer.flush()
+            journal.sync()
+            self.assertEqual(journal.replay(), 2)
+            self.assertEqual(Message.objects.count(), 4)
+        finally:
+            journal.close()
+            shutil.rmtree(directory)
+
+    def invalid_document(self, msg_id):
+        # Field names starting with $ are rejected by the database.
+        document = self.new_message(msg_id).to_mongo()
+        document['$invalid'] = 1
+        return document
+
+    def test_rejected_message_is_dropped_after_retries(self):
+        self.buffer.put(self.new_message(1))
+        self.buffer._queue.append((self.invalid_document(2), 0))
+        self.buffer.put(self.new_message(3))
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.buffer.depth(), 1)
+        self.assertTrue(self.buffer.stats()['healthy'])
+        for attempt in range(self.buffer.max_retries - 1):
+            self.buffer.flush()
+        self.assertEqual(self.buffer.depth(), 0)
+        self.assertEqual(self.buffer.stats()['dropped'], 1)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_replay_quarantines_rejected_message(self):
+        directory = tempfile.mkdtemp()
+        journal = SpillJournal(directory=directory, fsync_interval=60,
+                               replay_interval=60)
+        self.buffer.attach_journal(journal)
+        try:
+            journal.append([self.new_message(1).to_mongo(),
+                            self.invalid_document(2),
+                            self.new_message(3).to_mongo()])
+            journal.sync()
+            self.assertEqual(journal.replay(), 3)
+            self.assertEqual(Message.objects.count(), 2)
+            self.assertEqual(journal.stats()['quarantined'], 1)
+            self.assertEqual(journal.stats()['pending'], 0)
+            self.assertTrue(self.buffer.stats()['healthy'])
+        finally:
+            journal.close()
+            shutil.rmtree(directory)
+
+    def test_close_flushes_queue(self):
+        self.buffer.put(self.new_message(1))
+        self.buffer.close()
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_disabled_buffer_writes_immediately(self):
+        self.buffer.enabled = False
+        self.buffer.put(self.new_message(1))
+        self.assertEqual(self.buffer.depth(), 0)
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_stats(self):
+        self.buffer.put(self.new_message(1))
+        stats = self.buffer.stats()
+        self.assertEqual(stats['queue_depth'], 1)
+        self.assertEqual(stats['flushes'], 0)
+        self.buffer.flush()
+        stats = self.buffer.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['written'], 1)